@@ -0,0 +1,141 @@
+"""Approximate-nearest-neighbour FAISS indexes with recall-based auto-tuning.
+
+Shared by week_05 (build_index / query_engine) and week_06_07/project1_rag.
+All indexes use inner product on L2-normalized vectors (cosine similarity).
+"""
+import json
+import math
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import numpy as np
+import faiss
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+
+# search-time knob tuned for each index type
+SEARCH_PARAM = {"ivf": "nprobe", "ivfpq": "nprobe", "hnsw": "efSearch"}
+EF_SEARCH_CANDIDATES = [16, 32, 64, 128, 256, 512, 1024]
+
+def default_nlist(n: int) -> int:
+    """~4*sqrt(n) inverted lists, keeping at least 39 training points per list."""
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+def default_pq_m(d: int) -> int:
+    """Number of PQ sub-quantizers: aim for 8 dims per sub-vector, must divide d."""
+    m = max(1, d // 8)
+    while d % m:
+        m -= 1
+    return m
+
+def make_index(index_type: str, d: int, n: int, nlist: Optional[int] = None, pq_m: Optional[int] = None,
+               hnsw_m: int = 32) -> faiss.Index:
+    """Create an empty (untrained) index that accepts add_with_ids."""
+    if index_type == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+    if index_type == "hnsw":
+        return faiss.IndexIDMap(faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT))
+    nlist = nlist or default_nlist(n)
+    quantizer = faiss.IndexFlatIP(d)
+    if index_type == "ivf":
+        return faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+    if index_type == "ivfpq":
+        return faiss.IndexIVFPQ(quantizer, d, nlist, pq_m or default_pq_m(d), 8, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+def training_size(index_type: str, index: faiss.Index, n: int) -> int:
+    if index_type in ("ivf", "ivfpq"):
+        nlist = faiss.extract_index_ivf(index).nlist
+        # PQ codebooks (256 centroids per sub-quantizer) need a few thousand points too
+        wanted = max(nlist * 64, 10_000 if index_type == "ivfpq" else 0)
+        return min(n, wanted)
+    return 0
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray, k: int) -> float:
+    hits = sum(len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth))
+    return hits / float(k * len(truth))
+
+def _search_excluding_self(index: faiss.Index, queries: np.ndarray, query_ids: np.ndarray, k: int) -> np.ndarray:
+    # queries are sampled from the database, so drop each query's own id from its results
+    _, I = index.search(queries, k + 1)
+    return np.array([[i for i in row if i != qid][:k] for row, qid in zip(I, query_ids)])
+
+def tune(index: faiss.Index, index_type: str, exact: faiss.Index, queries: np.ndarray, query_ids: np.ndarray,
+         k: int = 10, target_recall: float = 0.95) -> Dict[str, Any]:
+    """Pick the cheapest nprobe/efSearch that reaches `target_recall` recall@k against `exact`."""
+    param = SEARCH_PARAM[index_type]
+    if param == "nprobe":
+        nlist = faiss.extract_index_ivf(index).nlist
+        candidates = [2 ** i for i in range(int(math.log2(nlist)) + 1)]
+        if candidates[-1] != nlist:
+            candidates.append(nlist)
+    else:
+        candidates = EF_SEARCH_CANDIDATES
+
+    truth = _search_excluding_self(exact, queries, query_ids, k)
+    ps = faiss.ParameterSpace()
+    result = {}
+    for value in candidates:
+        ps.set_index_parameter(index, param, value)
+        t0 = time.perf_counter()
+        found = _search_excluding_self(index, queries, query_ids, k)
+        elapsed = time.perf_counter() - t0
+        recall = recall_at_k(found, truth, k)
+        result = {param: value, "recall": recall, "ms_per_query": 1000 * elapsed / len(queries)}
+        print(f"[ann] {param}={value}: recall@{k}={recall:.3f}")
+        if recall >= target_recall:
+            break
+    else:
+        print(f"[ann] target recall {target_recall} not reached, using {param}={result[param]}")
+    return result
+
+def build_ann_index(index_type: str, vectors: np.ndarray, ids: np.ndarray, exact: faiss.Index,
+                    target_recall: float = 0.95, k: int = 10, n_queries: int = 500, nlist: Optional[int] = None,
+                    pq_m: Optional[int] = None, batch_size: int = 65536, seed: int = 0):
+    """Train on a sample of `vectors`, add them all with `ids`, then tune against `exact`.
+
+    `vectors` must already be L2-normalized; it can be a view into another index's storage.
+    Returns (index, params) where params is the JSON-able dict to store next to the index.
+    """
+    n, d = vectors.shape
+    rng = np.random.default_rng(seed)
+    index = make_index(index_type, d, n, nlist=nlist, pq_m=pq_m)
+
+    t0 = time.perf_counter()
+    n_train = training_size(index_type, index, n)
+    if n_train:
+        sample = vectors[np.sort(rng.choice(n, n_train, replace=False))]
+        print(f"[ann] Training {index_type} on {n_train} vectors...")
+        index.train(np.ascontiguousarray(sample, dtype="float32"))
+    for start in range(0, n, batch_size):
+        index.add_with_ids(np.ascontiguousarray(vectors[start:start + batch_size], dtype="float32"),
+                           np.ascontiguousarray(ids[start:start + batch_size], dtype="int64"))
+    params = {"type": index_type, "ntotal": int(n), "k": k, "target_recall": target_recall,
+              "build_seconds": round(time.perf_counter() - t0, 2)}
+    if index_type in ("ivf", "ivfpq"):
+        params["nlist"] = int(faiss.extract_index_ivf(index).nlist)
+    if index_type == "ivfpq":
+        params["pq_m"] = int(faiss.downcast_index(index).pq.M)
+
+    if index_type in SEARCH_PARAM and n > k + 1:
+        q_rows = np.sort(rng.choice(n, min(n_queries, n), replace=False))
+        params.update(tune(index, index_type, exact, np.ascontiguousarray(vectors[q_rows], dtype="float32"),
+                           ids[q_rows], k=k, target_recall=target_recall))
+    return index, params
+
+def apply_search_params(index: faiss.Index, params: Dict[str, Any]) -> faiss.Index:
+    """Set the tuned nprobe/efSearch (if any) on a freshly loaded index."""
+    param = SEARCH_PARAM.get(params.get("type"))
+    if param and param in params:
+        faiss.ParameterSpace().set_index_parameter(index, param, params[param])
+    return index
+
+def save_params(params: Dict[str, Any], path) -> None:
+    Path(path).write_text(json.dumps(params, indent=2), encoding="utf8")
+
+def load_params(path) -> Dict[str, Any]:
+    path = Path(path)
+    if not path.exists():
+        return {"type": "flat"}
+    return json.loads(path.read_text(encoding="utf8"))
@@ -0,0 +1,132 @@
+"""Compact on-disk BM25 inverted index and reciprocal-rank fusion with dense results.
+
+Shared by week_05 (build_index / query_engine) and week_06_07/project1_rag.
+Postings are stored term by term in flat .npy arrays that are memory-mapped at
+load time, so a query only touches the postings of its own terms. Documents are
+identified by the caller's ids (FAISS ids), which is what makes the lexical and
+dense rankings fusable.
+"""
+import json
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# words plus dotted/hyphenated compounds such as "3.2.1", "ora-00942" or "os.path.join"
+TOKEN_RE = re.compile(r"\w+(?:[.\-]\w+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have if in into is it its of on or such that the their "
+    "then there these they this to was were what when where which while who will with".split())
+RRF_K = 60
+
+FILES = {
+    "terms": "terms.json",
+    "offsets": "offsets.npy",   # postings of term t are rows offsets[t]:offsets[t+1]
+    "docs": "docs.npy",         # posting -> document row (uint32)
+    "tfs": "tfs.npy",           # posting -> term frequency (uint16)
+    "doc_ids": "doc_ids.npy",   # document row -> caller id (int64, ascending)
+    "doc_len": "doc_len.npy",   # document row -> length in tokens
+    "meta": "meta.json",
+}
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms; compounds are kept whole and also split into their parts."""
+    tokens = []
+    for tok in TOKEN_RE.findall(text.lower()):
+        if tok in STOPWORDS:
+            continue
+        tokens.append(tok)
+        if "." in tok or "-" in tok:
+            tokens.extend(p for p in re.split(r"[.\-]", tok) if p and p not in STOPWORDS)
+    return tokens
+
+def exists(index_dir) -> bool:
+    return all((Path(index_dir) / name).exists() for name in FILES.values())
+
+def build_bm25(docs: Iterable[Tuple[int, str]], index_dir, k1: float = 1.2, b: float = 0.75) -> Dict[str, float]:
+    """Write the inverted index of (id, text) pairs to `index_dir`; ids must come in ascending order."""
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    postings: Dict[str, Tuple[array, array]] = {}
+    doc_ids, doc_len = array("q"), array("I")
+    for row, (doc_id, text) in enumerate(docs):
+        counts = Counter(tokenize(text))
+        doc_ids.append(int(doc_id))
+        doc_len.append(sum(counts.values()))
+        for term, tf in counts.items():
+            rows, tfs = postings.setdefault(term, (array("I"), array("H")))
+            rows.append(row)
+            tfs.append(min(tf, 65535))
+
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype="int64")
+    offsets[1:] = np.cumsum([len(postings[t][0]) for t in terms])
+    docs_arr = np.empty(int(offsets[-1]), dtype="uint32")
+    tfs_arr = np.empty(int(offsets[-1]), dtype="uint16")
+    for i, t in enumerate(terms):
+        rows, tfs = postings.pop(t)
+        docs_arr[offsets[i]:offsets[i + 1]] = rows
+        tfs_arr[offsets[i]:offsets[i + 1]] = tfs
+
+    n_docs = len(doc_ids)
+    meta = {"n_docs": n_docs, "avgdl": float(sum(doc_len)) / max(n_docs, 1), "k1": k1, "b": b}
+    for key, arr in (("offsets", offsets), ("docs", docs_arr), ("tfs", tfs_arr),
+                     ("doc_ids", np.frombuffer(doc_ids, dtype="int64")),
+                     ("doc_len", np.frombuffer(doc_len, dtype="uint32"))):
+        np.save(index_dir / FILES[key], arr)
+    (index_dir / FILES["terms"]).write_text(json.dumps(terms), encoding="utf8")
+    # meta goes last: together with the other files it marks the index as complete
+    (index_dir / FILES["meta"]).write_text(json.dumps(meta), encoding="utf8")
+    return meta
+
+class BM25Index:
+    def __init__(self, index_dir):
+        index_dir = Path(index_dir)
+        self.meta = json.loads((index_dir / FILES["meta"]).read_text(encoding="utf8"))
+        terms = json.loads((index_dir / FILES["terms"]).read_text(encoding="utf8"))
+        self.term_ids = {t: i for i, t in enumerate(terms)}
+        self.offsets = np.load(index_dir / FILES["offsets"])
+        self.docs = np.load(index_dir / FILES["docs"], mmap_mode="r")
+        self.tfs = np.load(index_dir / FILES["tfs"], mmap_mode="r")
+        self.doc_ids = np.load(index_dir / FILES["doc_ids"])
+        self.doc_len = np.load(index_dir / FILES["doc_len"]).astype("float32")
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def search(self, query: str, k: int, id_ranges: Optional[Sequence[Tuple[int, int]]] = None):
+        """Top-k (ids, scores) for `query`; `id_ranges` ([lo, hi) runs) restricts the documents searched."""
+        n = len(self.doc_ids)
+        k1, b = self.meta["k1"], self.meta["b"]
+        norm = k1 * (1 - b + b * self.doc_len / max(self.meta["avgdl"], 1e-9))
+        scores = np.zeros(n, dtype="float32")
+        for term in set(tokenize(query)):
+            t = self.term_ids.get(term)
+            if t is None:
+                continue
+            lo, hi = self.offsets[t], self.offsets[t + 1]
+            rows = np.asarray(self.docs[lo:hi])
+            tf = np.asarray(self.tfs[lo:hi], dtype="float32")
+            idf = np.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tf * (k1 + 1) / (tf + norm[rows])
+        if id_ranges is not None:
+            allowed = np.zeros(n, dtype=bool)
+            for lo, hi in id_ranges:
+                allowed[np.searchsorted(self.doc_ids, lo):np.searchsorted(self.doc_ids, hi)] = True
+            scores[~allowed] = 0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return self.doc_ids[candidates], scores[candidates]
+
+def rrf_fuse(rankings: Sequence[Sequence[int]], k: int, rrf_k: int = RRF_K) -> List[Tuple[int, float]]:
+    """Reciprocal-rank fusion of several best-first id lists; returns the top-k (id, score)."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[int(doc_id)] = fused.get(int(doc_id), 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(fused.items(), key=lambda item: -item[1])[:k]
@@ -0,0 +1,105 @@
+"""Token-sized, sentence-aligned chunking shared by every RAG pipeline in the repo.
+
+Chunks are measured in embedder tokens (so none is silently truncated by the
+embedder), end on sentence boundaries where possible, and overlap by whole
+trailing sentences of up to `overlap_tokens`. The text is processed in one pass:
+sentences are tokenized in small batches with a fast tokenizer and packed into
+chunks as they stream by. Results are (start, end) character spans into the text.
+"""
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+
+DEFAULT_MAX_TOKENS = 250      # all-MiniLM-L6-v2 embeds at most 256 tokens, [CLS]/[SEP] included
+DEFAULT_OVERLAP_TOKENS = 50
+SENTENCE_BATCH = 64           # sentences tokenized per tokenizer call
+
+# end of a sentence (punctuation plus closing quotes/brackets before whitespace) or a blank line
+BOUNDARY_RE = re.compile(r"[.!?][\"')\]]*(?=\s)|\n\s*\n")
+
+@lru_cache(maxsize=None)
+def load_tokenizer(name: str):
+    """Fast tokenizer of an embedder given by hub/sentence-transformers name or local path."""
+    from transformers import AutoTokenizer
+    try:
+        return AutoTokenizer.from_pretrained(name)
+    except OSError:
+        # short sentence-transformers names ("all-MiniLM-L6-v2") live under that organisation
+        return AutoTokenizer.from_pretrained(f"sentence-transformers/{name}")
+
+def _strip(text: str, s: int, e: int) -> Tuple[int, int]:
+    while s < e and text[s].isspace():
+        s += 1
+    while e > s and text[e - 1].isspace():
+        e -= 1
+    return s, e
+
+def sentence_spans(text: str) -> Iterator[Tuple[int, int]]:
+    start = 0
+    for m in BOUNDARY_RE.finditer(text):
+        end = m.start() if m.group().isspace() else m.end()
+        s, e = _strip(text, start, end)
+        if s < e:
+            yield s, e
+        start = m.end()
+    s, e = _strip(text, start, len(text))
+    if s < e:
+        yield s, e
+
+def _units(text: str, tokenizer, max_tokens: int, piece_tokens: int) -> Iterator[Tuple[int, int, int]]:
+    """(start, end, n_tokens) per sentence; sentences over `max_tokens` are cut into word-aligned pieces."""
+    sentences = sentence_spans(text)
+    while True:
+        batch = [span for _, span in zip(range(SENTENCE_BATCH), sentences)]
+        if not batch:
+            return
+        enc = tokenizer([text[s:e] for s, e in batch], add_special_tokens=False,
+                        return_offsets_mapping=True, verbose=False)
+        for (s, e), offsets in zip(batch, enc["offset_mapping"]):
+            n = len(offsets)
+            if n <= max_tokens:
+                if n:
+                    yield s, e, n
+                continue
+            i = 0
+            while i < n:
+                j = end = min(i + piece_tokens, n)
+                # back off to a token that starts a new word, so words are not split
+                while i + 1 < j < n and offsets[j][0] == offsets[j - 1][1]:
+                    j -= 1
+                if j < n and offsets[j][0] == offsets[j - 1][1]:
+                    j = end   # one very long "word": cut it anyway
+                yield s + offsets[i][0], s + offsets[j - 1][1], j - i
+                i = j
+
+def chunk_spans(text: str, tokenizer, max_tokens: int = DEFAULT_MAX_TOKENS,
+                overlap_tokens: int = DEFAULT_OVERLAP_TOKENS) -> Iterator[Tuple[int, int]]:
+    """Yield (start, end) character spans of chunks of at most `max_tokens` tokens."""
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("chunking needs a fast tokenizer (offset mapping)")
+    if not 0 <= overlap_tokens < max_tokens:
+        raise ValueError("overlap_tokens must be in [0, max_tokens)")
+    # over-long sentences are cut finely enough that overlap can still be carried over
+    piece_tokens = overlap_tokens if overlap_tokens else max_tokens
+    window, total = deque(), 0
+    for unit in _units(text, tokenizer, max_tokens, piece_tokens):
+        n = unit[2]
+        if window and total + n > max_tokens:
+            yield window[0][0], window[-1][1]
+            # trailing sentences (up to overlap_tokens) start the next chunk
+            kept, kept_tokens = deque(), 0
+            while window and kept_tokens + window[-1][2] <= overlap_tokens \
+                    and kept_tokens + window[-1][2] + n <= max_tokens:
+                u = window.pop()
+                kept.appendleft(u)
+                kept_tokens += u[2]
+            window, total = kept, kept_tokens
+        window.append(unit)
+        total += n
+    if window:
+        yield window[0][0], window[-1][1]
+
+def chunk_text(text: str, tokenizer, max_tokens: int = DEFAULT_MAX_TOKENS,
+               overlap_tokens: int = DEFAULT_OVERLAP_TOKENS) -> List[str]:
+    return [text[s:e] for s, e in chunk_spans(text, tokenizer, max_tokens, overlap_tokens)]
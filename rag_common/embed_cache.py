@@ -0,0 +1,146 @@
+"""Persistent, content-addressed embedding cache shared by every project in the repo.
+
+Vectors are keyed by (model key, hash of the text). Each model gets a directory
+with append-only float32 shards (<id>.npy, memory-mapped on read) and one sorted
+index file mapping text hashes to (shard, row), so a whole batch is looked up
+with a single searchsorted. Only cache misses are sent to the model.
+
+The cache lives in $EMBED_CACHE_DIR (default ~/.cache/ai_fellowship/embeddings);
+set EMBED_CACHE_DIR=off to disable it.
+"""
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_DIR = Path.home() / ".cache" / "ai_fellowship" / "embeddings"
+INDEX_DTYPE = np.dtype([("key", "S16"), ("shard", "S12"), ("row", "<u4")])
+FLUSH_ROWS = 16384    # pending vectors written out as one shard
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+class EmbeddingCache:
+    def __init__(self, model_key: str, root=None, flush_rows: int = FLUSH_ROWS):
+        self.model_key = model_key
+        self.dir = Path(root or DEFAULT_DIR) / re.sub(r"[^A-Za-z0-9_.-]+", "__", model_key)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.dir / "index.npy"
+        self.flush_rows = flush_rows
+        self.index = self._read_index()
+        self.shards: Dict[bytes, np.ndarray] = {}
+        self.pending: Dict[bytes, np.ndarray] = {}   # written by the next flush()
+        self.hits = self.misses = 0
+
+    @classmethod
+    def for_model(cls, model_key: str) -> Optional["EmbeddingCache"]:
+        """Cache in the configured directory, or None when caching is turned off."""
+        root = os.getenv("EMBED_CACHE_DIR", str(DEFAULT_DIR))
+        if root.lower() in ("", "off", "0", "none"):
+            return None
+        return cls(model_key, root=root)
+
+    def _read_index(self) -> np.ndarray:
+        if not self.index_path.exists():
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.load(self.index_path)
+
+    def _shard(self, name: bytes) -> np.ndarray:
+        if name not in self.shards:
+            self.shards[name] = np.load(self.dir / f"{name.decode()}.npy", mmap_mode="r")
+        return self.shards[name]
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
+
+    def lookup(self, keys: Sequence[bytes]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """(vectors, found): rows of `vectors` are only meaningful where `found` is True."""
+        raw = list(keys)   # S16 drops trailing NUL bytes, so pending (a dict of raw keys) is looked up with these
+        keys = np.array(raw, dtype="S16")
+        found = np.zeros(len(keys), dtype=bool)
+        vectors = None
+        if len(self.index) and len(keys):
+            pos = np.minimum(np.searchsorted(self.index["key"], keys), len(self.index) - 1)
+            found = self.index["key"][pos] == keys
+            entries = self.index[pos[found]]
+            rows = np.flatnonzero(found)
+            for name in np.unique(entries["shard"]):
+                sel = entries["shard"] == name
+                shard = self._shard(bytes(name))
+                if vectors is None:
+                    vectors = np.zeros((len(keys), shard.shape[1]), dtype="float32")
+                vectors[rows[sel]] = shard[entries["row"][sel]]
+        if self.pending:
+            for i in np.flatnonzero(~found):
+                vec = self.pending.get(raw[i])
+                if vec is not None:
+                    if vectors is None:
+                        vectors = np.zeros((len(keys), len(vec)), dtype="float32")
+                    vectors[i] = vec
+                    found[i] = True
+        return vectors, found
+
+    def put(self, keys: Sequence[bytes], vectors: np.ndarray) -> None:
+        for key, vec in zip(keys, np.asarray(vectors, dtype="float32")):
+            self.pending[key] = vec
+        if len(self.pending) >= self.flush_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write pending vectors as a new shard and merge them into the index file."""
+        if not self.pending:
+            return
+        name = uuid.uuid4().hex[:12]
+        vectors = np.stack(list(self.pending.values()))
+        tmp = self.dir / f"{name}.tmp.npy"
+        np.save(tmp, vectors)
+        os.replace(tmp, self.dir / f"{name}.npy")
+
+        added = np.zeros(len(self.pending), dtype=INDEX_DTYPE)
+        added["key"] = list(self.pending)
+        added["shard"] = name.encode()
+        added["row"] = np.arange(len(added))
+        # re-read the index so entries flushed meanwhile by another process are kept
+        merged = np.concatenate([self._read_index(), added])
+        _, first = np.unique(merged["key"], return_index=True)
+        self.index = merged[first]   # np.unique sorts by key
+        with open(self.index_path.with_suffix(".tmp"), "wb") as f:
+            np.save(f, self.index)
+        os.replace(self.index_path.with_suffix(".tmp"), self.index_path)
+        self.pending = {}
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses}
+
+def encode_cached(texts: Sequence[str], encode: Callable[[List[str]], np.ndarray],
+                  cache: Optional[EmbeddingCache]) -> np.ndarray:
+    """float32 embeddings of `texts`; `encode` is only called on texts missing from the cache.
+
+    Vectors are returned exactly as `encode` produced them (normalize afterwards as before).
+    Pending cache writes are kept in memory until `cache.flush()` or FLUSH_ROWS is reached.
+    """
+    texts = list(texts)
+    if cache is None:
+        return np.asarray(encode(texts), dtype="float32")
+    keys = [text_key(t) for t in texts]
+    vectors, found = cache.lookup(keys)
+    missing: Dict[bytes, List[int]] = {}
+    for i in np.flatnonzero(~found):
+        missing.setdefault(keys[i], []).append(int(i))   # repeated texts are encoded once
+    cache.hits += int(found.sum())
+    cache.misses += len(missing)
+    if missing:
+        first = [rows[0] for rows in missing.values()]
+        new = np.asarray(encode([texts[i] for i in first]), dtype="float32")
+        if vectors is None:
+            vectors = np.zeros((len(texts), new.shape[1]), dtype="float32")
+        for rows, vec in zip(missing.values(), new):
+            vectors[rows] = vec
+        cache.put(list(missing), new)
+    if vectors is None:
+        return np.zeros((0, 0), dtype="float32")
+    return vectors
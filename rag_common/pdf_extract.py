@@ -0,0 +1,181 @@
+"""Page-level PDF text extraction shared by every project in the repo.
+
+Pages are extracted by a process pool, one range of pages per task, and yielded
+in document order with bounded look-ahead. Each page's text is cached on disk by
+(file hash, page, backend), so a PDF read before - however slow its extraction
+was - costs one file hash and a few small reads. Whole documents are assembled
+with a single join and keep the character offset of every page.
+
+The cache lives in $PDF_CACHE_DIR (default ~/.cache/ai_fellowship/pdf_pages);
+set PDF_CACHE_DIR=off to disable it.
+"""
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_DIR = Path.home() / ".cache" / "ai_fellowship" / "pdf_pages"
+BACKENDS = ("pypdf2", "pdfplumber")
+PAGES_PER_TASK = 16
+PAGE_HEADER = "\n\n[PAGE {page}]\n"   # written before each page's text by extract_document
+
+def file_sha256(path, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# -------- backends ----------
+def _open(path, backend: str):
+    if backend == "pypdf2":
+        from PyPDF2 import PdfReader
+        return PdfReader(str(path))
+    if backend == "pdfplumber":
+        import pdfplumber
+        return pdfplumber.open(str(path))
+    raise ValueError(f"Unknown PDF backend {backend!r}; expected one of {BACKENDS}")
+
+def _close(doc) -> None:
+    close = getattr(doc, "close", None)
+    if close is not None:
+        close()
+
+def count_pages(path, backend: str = "pypdf2") -> int:
+    doc = _open(path, backend)
+    try:
+        return len(doc.pages)
+    finally:
+        _close(doc)
+
+def extract_range(path, backend: str, start: int, stop: int) -> List[str]:
+    """Text of pages [start, stop) (0-based). Runs in a worker process, which opens its own reader."""
+    doc = _open(path, backend)
+    try:
+        return [doc.pages[i].extract_text() or "" for i in range(start, stop)]
+    finally:
+        _close(doc)
+
+# -------- page cache ----------
+class PageCache:
+    """<root>/<hash[:2]>/<hash>/<backend>/<page>.txt, plus the page count of the file."""
+    def __init__(self, root=None):
+        self.root = Path(root or DEFAULT_DIR)
+
+    @classmethod
+    def default(cls) -> Optional["PageCache"]:
+        """Cache in the configured directory, or None when caching is turned off."""
+        root = os.getenv("PDF_CACHE_DIR", str(DEFAULT_DIR))
+        if root.lower() in ("", "off", "0", "none"):
+            return None
+        return cls(root)
+
+    def _dir(self, digest: str, backend: str) -> Path:
+        return self.root / digest[:2] / digest / backend
+
+    @staticmethod
+    def _write(path: Path, text: str) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(text, encoding="utf8", errors="surrogatepass")
+        os.replace(tmp, path)
+
+    def get_count(self, digest: str, backend: str) -> Optional[int]:
+        path = self._dir(digest, backend) / "pages"
+        return int(path.read_text()) if path.exists() else None
+
+    def put_count(self, digest: str, backend: str, n: int) -> None:
+        self._write(self._dir(digest, backend) / "pages", str(n))
+
+    def has_range(self, digest: str, backend: str, start: int, stop: int) -> bool:
+        d = self._dir(digest, backend)
+        return all((d / f"{i}.txt").exists() for i in range(start, stop))
+
+    def get_range(self, digest: str, backend: str, start: int, stop: int) -> Optional[List[str]]:
+        """Texts of pages [start, stop), or None unless every one of them is cached."""
+        d = self._dir(digest, backend)
+        try:
+            return [(d / f"{i}.txt").read_text(encoding="utf8", errors="surrogatepass") for i in range(start, stop)]
+        except FileNotFoundError:
+            return None
+
+    def put_range(self, digest: str, backend: str, start: int, texts: Sequence[str]) -> None:
+        d = self._dir(digest, backend)
+        for i, text in enumerate(texts, start):
+            self._write(d / f"{i}.txt", text)
+
+# -------- extraction ----------
+def iter_pages(paths: Sequence, backend: str = "pypdf2", workers: Optional[int] = None,
+               pages_per_task: int = PAGES_PER_TASK, max_pending: Optional[int] = None,
+               use_cache: bool = True) -> Iterator[Tuple[str, int, str]]:
+    """Yield (path, page number from 1, text) for every page of `paths`, in order.
+
+    Cached page ranges are read back; the others are extracted by a process pool
+    (only started when more than one range needs extracting), at most `max_pending`
+    ranges ahead of the consumer, so memory stays bounded however large the corpus is.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown PDF backend {backend!r}; expected one of {BACKENDS}")
+    cache = PageCache.default() if use_cache else None
+    plan = []   # (path, file hash, start, stop, cached)
+    for path in paths:
+        digest = file_sha256(path) if cache is not None else None
+        n = cache.get_count(digest, backend) if cache is not None else None
+        if n is None:
+            n = count_pages(path, backend)
+            if cache is not None:
+                cache.put_count(digest, backend, n)
+        for start in range(0, n, pages_per_task):
+            stop = min(start + pages_per_task, n)
+            plan.append((path, digest, start, stop, cache is not None and cache.has_range(digest, backend, start, stop)))
+
+    misses = sum(not cached for *_, cached in plan)
+    workers = min(workers or os.cpu_count() or 1, misses)
+    max_pending = max_pending or max(workers, 1) * 2
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def finish(entry, future):
+        path, digest, start, stop, cached = entry
+        texts = cache.get_range(digest, backend, start, stop) if cached else None
+        if texts is None:
+            texts = future.result() if future is not None else extract_range(path, backend, start, stop)
+            if cache is not None:
+                cache.put_range(digest, backend, start, texts)
+        for i, text in enumerate(texts, start + 1):
+            yield str(path), i, text
+
+    try:
+        pending = deque()
+        for entry in plan:
+            cached = entry[4]
+            future = pool.submit(extract_range, entry[0], backend, entry[2], entry[3]) \
+                if pool is not None and not cached else None
+            pending.append((entry, future))
+            if len(pending) >= max_pending:
+                yield from finish(*pending.popleft())
+        while pending:
+            yield from finish(*pending.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+def extract_pages(path, backend: str = "pypdf2", workers: Optional[int] = None, use_cache: bool = True) -> List[str]:
+    """Text of every page of one PDF."""
+    return [text for _, _, text in iter_pages([path], backend=backend, workers=workers, use_cache=use_cache)]
+
+def extract_document(path, backend: str = "pdfplumber", header: str = PAGE_HEADER, workers: Optional[int] = None,
+                     use_cache: bool = True) -> Dict[str, Any]:
+    """{"full_text", "page_index"}: the pages joined, each preceded by `header` (formatted with
+    its page number); page_index holds each page's number, start_char (where its header
+    starts) and text length."""
+    parts: List[str] = []
+    page_index = []
+    offset = 0
+    for i, text in enumerate(extract_pages(path, backend=backend, workers=workers, use_cache=use_cache), start=1):
+        head = header.format(page=i)
+        page_index.append({"page": i, "start_char": offset, "length": len(text)})
+        parts += (head, text)
+        offset += len(head) + len(text)
+    return {"full_text": "".join(parts), "page_index": page_index}
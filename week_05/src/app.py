@@ -1,22 +1,25 @@
 # src/app.py
 import streamlit as st
-import os
-import pickle
-from query_engine import init, answer_query
+from query_engine import answer_query, answer_query_stream, RETRIEVAL_MODES, RETRIEVAL_MODE
+from index_manager import IndexManager
+import metrics
 
 st.set_page_config(page_title="Student Research Assistant", layout="wide")
 st.title("📚 AI Research Companion for IT Students")
 
 # --------------- load resources and cached ---------------
 @st.cache_resource
-def load_resources():
-    return init()
+def load_manager():
+    # disk tier keeps cached answers across Streamlit restarts
+    return IndexManager(disk_cache=True)
 
-resources = load_resources()
+manager = load_manager()
+# one snapshot per run: a rebuild finishing mid-run swaps the manager's resources, not these
+resources = manager.resources
+job = manager.job
 
-# get available books from meta
-meta = resources["meta"]
-books = sorted(list({m["source"] for m in meta}))
+# available books come straight from the chunk store's source table
+books = sorted(resources["store"].sources)
 books_display = ["All"] + books
 
 # Sidebar
@@ -28,33 +31,77 @@ with st.sidebar:
     st.write("---")
     book_choice = st.selectbox("Search in", books_display, index=0)
     k = st.slider("Number of retrieved chunks (k)", min_value=1, max_value=8, value=4)
+    mode = st.radio("Retrieval", RETRIEVAL_MODES, index=RETRIEVAL_MODES.index(RETRIEVAL_MODE), horizontal=True,
+                    help="hybrid fuses keyword (BM25) and semantic matches; lexical finds exact terms and codes")
+    stream = st.checkbox("Stream answer (greedy decoding, first words appear sooner)", value=True)
+    debug = st.checkbox("Show timings (debug)", value=False,
+                        help="per-stage latency, token counts and cache hits of each answer")
     st.markdown("**Index / Data**")
     st.write("To add new books: put PDFs in `data/books/` and click Rebuild index.")
-    if st.button("Rebuild index"):
-        st.warning("Rebuilding index — this may take a while. Run `python src/build_index.py` in terminal if it hangs.")
-        os.system("python src/build_index.py")
-        st.experimental_rerun()
+    rebuilding = job is not None and job.running
+    if st.button("Rebuild index", disabled=rebuilding):
+        # runs in the background; questions keep being answered from the current index
+        manager.start_rebuild()
+        job = manager.job
+    if job is not None:
+        status = job.status()
+        if status["running"]:
+            st.progress(status["fraction"], text=f"Rebuilding: {status['stage']} "
+                                                 f"({status['done']}/{status['total']}, {status['seconds']}s)")
+            st.button("Refresh status")
+        elif status["error"]:
+            st.error(f"Rebuild failed: {status['error']}")
+        else:
+            st.success(f"Index {manager.resources['version']} is live (rebuilt in {status['seconds']}s).")
+    with st.expander("Cache statistics"):
+        st.json(resources["cache"].stats())
 
 # Main
 st.markdown("Ask questions from the loaded textbooks. Tip: type `calc: 23*45` to use the calculator.")
 query = st.text_input("Ask a question", placeholder="e.g., What is an eigenvalue?")
 
 if st.button("Ask") and query.strip():
-    with st.spinner("Searching and generating answer..."):
-        answer, contexts = answer_query(query, resources, k=k, book_filter=book_choice)
-    st.subheader("Answer")
-    st.write(answer)
+    # with the debug option this exchange is traced even when RAG_METRICS is off
+    with metrics.trace("ask", force=debug, k=k, mode=mode, stream=stream) as ask_trace:
+        if stream:
+            with st.spinner("Searching..."):
+                contexts, pieces = answer_query_stream(query, resources, k=k, book_filter=book_choice, mode=mode)
+            st.subheader("Answer")
+            placeholder = st.empty()
+            answer = ""
+            for piece in pieces:
+                answer += piece
+                placeholder.write(answer)
+        else:
+            with st.spinner("Searching and generating answer..."):
+                answer, contexts = answer_query(query, resources, k=k, book_filter=book_choice, mode=mode)
+            st.subheader("Answer")
+            st.write(answer)
 
-    # show contexts in expanders
+    if debug and ask_trace is not None:
+        report = ask_trace.as_dict()
+        with st.expander(f"Timings — {report['seconds'] * 1000:.0f} ms"):
+            st.table({"stage": list(report["stages"]),
+                      "ms": [round(seconds * 1000, 1) for seconds in report["stages"].values()]})
+            st.json({"counts": report["counts"], "spans": report["spans"]})
+
+    # show contexts in expanders, numbered as the prompt (and so the answer's citations) numbers them
     st.subheader("Retrieved Contexts")
     for i, c in enumerate(contexts, start=1):
+        i = c.get("context_no", i)
         with st.expander(f"Context {i} — {c['source']} (page {c['page']})"):
             st.write(c["text"])
+            if c.get("also_in"):
+                # near-duplicate copies merged at build time
+                also = [f"{d['source']} (page {d['page']})" for d in c["also_in"]]
+                st.caption("Also in: " + ", ".join(also[:10]) + (f" and {len(also) - 10} more" if len(also) > 10 else ""))
 
     # Download combined result
     combined = f"Question: {query}\n\nAnswer:\n{answer}\n\nSources:\n"
     for i, c in enumerate(contexts, start=1):
-        combined += f"Context {i}: {c['source']} (page {c['page']})\n{c['text']}\n\n"
+        i = c.get("context_no", i)
+        also = "".join(f"; also {d['source']} (page {d['page']})" for d in c.get("also_in", []))
+        combined += f"Context {i}: {c['source']} (page {c['page']}){also}\n{c['text']}\n\n"
 
     st.download_button("Download result (.txt)", combined, file_name="qa_result.txt", mime="text/plain")
 
@@ -0,0 +1,124 @@
+# src/backends.py
+# Inference backends for the embedder and the generator:
+#   torch - full-precision PyTorch (default)
+#   int8  - PyTorch with dynamic int8 quantization of the Linear layers (done at load time)
+#   onnx  - ONNX Runtime; models are exported once and cached under models/
+# Run `python src/backends.py --backend onnx` to check a backend against fp32 PyTorch.
+import os
+import re
+import time
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+
+BACKENDS = ("torch", "int8", "onnx")
+ARTIFACT_DIR = "models"
+
+def artifact_path(name, kind, artifact_dir=ARTIFACT_DIR):
+    return os.path.join(artifact_dir, kind, re.sub(r"[^A-Za-z0-9_.-]+", "__", name))
+
+def quantize_int8(model):
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def require_onnx():
+    try:
+        import onnxruntime  # noqa: F401
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError as e:
+        raise ImportError("The onnx backend needs: pip install optimum[onnxruntime]") from e
+    return ORTModelForSeq2SeqLM
+
+# -------- embedder ----------
+def load_embedder(name, backend="torch", artifact_dir=ARTIFACT_DIR):
+    if backend == "torch":
+        return SentenceTransformer(name)
+    if backend == "int8":
+        return quantize_int8(SentenceTransformer(name))
+    if backend == "onnx":
+        require_onnx()
+        path = artifact_path(name, "embedder-onnx", artifact_dir)
+        if not os.path.exists(os.path.join(path, "modules.json")):
+            print(f"[backends] Exporting {name} to ONNX ({path})...")
+            SentenceTransformer(name, backend="onnx").save(path)
+        return SentenceTransformer(path, backend="onnx")
+    raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+
+# -------- generator ----------
+def load_generator(name, backend="torch", artifact_dir=ARTIFACT_DIR):
+    """Return (tokenizer, model); every backend's model supports .generate()."""
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    if backend == "torch":
+        return tokenizer, AutoModelForSeq2SeqLM.from_pretrained(name)
+    if backend == "int8":
+        return tokenizer, quantize_int8(AutoModelForSeq2SeqLM.from_pretrained(name))
+    if backend == "onnx":
+        ORTModelForSeq2SeqLM = require_onnx()
+        path = artifact_path(name, "generator-onnx", artifact_dir)
+        if not os.path.exists(os.path.join(path, "config.json")):
+            print(f"[backends] Exporting {name} to ONNX ({path})...")
+            ORTModelForSeq2SeqLM.from_pretrained(name, export=True).save_pretrained(path)
+        return tokenizer, ORTModelForSeq2SeqLM.from_pretrained(path)
+    raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+
+# -------- parity check ----------
+SAMPLE_TEXTS = [
+    "A B-tree keeps keys sorted and allows searches, insertions and deletions in logarithmic time.",
+    "TCP provides reliable, ordered delivery of a byte stream between applications.",
+    "An eigenvalue of a matrix A is a scalar lambda such that Av = lambda v for some nonzero v.",
+    "Deadlock requires mutual exclusion, hold and wait, no preemption and circular wait.",
+    "Normalization reduces redundancy in a relational schema by decomposing relations.",
+    "Functions should do one thing, do it well, and do it only.",
+]
+SAMPLE_QUESTIONS = [
+    "What is a B-tree?",
+    "What does TCP guarantee?",
+    "Define an eigenvalue.",
+    "What are the conditions for deadlock?",
+]
+
+def check_parity(emb_model, gen_model, backend, texts=SAMPLE_TEXTS, questions=SAMPLE_QUESTIONS,
+                 min_cosine=0.99, min_answer_match=0.75, max_new_tokens=64):
+    """Compare `backend` with fp32 PyTorch: embedding cosine, greedy-answer agreement and speed."""
+    report = {"backend": backend}
+
+    ref = load_embedder(emb_model, "torch")
+    cand = load_embedder(emb_model, backend)
+    timings = {}
+    for label, model in (("torch", ref), (backend, cand)):
+        model.encode(texts[:1])   # warm-up
+        t0 = time.perf_counter()
+        emb = model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+        timings[label] = (time.perf_counter() - t0, emb)
+    cos = np.sum(timings["torch"][1] * timings[backend][1], axis=1)
+    report["embedding_min_cosine"] = float(cos.min())
+    report["embedding_speedup"] = timings["torch"][0] / max(timings[backend][0], 1e-9)
+
+    tokenizer, ref_gen = load_generator(gen_model, "torch")
+    _, cand_gen = load_generator(gen_model, backend)
+    inputs = tokenizer(questions, return_tensors="pt", padding=True)
+    answers = {}
+    for label, model in (("torch", ref_gen), (backend, cand_gen)):
+        t0 = time.perf_counter()
+        out = model.generate(**inputs, max_new_tokens=max_new_tokens, num_beams=1, do_sample=False)
+        answers[label] = (time.perf_counter() - t0, tokenizer.batch_decode(out, skip_special_tokens=True))
+    matches = [a == b for a, b in zip(answers["torch"][1], answers[backend][1])]
+    report["answer_match_rate"] = sum(matches) / len(matches)
+    report["generation_speedup"] = answers["torch"][0] / max(answers[backend][0], 1e-9)
+
+    report["ok"] = report["embedding_min_cosine"] >= min_cosine and report["answer_match_rate"] >= min_answer_match
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from query_engine import EMB_MODEL, GEN_MODEL
+    parser = argparse.ArgumentParser(description="Check an inference backend against fp32 PyTorch")
+    parser.add_argument("--backend", choices=BACKENDS, default="int8")
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    parser.add_argument("--min-answer-match", type=float, default=0.75)
+    args = parser.parse_args()
+    report = check_parity(EMB_MODEL, GEN_MODEL, args.backend,
+                          min_cosine=args.min_cosine, min_answer_match=args.min_answer_match)
+    print(json.dumps(report, indent=2))
+    raise SystemExit(0 if report["ok"] else 1)
@@ -0,0 +1,431 @@
+# src/benchmark.py
+# Offline, CPU-only benchmark of the RAG engine (ingest -> build_index -> query_engine)
+# and of week_06_07's rag_system (build -> retrieve_topk_local -> rag_answer_local).
+# On a synthetic corpus (or a folder of PDFs) it measures:
+#   ingest pages/sec (PDF extraction + chunking), embed chunks/sec, index build time,
+#   index RAM, retrieve and answer_query latency p50/p95/p99, and recall@k of the
+#   (ANN) index against exact search; for rag_system the build, index RAM, retrieve and
+#   answer latency and recall@k, under "rag_system".
+# Results are written as JSON; --baseline prints the change against an earlier run.
+# Run: python src/benchmark.py --pages 400 --index-type hnsw --out bench.json
+#      python src/benchmark.py --pdf-dir data/books --baseline bench.json
+import os
+import sys
+# models must already be in the local Hugging Face cache (or be local paths): never download
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import gc
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import textwrap
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import faiss
+from ingest import list_pdfs, count_pages, iter_chunks, CHUNK_TOKENS, OVERLAP_TOKENS
+from build_index import build_index
+from query_engine import (EMB_MODEL, GEN_MODEL, EMB_BACKEND, GEN_BACKEND, RETRIEVAL_MODES, RETRIEVAL_MODE,
+                          load_models, load_index, embed_queries, retrieve, answer_query)
+from rag_common.ann_index import INDEX_TYPES
+from rag_common.chunking import load_tokenizer
+from rag_common.embed_cache import EmbeddingCache, text_key
+
+RAG_SYSTEM_DIR = Path(__file__).resolve().parents[2] / "week_06_07" / "project1_rag"
+ENGINES = ("query_engine", "rag_system")
+
+# -------- synthetic corpus ----------
+SYLLABLES = ["ka", "to", "ri", "sen", "mo", "lu", "ver", "an", "di", "pe", "qua", "zor", "el", "nix", "ta", "bro"]
+
+def make_vocabulary(rng, size=5000):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def synthetic_pages(n_pages, words_per_page=300, seed=0):
+    """Pages of sentences over a made-up vocabulary with Zipf-like word frequencies."""
+    rng = random.Random(seed)
+    vocab = make_vocabulary(rng)
+    weights = [1.0 / rank for rank in range(1, len(vocab) + 1)]
+    for _ in range(n_pages):
+        words = rng.choices(vocab, weights=weights, k=words_per_page)
+        sentences, i = [], 0
+        while i < len(words):
+            n = rng.randint(8, 20)
+            sentences.append(" ".join(words[i:i + n]).capitalize() + ".")
+            i += n
+        yield " ".join(sentences)
+
+def pdf_escape(line):
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_pdf(path, pages):
+    """Minimal uncompressed PDF with one Helvetica text block per page (readable by PyPDF2)."""
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = textwrap.wrap(text, 95)
+        stream = ("BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({pdf_escape(l)}) '" for l in lines) + " ET").encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (n, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % off for off in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+def make_corpus(folder, n_pages, n_books=4, words_per_page=300, seed=0):
+    os.makedirs(folder, exist_ok=True)
+    pages = list(synthetic_pages(n_pages, words_per_page, seed))
+    per_book = -(-len(pages) // n_books)
+    for b in range(n_books):
+        if pages[b * per_book:(b + 1) * per_book]:
+            write_pdf(os.path.join(folder, f"synthetic_{b + 1:02d}.pdf"), pages[b * per_book:(b + 1) * per_book])
+    return list_pdfs(folder)
+
+def sample_queries(texts, n, seed=0, min_words=6, max_words=12):
+    """Queries are runs of consecutive words taken from random chunks, so every query has an answer."""
+    rng = random.Random(seed)
+    queries = []
+    while len(queries) < n and texts:
+        words = rng.choice(texts).split()
+        if len(words) < min_words:
+            continue
+        size = rng.randint(min_words, min(max_words, len(words)))
+        start = rng.randint(0, len(words) - size)
+        queries.append(" ".join(words[start:start + size]))
+    return queries
+
+# -------- measurement helpers ----------
+def latency_stats(seconds):
+    ms = np.array(seconds) * 1000
+    return {"n": len(ms), "mean_ms": round(float(ms.mean()), 3),
+            **{f"p{p}_ms": round(float(np.percentile(ms, p)), 3) for p in (50, 95, 99)}}
+
+def timed(fn, items):
+    times = []
+    for item in items:
+        t0 = time.perf_counter()
+        fn(item)
+        times.append(time.perf_counter() - t0)
+    return times
+
+def rss_mb():
+    """Resident set size of this process in MB (Linux); None where /proc is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+@contextmanager
+def scoped_env(**values):
+    """Set environment variables for the block; their previous values are restored after it."""
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+@contextmanager
+def working_dir(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def dir_mb(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file()) / 2 ** 20
+
+def topk_overlap(found, exact):
+    hits = [len(set(a[a >= 0]) & set(e[e >= 0])) / max(int((e >= 0).sum()), 1) for a, e in zip(found, exact)]
+    return round(float(np.mean(hits)), 4)
+
+def recall_at_k(resources, queries, k):
+    """Overlap of the serving index's dense top-k with exact (flat) search."""
+    q_emb = embed_queries(queries, resources)
+    _, ann = resources["index"].search(q_emb, k)
+    _, exact = resources["flat"].search(q_emb, k)
+    return topk_overlap(ann, exact)
+
+# -------- benchmark ----------
+def run_benchmark(pdf_dir=None, pages=200, books=4, words_per_page=300, n_queries=100, n_answers=10, k=4,
+                  modes=RETRIEVAL_MODES, index_type="flat", target_recall=0.95, chunk_size=CHUNK_TOKENS,
+                  overlap=OVERLAP_TOKENS, batch_size=256, workers=None, emb_model=EMB_MODEL, gen_model=GEN_MODEL,
+                  emb_backend=EMB_BACKEND, gen_backend=GEN_BACKEND, work_dir=None, seed=0, shards=0,
+                  engines=ENGINES):
+    work_dir = os.path.abspath(work_dir or tempfile.mkdtemp(prefix="rag-bench-"))
+    report = {"config": {"corpus": pdf_dir or "synthetic", "pages": pages, "books": books, "queries": n_queries,
+                         "answers": n_answers, "k": k, "index_type": index_type, "shards": shards, "target_recall": target_recall,
+                         "chunk_size": chunk_size, "overlap": overlap, "emb_model": emb_model, "gen_model": gen_model,
+                         "emb_backend": emb_backend, "gen_backend": gen_backend, "seed": seed,
+                         "engines": list(engines)},
+              "env": {"python": platform.python_version(), "platform": platform.platform(),
+                      "cpu_count": os.cpu_count(), "faiss": faiss.__version__,
+                      "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}}
+
+    print("[bench] Preparing corpus...")
+    if pdf_dir:
+        paths = list_pdfs(pdf_dir)
+        books_dir = pdf_dir
+    else:
+        books_dir = os.path.join(work_dir, "books")
+        paths = make_corpus(books_dir, pages, books, words_per_page, seed)
+    n_pages = sum(count_pages(p) for p in paths)
+    report["corpus"] = {"files": len(paths), "pages": n_pages,
+                        "mb": round(sum(os.path.getsize(p) for p in paths) / 2 ** 20, 2)}
+
+    # a private page cache keeps earlier runs from turning extraction into cache reads
+    with scoped_env(PDF_CACHE_DIR=os.path.join(work_dir, "pdf_cache")):
+        if "query_engine" in engines:
+            report.update(bench_query_engine(paths, books_dir, n_pages, work_dir, n_queries=n_queries,
+                                             n_answers=n_answers, k=k, modes=modes, index_type=index_type,
+                                             target_recall=target_recall, chunk_size=chunk_size, overlap=overlap,
+                                             batch_size=batch_size, workers=workers, emb_model=emb_model,
+                                             gen_model=gen_model, emb_backend=emb_backend, gen_backend=gen_backend,
+                                             seed=seed, shards=shards))
+        if "rag_system" in engines:
+            # rag_system indexes one document: all synthetic pages in one PDF, or the largest of --pdf-dir
+            if pdf_dir:
+                pdf_path = max(paths, key=os.path.getsize)
+            else:
+                pdf_path = os.path.join(work_dir, "rag_system.pdf")
+                write_pdf(pdf_path, synthetic_pages(pages, words_per_page, seed))
+            report["rag_system"] = bench_rag_system(pdf_path, work_dir, n_queries=n_queries, n_answers=n_answers,
+                                                    k=k, modes=modes, index_type=index_type,
+                                                    target_recall=target_recall, emb_model=emb_model,
+                                                    gen_model=gen_model, seed=seed)
+    return report
+
+def bench_query_engine(paths, books_dir, n_pages, work_dir, n_queries, n_answers, k, modes, index_type,
+                       target_recall, chunk_size, overlap, batch_size, workers, emb_model, gen_model, emb_backend,
+                       gen_backend, seed, shards):
+    """ingest -> build_index -> query_engine over the corpus `paths` (in `books_dir`)."""
+    report = {}
+    # 1) extraction + chunking, the CPU part of ingest that runs ahead of the embedder
+    print(f"[bench] Ingesting {n_pages} pages...")
+    tokenizer = load_tokenizer(emb_model)
+    t0 = time.perf_counter()
+    texts = [c["text"] for c in iter_chunks(paths, chunk_size=chunk_size, overlap=overlap, workers=workers,
+                                            tokenizer=tokenizer)]
+    secs = time.perf_counter() - t0
+    report["ingest"] = {"seconds": round(secs, 3), "pages_per_sec": round(n_pages / secs, 2), "chunks": len(texts)}
+    if not texts:
+        raise ValueError("The corpus produced no chunks")
+
+    # 2) embedding throughput
+    models = load_models(emb_model, gen_model, emb_backend, gen_backend)
+    embedder = models["embedder"]
+    embedder.encode(texts[:8], convert_to_numpy=True)   # warm-up
+    print(f"[bench] Embedding {len(texts)} chunks...")
+    t0 = time.perf_counter()
+    vectors = embedder.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+    secs = time.perf_counter() - t0
+    report["embed"] = {"seconds": round(secs, 3), "chunks_per_sec": round(len(texts) / secs, 2),
+                       "dim": int(vectors.shape[1])}
+
+    # 3) index build: the vectors just computed are served from a private embedding cache
+    #    (and the pages from the page cache filled by step 1), so this times chunking, dedup,
+    #    FAISS/ANN and BM25 without extracting or embedding twice
+    cache_dir = os.path.join(work_dir, "embed_cache")
+    cache = EmbeddingCache(f"{emb_model}:{emb_backend}", root=cache_dir)
+    cache.put([text_key(t) for t in texts], vectors)
+    cache.flush()
+    del vectors
+    print(f"[bench] Building {index_type} index...")
+    t0 = time.perf_counter()
+    version_dir = build_index(chunk_size=chunk_size, overlap=overlap, folder=books_dir, full=True,
+                              batch_size=batch_size, workers=workers, index_type=index_type,
+                              target_recall=target_recall, backend=emb_backend,
+                              index_dir=os.path.join(work_dir, "indexes"), model=embedder, emb_model=emb_model,
+                              shards=shards, emb_cache=cache)
+    report["build"] = {"seconds": round(time.perf_counter() - t0, 3), "disk_mb": round(dir_mb(version_dir), 2),
+                       "embeddings_cached": cache.hits, "embeddings_encoded": cache.misses}
+    del cache
+
+    # 4) memory of the loaded index (FAISS + chunk store + BM25)
+    gc.collect()
+    before = rss_mb()
+    index_resources = load_index(version_dir)
+    index = index_resources["index"]
+    # one search, so lazily loaded shards are counted too
+    index.search(np.full((1, index.d), 1 / np.sqrt(index.d), dtype="float32"), 1)
+    after = rss_mb()
+    report["memory"] = {"index_rss_mb": round(after - before, 2) if before is not None else None,
+                        "vectors": int(index.ntotal), "vectors_mb": round(index.ntotal * index.d * 4 / 2 ** 20, 2),
+                        "process_rss_mb": round(after, 2) if after is not None else None}
+
+    # no query cache: every call does the full work
+    resources = {**models, "cache": None, **index_resources}
+    queries = sample_queries(texts, n_queries, seed=seed)
+    del texts
+
+    # 5) latency
+    report["retrieve"] = {}
+    for mode in modes:
+        if mode != "dense" and resources["bm25"] is None:
+            continue
+        print(f"[bench] retrieve ({mode}) x {len(queries)}...")
+        timed(lambda q: retrieve(q, resources, k=k, mode=mode), queries[:3])   # warm-up
+        report["retrieve"][mode] = latency_stats(timed(lambda q: retrieve(q, resources, k=k, mode=mode), queries))
+    report["recall"] = {"index_type": index_type, f"recall@{k}": recall_at_k(resources, queries, k)}
+    if n_answers:
+        print(f"[bench] answer_query x {min(n_answers, len(queries))}...")
+        answer_query(queries[0], resources, k=k)   # warm-up
+        report["answer"] = latency_stats(timed(lambda q: answer_query(q, resources, k=k), queries[:n_answers]))
+        report["answer"]["mode"] = RETRIEVAL_MODE
+    return report
+
+def bench_rag_system(pdf_path, work_dir, n_queries, n_answers, k, modes, index_type, target_recall, emb_model,
+                     gen_model, seed):
+    """rag_system's build -> retrieve_topk_local -> rag_answer_local over the one PDF `pdf_path`.
+
+    It runs in `work_dir` (where it keeps its project1-rag/ folder) with a private embedding
+    cache, so every stage of the build is computed.
+    """
+    sys.path.insert(0, str(RAG_SYSTEM_DIR))
+    report = {}
+    with working_dir(work_dir):
+        import rag_system as rs
+        rs.LOCAL_EMBED_MODEL, rs.LOCAL_GEN_MODEL = emb_model, gen_model
+        rs.INDEX_TYPE, rs.TARGET_RECALL = index_type, target_recall
+        cache = rs._models["embed_cache"] = EmbeddingCache(f"{emb_model}:torch", root=os.path.join(work_dir, "rs_embed_cache"))
+        rs.PROJECT_DIR.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(pdf_path, rs.PDF_PATH)
+
+        # 1) build: extract, chunk, embed (the embedder is loaded beforehand), FAISS and BM25
+        rs.get_embed_model()
+        print(f"[bench] rag_system: building {index_type} index...")
+        t0 = time.perf_counter()
+        res = rs.build(rs.CHUNK_CONFIG)
+        secs = time.perf_counter() - t0
+        report["build"] = {"seconds": round(secs, 3), "chunks": len(res["chunks"]),
+                           "chunks_per_sec": round(len(res["chunks"]) / secs, 2),
+                           "embeddings_cached": cache.hits, "embeddings_encoded": cache.misses,
+                           "disk_mb": round(dir_mb(rs.STAGES_DIR), 2)}
+
+        # 2) memory of the loaded index (FAISS + chunks + BM25)
+        rs._index.clear()
+        del res
+        gc.collect()
+        before = rss_mb()
+        res = rs.load_index()
+        index = res["index"]
+        after = rss_mb()
+        report["memory"] = {"index_rss_mb": round(after - before, 2) if before is not None else None,
+                            "vectors": int(index.ntotal)}
+
+        # 3) latency and recall
+        queries = sample_queries(res["chunks"], n_queries, seed=seed)
+        report["retrieve"] = {}
+        for mode in modes:
+            print(f"[bench] rag_system: retrieve ({mode}) x {len(queries)}...")
+            timed(lambda q: rs.retrieve_topk_local(q, k=k, mode=mode), queries[:3])   # warm-up
+            report["retrieve"][mode] = latency_stats(timed(lambda q: rs.retrieve_topk_local(q, k=k, mode=mode),
+                                                           queries))
+        q_emb = np.vstack([rs.embed_query_local(q) for q in queries])
+        vectors = np.load(rs.PROJECT_DIR / res["stages"]["embed"] / rs.EMBEDDINGS_FILE, mmap_mode="r")
+        exact = faiss.IndexFlatIP(vectors.shape[1])
+        exact.add(np.ascontiguousarray(vectors, dtype="float32"))
+        report["recall"] = {"index_type": index_type,
+                            f"recall@{k}": topk_overlap(index.search(q_emb, k)[1], exact.search(q_emb, k)[1])}
+        if n_answers:
+            print(f"[bench] rag_system: rag_answer_local x {min(n_answers, len(queries))}...")
+            rs.rag_answer_local(queries[0], topk=k)   # warm-up
+            report["answer"] = latency_stats(timed(lambda q: rs.rag_answer_local(q, topk=k), queries[:n_answers]))
+            report["answer"]["mode"] = rs.RETRIEVAL_MODE
+    return report
+
+# -------- run-to-run comparison ----------
+def flatten(report, prefix=""):
+    flat = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(report, baseline):
+    """Print every measured number next to the baseline's, with the relative change."""
+    old = flatten({key: baseline.get(key, {}) for key in report if key not in ("config", "env")})
+    new = flatten({key: value for key, value in report.items() if key not in ("config", "env")})
+    print(f"{'metric':40s} {'baseline':>12s} {'now':>12s} {'change':>8s}")
+    for key, value in new.items():
+        if key in old:
+            change = f"{(value - old[key]) / old[key] * 100:+.1f}%" if old[key] else ""
+            print(f"{key:40s} {old[key]:12g} {value:12g} {change:>8s}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark ingest, indexing, retrieval and answering (offline, CPU)")
+    parser.add_argument("--pdf-dir", help="benchmark on these PDFs instead of a synthetic corpus")
+    parser.add_argument("--pages", type=int, default=200, help="synthetic corpus size in pages")
+    parser.add_argument("--books", type=int, default=4, help="synthetic PDFs the pages are spread over")
+    parser.add_argument("--words-per-page", type=int, default=300)
+    parser.add_argument("--queries", type=int, default=100, help="queries timed per retrieval mode")
+    parser.add_argument("--answers", type=int, default=10, help="queries timed end to end with answer_query (0 skips)")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--modes", nargs="+", choices=RETRIEVAL_MODES, default=list(RETRIEVAL_MODES))
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--shards", type=int, default=0, help="build a sharded index with this many shards")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES),
+                        help="query_engine (week_05) and/or rag_system (week_06_07/project1_rag)")
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS)
+    parser.add_argument("--overlap-tokens", type=int, default=OVERLAP_TOKENS)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--emb-model", default=EMB_MODEL)
+    parser.add_argument("--gen-model", default=GEN_MODEL)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", help="keep the corpus and index here (default: a temporary directory)")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier JSON result to compare against")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="rag-bench-")
+    try:
+        report = run_benchmark(pdf_dir=args.pdf_dir, pages=args.pages, books=args.books,
+                               words_per_page=args.words_per_page, n_queries=args.queries, n_answers=args.answers,
+                               k=args.k, modes=args.modes, index_type=args.index_type,
+                               target_recall=args.target_recall, chunk_size=args.chunk_tokens,
+                               overlap=args.overlap_tokens, batch_size=args.batch_size, workers=args.workers,
+                               emb_model=args.emb_model, gen_model=args.gen_model, work_dir=work_dir, seed=args.seed,
+                               shards=args.shards, engines=args.engines)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    with open(args.out, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print("[bench] Saved", args.out)
+    if args.baseline:
+        with open(args.baseline, encoding="utf8") as f:
+            compare(report, json.load(f))
@@ -1,41 +1,395 @@
 # src/build_index.py
 import os
-import pickle
-from sentence_transformers import SentenceTransformer
+import sys
+import json
+import shutil
+import hashlib
+from pathlib import Path
+import numpy as np
 import faiss
-from ingest import ingest_folder
+from backends import BACKENDS, load_embedder
+from ingest import list_pdfs, count_pages, iter_pages, chunk_page, CHUNK_TOKENS, OVERLAP_TOKENS
+from chunk_store import ChunkStore, ChunkStoreWriter, store_paths
+from dedup import MAX_DISTANCE, NearDupIndex, simhash
+from shards import SHARDS_DIR, build_shards, shards_up_to_date, load_meta as load_shards_meta
+from index_versions import (INDEX_DIR, INDEX_FILE, MANIFEST_FILE, BM25_DIR, version_paths, current_version,
+                            new_version, link_files, publish_version)
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # repo root, for rag_common
+from rag_common.ann_index import INDEX_TYPES, build_ann_index, save_params, load_params
+from rag_common import bm25
+from rag_common.pdf_extract import file_sha256
+from rag_common.chunking import load_tokenizer
+from rag_common.embed_cache import EmbeddingCache, encode_cached
 
 EMB_MODEL = "all-MiniLM-L6-v2"
-INDEX_DIR = "indexes"
-INDEX_PATH = os.path.join(INDEX_DIR, "faiss.index")
-META_PATH = os.path.join(INDEX_DIR, "meta.pkl")
+BOOKS_DIR = "data/books"
+
+# -------- content hashes ----------
+def text_sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# -------- previous build (index + chunk store + manifest) ----------
+def empty_state(params):
+    manifest = {"params": params, "next_id": 0, "files": {}}
+    return None, None, manifest
+
+def load_state(params, version_dir):
+    """Load a previous build if it was made with the same model and chunking params."""
+    paths = version_paths(version_dir or "")
+    if not version_dir or not os.path.exists(paths["index"]) or not os.path.exists(paths["manifest"]) \
+            or not ChunkStore.exists(version_dir):
+        return empty_state(params)
+    with open(paths["manifest"], encoding="utf8") as f:
+        manifest = json.load(f)
+    if manifest.get("params") != params:
+        print("[build] Model or chunking params changed, doing a full rebuild.")
+        return empty_state(params)
+    index = faiss.read_index(paths["index"])
+    return index, ChunkStore(version_dir), manifest
+
+def save_state(index, store, writer, manifest, version_dir):
+    paths = version_paths(version_dir)
+    faiss.write_index(index, paths["index"])
+    if store is not None:
+        store.close()
+    writer.close()
+    # manifest goes last: it is what marks the build as complete
+    tmp = paths["manifest"] + ".tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, paths["manifest"])
+
+# -------- ANN search index (derived from the flat index) ----------
+def ann_up_to_date(index_type, version_dir):
+    paths = version_paths(version_dir)
+    params = load_params(paths["ann_params"])
+    return params["type"] == index_type and (index_type == "flat" or os.path.exists(paths["ann"]))
+
+def save_ann(index, index_type, version_dir, target_recall=0.95):
+    """Train/tune the ANN index from the vectors already in the flat index (no re-encoding)."""
+    if index_type == "flat":
+        return
+    paths = version_paths(version_dir)
+    flat = faiss.downcast_index(index.index)
+    ids = faiss.vector_to_array(index.id_map)
+    vectors = faiss.rev_swig_ptr(flat.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+    print(f"[build] Building {index_type} index over {index.ntotal} vectors...")
+    ann, params = build_ann_index(index_type, vectors, ids, index, target_recall=target_recall)
+    faiss.write_index(ann, paths["ann"])
+    save_params(params, paths["ann_params"])
+    print(" - ann index:", paths["ann"], {k: v for k, v in params.items() if k in ("nprobe", "efSearch", "recall")})
+
+def live_dense_settings(live_dir):
+    """(index_type, target_recall) of the live version's dense index; ("flat", 0.95) before the first build."""
+    if live_dir is None:
+        return "flat", 0.95
+    meta = load_shards_meta(live_dir)
+    if meta is not None:
+        tuned = [load_params(version_paths(os.path.join(live_dir, SHARDS_DIR, s["name"]))["ann_params"])
+                 for s in meta["shards"] if s["type"] != "flat"]
+        return meta["index_type"], tuned[0].get("target_recall", 0.95) if tuned else 0.95
+    params = load_params(version_paths(live_dir)["ann_params"])
+    return params["type"], params.get("target_recall", 0.95)
+
+def save_dense(index, index_type, version_dir, shards, live_dir, target_recall, report):
+    if shards:
+        report("shards")
+        store = ChunkStore(version_dir)
+        build_shards(index, store, shards, index_type, version_dir, live_dir, target_recall=target_recall)
+        store.close()
+    else:
+        report("ann")
+        save_ann(index, index_type, version_dir, target_recall=target_recall)
+
+# -------- lexical index (BM25 over the chunk store) ----------
+def save_bm25(version_dir):
+    """Rebuild the inverted index from the new chunk store; tokenizing is cheap next to embedding."""
+    store = ChunkStore(version_dir)
+    # merged near-duplicates share their canonical chunk's entry
+    canonical = store.ids[store.canonical == store.ids]
+    print(f"[build] Building BM25 index over {len(canonical)} chunks...")
+    meta = bm25.build_bm25(((int(i), store.get(int(i))["text"]) for i in canonical),
+                           version_paths(version_dir)["bm25"])
+    store.close()
+    print(" - bm25 index:", version_paths(version_dir)["bm25"], meta)
+
+# -------- near-duplicate merging ----------
+def load_dedup(store, exclude_ids, max_distance=MAX_DISTANCE):
+    """NearDupIndex over the canonical chunks of the previous build, minus `exclude_ids`."""
+    dedup = NearDupIndex(max_distance)
+    if store is not None and "simhash" in store.chunks.dtype.names:
+        hashes = store.chunks["simhash"]
+        keep = (store.canonical == store.ids) & (hashes != 0) & ~np.isin(store.ids, list(exclude_ids))
+        for chunk_id, h in zip(store.ids[keep], hashes[keep]):
+            dedup.add(int(chunk_id), int(h))
+    return dedup
+
+def readd_to_dedup(dedup, store, ids):
+    # pages carried over unchanged can be matched again
+    if "simhash" not in store.chunks.dtype.names:
+        return
+    for chunk_id in ids:
+        r = store.row(chunk_id)
+        if r >= 0 and store.canonical[r] == chunk_id:
+            dedup.add(int(chunk_id), int(store.chunks[r]["simhash"]))
+
+# -------- streaming pipeline ----------
+def iter_changed_chunks(changed, manifest, store, writer, stale_ids, chunk_size, overlap, workers=None,
+                        on_page=None, dedup=None, tokenizer=None):
+    """Yield (id, chunk) for new or changed pages of the `changed` (path, sha256) files.
+
+    The manifest entries of those files are rewritten as their pages stream by,
+    every page is written to the new chunk store (copied from `store` when it is
+    unchanged) and ids of replaced or vanished pages are collected into `stale_ids`.
+    `on_page()` is called once per extracted page. With a `dedup` index, chunks that
+    are near-duplicates of an earlier one (or of any unchanged page of the changed
+    files) are stored pointing at it and not yielded.
+    """
+    files = manifest["files"]
+    old_pages = {}
+    updated = []
+    for path, digest in changed:
+        fname = os.path.basename(path)
+        entry = files.get(fname)
+        print(f"[build] {'Updating' if entry else 'Adding'} {fname}")
+        if entry:
+            updated.append(path)
+        old_pages[fname] = dict(entry["pages"]) if entry else {}
+        files[fname] = {"sha256": digest, "pages": {}}
+
+    if dedup is not None and updated:
+        # unchanged pages of the updated files go into `dedup` (with the SimHashes in the chunk
+        # store) before any new text is matched, wherever they sit in the stream. Only page
+        # digests are compared here; the pages are read back from the page cache below.
+        for p in iter_pages(updated, workers=workers):
+            old = old_pages[p["source"]].get(str(p["page"]))
+            if old and old["sha256"] == text_sha256(p["text"]):
+                readd_to_dedup(dedup, store, old["ids"])
+
+    for p in iter_pages([path for path, _ in changed], workers=workers):
+        if on_page is not None:
+            on_page()
+        fname, key = p["source"], str(p["page"])
+        page_digest = text_sha256(p["text"])
+        old = old_pages[fname].pop(key, None)
+        if old and old["sha256"] == page_digest:
+            files[fname]["pages"][key] = old
+            writer.copy_page(store, old["ids"])
+            continue
+        if old:
+            stale_ids.extend(old["ids"])
+        page_chunks = []
+        for chunk in chunk_page(p, chunk_size=chunk_size, overlap=overlap, tokenizer=tokenizer):
+            chunk_id = manifest["next_id"]
+            manifest["next_id"] += 1
+            if dedup is not None:
+                chunk["simhash"] = simhash(chunk["text"])
+                match = dedup.find(chunk["simhash"])
+                chunk["canonical"] = chunk_id if match is None else match
+                if match is None:
+                    dedup.add(chunk_id, chunk["simhash"])
+            page_chunks.append((chunk_id, chunk))
+        writer.add_page(p, page_chunks)
+        files[fname]["pages"][key] = {"sha256": page_digest, "ids": [i for i, _ in page_chunks]}
+        yield from ((i, c) for i, c in page_chunks if c.get("canonical", i) == i)
+
+    # pages that no longer exist in the new version of a file
+    for pages in old_pages.values():
+        for old in pages.values():
+            stale_ids.extend(old["ids"])
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# -------- incremental build ----------
+def build_index(chunk_size=CHUNK_TOKENS, overlap=OVERLAP_TOKENS, folder=BOOKS_DIR, full=False, batch_size=256,
+                workers=None, index_type=None, target_recall=None, backend="torch", index_dir=INDEX_DIR, model=None,
+                progress=None, dedup=True, emb_model=EMB_MODEL, shards=None, emb_cache=None):
+    """Build a new index version from the live one and publish it; returns the live version dir.
+
+    The live version is only read, so it can keep serving queries while this runs.
+    `model` reuses an already loaded `emb_model` embedder; `progress(stage, done, total)` is
+    called as the build advances. With `dedup`, near-duplicate chunks are merged
+    into one embedded copy that keeps every source/page as provenance.
+    With `shards` > 0 the vectors are also split by book into that many shards, each
+    with its own `index_type` index (None keeps the live version's shard count).
+    `index_type` / `target_recall` None keep the live version's (flat for a first build), so a
+    plain rebuild never replaces a tuned ANN index with a flat one. `emb_cache` is used instead
+    of the configured embedding cache; its hits/misses count what this build looked up.
+    """
+    def report(stage, done=0, total=0):
+        if progress is not None:
+            progress(stage, done, total)
+
+    # chunk_size/overlap are in embedder tokens
+    params = {"emb_model": emb_model, "chunk_size": chunk_size, "overlap": overlap, "chunk_unit": "tokens",
+              "dedup_distance": MAX_DISTANCE if dedup else None}
+    live_dir = current_version(index_dir)
+    if shards is None:
+        live_shards = load_shards_meta(live_dir)
+        shards = live_shards["n_shards"] if live_shards else 0
+    live_type, live_recall = live_dense_settings(live_dir)
+    index_type = index_type or live_type
+    target_recall = target_recall if target_recall is not None else live_recall
+    index, store, manifest = empty_state(params) if full else load_state(params, live_dir)
+    files = manifest["files"]
+
+    print("[build] Checking PDFs against manifest...")
+    pdfs = list_pdfs(folder)
+    changed = []
+    for n, path in enumerate(pdfs, start=1):
+        digest = file_sha256(path)
+        entry = files.get(os.path.basename(path))
+        if not entry or entry["sha256"] != digest:
+            changed.append((path, digest))
+        report("checking", n, len(pdfs))
+
+    stale_ids = []
+    present = {os.path.basename(path) for path in pdfs}
+    for fname in sorted(set(files) - present):
+        print(f"[build] Removing {fname}")
+        for old in files.pop(fname)["pages"].values():
+            stale_ids.extend(old["ids"])
+
+    if index is not None and not changed and not stale_ids:
+        bm25_dir = version_paths(live_dir)["bm25"]
+        # a sharded version keeps its ANN indexes per shard
+        dense_ok = shards_up_to_date(shards, index_type, live_dir) and \
+            (shards > 0 or ann_up_to_date(index_type, live_dir))
+        if not dense_ok or not bm25.exists(bm25_dir):
+            # same vectors and chunks, only the search indexes change
+            version_dir = new_version(index_dir)
+            link_files(live_dir, version_dir, [INDEX_FILE, MANIFEST_FILE] +
+                       [os.path.basename(p) for p in store_paths(live_dir).values()])
+            if bm25.exists(bm25_dir):
+                link_files(bm25_dir, os.path.join(version_dir, BM25_DIR), bm25.FILES.values())
+            else:
+                report("bm25")
+                save_bm25(version_dir)
+            save_dense(index, index_type, version_dir, shards, live_dir, target_recall, report)
+            publish_version(version_dir, index_dir)
+            print("[build] Published", version_dir)
+        else:
+            print("[build] Index is up to date, nothing to do.")
+        report("done")
+        return current_version(index_dir)
+
+    version_dir = new_version(index_dir)
+    try:
+        # unchanged books are carried over into the new chunk store as-is
+        writer = ChunkStoreWriter(version_dir)
+        changed_names = {os.path.basename(path) for path, _ in changed}
+        for fname, entry in files.items():
+            if fname not in changed_names:
+                for page in entry["pages"].values():
+                    writer.copy_page(store, page["ids"])
+
+        # old chunks of changed or removed files can't stand in for new ones: they may be going away
+        near_dups = None
+        if dedup:
+            replaced = set(stale_ids)
+            for path, _ in changed:
+                for page in files.get(os.path.basename(path), {}).get("pages", {}).values():
+                    replaced.update(page["ids"])
+            near_dups = load_dedup(store, replaced)
+
+        total_pages = sum(count_pages(path) for path, _ in changed) if progress is not None else 0
+        pages_done = 0
+        def on_page():
+            nonlocal pages_done
+            pages_done += 1
+            report("embedding", pages_done, total_pages)
+
+        # vectors of text seen before (by any project) come from the embedding cache;
+        # the model is only loaded once something actually needs encoding
+        if emb_cache is None:
+            emb_cache = EmbeddingCache.for_model(f"{emb_model}:{backend}")
+        def encode(texts):
+            nonlocal model
+            if model is None:
+                print(f"[build] Encoding new chunks with {emb_model} ({backend}) ...")
+                model = load_embedder(emb_model, backend)
+            return model.encode(texts, convert_to_numpy=True)
+
+        # extraction runs ahead in worker processes while each batch is encoded and added
+        added = 0
+        chunks = iter_changed_chunks(changed, manifest, store, writer, stale_ids, chunk_size, overlap,
+                                     workers=workers, on_page=on_page, dedup=near_dups,
+                                     tokenizer=load_tokenizer(emb_model))
+        for batch in batched(chunks, batch_size):
+            embeddings = encode_cached([c["text"] for _, c in batch], encode, emb_cache)
+
+            # normalize for cosine (IndexFlatIP)
+            faiss.normalize_L2(embeddings)
 
-def build_index(chunk_size=1000, overlap=200):
-    print("[build] Loading and chunking PDFs...")
-    chunks = ingest_folder(chunk_size=chunk_size, overlap=overlap)
-    texts = [c["text"] for c in chunks]
-    if not texts:
-        raise ValueError("No chunks found. Put PDFs into data/books/")
+            if index is None:
+                index = faiss.IndexIDMap2(faiss.IndexFlatIP(embeddings.shape[1]))
+            index.add_with_ids(embeddings, np.array([i for i, _ in batch], dtype="int64"))
+            added += len(batch)
+            print(f"[build] Encoded {added} chunks...")
 
-    print(f"[build] Encoding {len(texts)} chunks with {EMB_MODEL} ...")
-    model = SentenceTransformer(EMB_MODEL)
-    embeddings = model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
+        if stale_ids:
+            # a removed chunk may have stood in for near-duplicates that stay: one of them takes over
+            promoted = writer.promote_duplicates(stale_ids) if store is not None else []
+            if promoted:
+                print(f"[build] Embedding {len(promoted)} near-duplicates whose canonical chunk was removed...")
+                for batch in batched(promoted, batch_size):
+                    embeddings = encode_cached([store.get(i)["text"] for i in batch], encode, emb_cache)
+                    faiss.normalize_L2(embeddings)
+                    index.add_with_ids(embeddings, np.array(batch, dtype="int64"))
+            print(f"[build] Removing {len(stale_ids)} stale chunks...")
+            index.remove_ids(np.array(stale_ids, dtype="int64"))
 
-    # normalize for cosine (IndexFlatIP)
-    faiss.normalize_L2(embeddings)
+        if index is None or index.ntotal == 0:
+            raise ValueError("No chunks found. Put PDFs into data/books/")
 
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    index.add(embeddings.astype("float32"))
+        if emb_cache is not None:
+            emb_cache.flush()
+            print(f"[build] Embedding cache: {emb_cache.stats()}")
 
-    os.makedirs(INDEX_DIR, exist_ok=True)
-    faiss.write_index(index, INDEX_PATH)
-    with open(META_PATH, "wb") as f:
-        pickle.dump(chunks, f)
+        report("saving")
+        save_state(index, store, writer, manifest, version_dir)
+        report("bm25")
+        save_bm25(version_dir)
+        save_dense(index, index_type, version_dir, shards, live_dir, target_recall, report)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
 
-    print("[build] Index & metadata saved.")
-    print(" - index:", INDEX_PATH)
-    print(" - meta:", META_PATH)
+    publish_version(version_dir, index_dir)
+    report("done")
+    paths = version_paths(version_dir)
+    print(f"[build] Index & chunk store saved ({index.ntotal} chunks embedded, {added} new, "
+          f"{len(writer.chunk_cols['id']) - index.ntotal} near-duplicates merged).")
+    print(" - version:", version_dir)
+    print(" - index:", paths["index"])
+    print(" - manifest:", paths["manifest"])
+    return version_dir
 
 if __name__ == "__main__":
-    build_index()
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or update the FAISS index from data/books/")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and rebuild everything")
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS, help="max embedder tokens per chunk")
+    parser.add_argument("--overlap-tokens", type=int, default=OVERLAP_TOKENS, help="tokens shared by neighbouring chunks")
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks per encoder batch")
+    parser.add_argument("--workers", type=int, default=None, help="PDF extraction processes (default: all cores)")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=None,
+                        help="search index to build (default: as the live version, flat for a first build)")
+    parser.add_argument("--target-recall", type=float, default=None,
+                        help="recall@10 the ANN index is tuned for (default: as the live version, else 0.95)")
+    parser.add_argument("--backend", choices=BACKENDS, default="torch", help="embedder inference backend")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="split the vectors by book into N shards (0: one index; default: as the live version)")
+    args = parser.parse_args()
+    build_index(chunk_size=args.chunk_tokens, overlap=args.overlap_tokens, full=args.full, batch_size=args.batch_size,
+                workers=args.workers, index_type=args.index_type, target_recall=args.target_recall,
+                backend=args.backend, shards=args.shards)
@@ -0,0 +1,117 @@
+# src/cache.py
+# Bounded caches for query_engine: query embeddings, retrieval results and final answers.
+# Each level is an in-memory LRU with optional TTL; an optional SQLite file adds a disk
+# tier that survives app restarts. Keys that depend on the index carry its version, so a
+# rebuild makes old entries unreachable (they then age out by TTL).
+import os
+import time
+import pickle
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+import metrics
+
+LEVELS = ("embedding", "retrieval", "answer")
+
+def make_key(*parts):
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()   # key -> (stored_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return (found, value)."""
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return False, None
+            stored_at, value = item
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self.data[key]
+                return False, None
+            self.data.move_to_end(key)
+            return True, value
+
+    def put(self, key, value, stored_at=None):
+        with self.lock:
+            self.data[key] = (stored_at or time.time(), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+class DiskCache:
+    def __init__(self, path, ttl=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, stored_at REAL, value BLOB)")
+        if ttl is not None:
+            self.db.execute("DELETE FROM cache WHERE stored_at < ?", (time.time() - ttl,))
+        self.db.commit()
+
+    def get(self, key):
+        """Return (found, stored_at, value)."""
+        with self.lock:
+            row = self.db.execute("SELECT stored_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[0] > self.ttl):
+            return False, None, None
+        return True, row[0], pickle.loads(row[1])
+
+    def put(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, time.time(), blob))
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+class QueryCache:
+    def __init__(self, maxsize=1024, ttl=24 * 3600, disk_path=None):
+        self.memory = {level: LRUCache(maxsize=maxsize, ttl=ttl) for level in LEVELS}
+        self.disk = DiskCache(disk_path, ttl=ttl) if disk_path else None
+        self.counts = {level: {"hits": 0, "disk_hits": 0, "misses": 0} for level in LEVELS}
+
+    def get(self, level, key):
+        """Return (found, value), looking in memory first and then on disk."""
+        found, value = self.memory[level].get(key)
+        if found:
+            self.counts[level]["hits"] += 1
+            metrics.count("cache_lookups", level=level, result="hit")
+            return True, value
+        if self.disk is not None:
+            found, stored_at, value = self.disk.get(f"{level}:{key}")
+            if found:
+                self.memory[level].put(key, value, stored_at=stored_at)
+                self.counts[level]["disk_hits"] += 1
+                metrics.count("cache_lookups", level=level, result="disk_hit")
+                return True, value
+        self.counts[level]["misses"] += 1
+        metrics.count("cache_lookups", level=level, result="miss")
+        return False, None
+
+    def put(self, level, key, value):
+        self.memory[level].put(key, value)
+        if self.disk is not None:
+            self.disk.put(f"{level}:{key}", value)
+
+    def stats(self):
+        stats = {}
+        for level in LEVELS:
+            c = self.counts[level]
+            lookups = c["hits"] + c["disk_hits"] + c["misses"]
+            stats[level] = dict(c, size=len(self.memory[level]),
+                                hit_rate=(c["hits"] + c["disk_hits"]) / lookups if lookups else 0.0)
+        if self.disk is not None:
+            stats["disk_entries"] = len(self.disk)
+        return stats
@@ -0,0 +1,235 @@
+# src/chunk_store.py
+# Compact on-disk chunk metadata. Page text is stored once in pages.bin; chunks are
+# (page_row, byte offset, byte length) ranges into it and sources are interned in
+# sources.json. Everything is memory-mapped, so only the chunks that are actually
+# looked up get decoded. ranges.npy maps each source to the runs of chunk ids it owns,
+# which is what filtered search uses to restrict FAISS to one book.
+# Near-duplicate chunks (see dedup.py) keep their own row for provenance but point at
+# the canonical chunk whose vector stands for all of them.
+import os
+import json
+from array import array
+import numpy as np
+
+PAGE_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("source", "<u4"), ("page", "<u4")])
+CHUNK_DTYPE = np.dtype([("id", "<i8"), ("page_row", "<u4"), ("start", "<u4"), ("length", "<u4"), ("n", "<u4"),
+                        ("canonical", "<i8"), ("simhash", "<u8")])
+RANGE_DTYPE = np.dtype([("source", "<u4"), ("lo", "<i8"), ("hi", "<i8")])
+
+def store_paths(store_dir):
+    return {
+        "text": os.path.join(store_dir, "pages.bin"),
+        "pages": os.path.join(store_dir, "pages.npy"),
+        "chunks": os.path.join(store_dir, "chunks.npy"),
+        "sources": os.path.join(store_dir, "sources.json"),
+        "ranges": os.path.join(store_dir, "ranges.npy"),
+    }
+
+# -------- reader ----------
+class ChunkStore:
+    def __init__(self, store_dir):
+        paths = store_paths(store_dir)
+        with open(paths["sources"], encoding="utf8") as f:
+            self.sources = json.load(f)
+        self.pages = np.load(paths["pages"], mmap_mode="r")
+        self.chunks = np.load(paths["chunks"], mmap_mode="r")
+        self.ranges = np.load(paths["ranges"])
+        if os.path.getsize(paths["text"]):
+            self.text = np.memmap(paths["text"], dtype=np.uint8, mode="r")
+        else:
+            self.text = np.zeros(0, dtype=np.uint8)
+        # chunks are sorted by id, so lookups are a binary search over this column
+        self.ids = self.chunks["id"]
+        # stores written before near-duplicate merging: every chunk is its own canonical
+        self.canonical = np.asarray(self.chunks["canonical"]) if "canonical" in self.chunks.dtype.names else self.ids
+        dup_rows = np.flatnonzero(self.canonical != self.ids)
+        order = np.argsort(self.canonical[dup_rows], kind="stable")
+        self.dup_canonical = self.canonical[dup_rows][order]
+        self.dup_ids = np.asarray(self.ids[dup_rows][order])
+
+    @staticmethod
+    def exists(store_dir):
+        return all(os.path.exists(p) for p in store_paths(store_dir).values())
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __contains__(self, chunk_id):
+        return self.row(chunk_id) >= 0
+
+    def row(self, chunk_id):
+        r = int(np.searchsorted(self.ids, chunk_id))
+        if r < len(self.ids) and self.ids[r] == chunk_id:
+            return r
+        return -1
+
+    def page_bytes(self, page_row):
+        p = self.pages[page_row]
+        start = int(p["offset"])
+        return bytes(self.text[start:start + int(p["length"])])
+
+    def source_of(self, chunk_id):
+        c = self.chunks[self.row(chunk_id)]
+        return self.sources[int(self.pages[c["page_row"]]["source"])]
+
+    def id_ranges(self, book_filter):
+        """[lo, hi) chunk-id runs of every source whose name starts with `book_filter`.
+
+        Chunks of the book that were merged into another book's copy are represented by
+        that canonical id, added as a one-id run.
+        """
+        prefix = book_filter.lower()
+        matched = [i for i, s in enumerate(self.sources) if s.lower().startswith(prefix)]
+        rows = self.ranges[np.isin(self.ranges["source"], matched)]
+        ranges = [(int(lo), int(hi)) for lo, hi in zip(rows["lo"], rows["hi"])]
+        if len(self.dup_ids):
+            extra = set()
+            for lo, hi in ranges:
+                r0, r1 = np.searchsorted(self.ids, [lo, hi])
+                merged = self.canonical[r0:r1] != self.ids[r0:r1]
+                extra.update(int(c) for c in self.canonical[r0:r1][merged])
+            ranges += [(c, c + 1) for c in sorted(extra)]
+        return ranges
+
+    def group(self, chunk_id):
+        """Ids of every copy of a chunk's text: the canonical chunk first, then its merged near-duplicates."""
+        c = int(self.canonical[self.row(chunk_id)])
+        lo, hi = np.searchsorted(self.dup_canonical, [c, c + 1])
+        return [c] + [int(i) for i in self.dup_ids[lo:hi]]
+
+    def citation(self, chunk_id):
+        c = self.chunks[self.row(chunk_id)]
+        p = self.pages[c["page_row"]]
+        source, page = self.sources[int(p["source"])], int(p["page"])
+        return {"source": source, "page": page, "chunk_id": f"{source}_p{page}_c{int(c['n'])}"}
+
+    def get(self, chunk_id):
+        r = self.row(chunk_id)
+        if r < 0:
+            raise KeyError(chunk_id)
+        c = self.chunks[r]
+        p = self.pages[c["page_row"]]
+        start = int(p["offset"]) + int(c["start"])
+        text = bytes(self.text[start:start + int(c["length"])]).decode("utf-8", errors="ignore")
+        source = self.sources[int(p["source"])]
+        page = int(p["page"])
+        return {
+            "id": int(chunk_id),
+            "text": text,
+            "source": source,
+            "page": page,
+            "chunk_id": f"{source}_p{page}_c{int(c['n'])}",
+            "n": int(c["n"]),
+            "start": int(c["start"]),    # byte range within the page text
+            "length": int(c["length"]),
+            # the other places this text appears (near-duplicates merged at build time)
+            "also_in": [self.citation(i) for i in self.group(chunk_id) if i != chunk_id] if len(self.dup_ids) else [],
+        }
+
+    def close(self):
+        # drop the maps so the files can be replaced (needed on Windows)
+        self.pages = self.chunks = self.ids = self.text = self.ranges = None
+        self.canonical = self.dup_canonical = self.dup_ids = None
+
+# -------- writer ----------
+class ChunkStoreWriter:
+    def __init__(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        self.paths = store_paths(store_dir)
+        self.text = open(self.paths["text"] + ".tmp", "wb")
+        self.offset = 0
+        self.sources = []
+        self.source_ids = {}
+        self.page_cols = {name: array("Q") for name in PAGE_DTYPE.names}
+        self.chunk_cols = {name: array("Q" if name == "simhash" else "q") for name in CHUNK_DTYPE.names}
+
+    def _source_id(self, source):
+        if source not in self.source_ids:
+            self.source_ids[source] = len(self.sources)
+            self.sources.append(source)
+        return self.source_ids[source]
+
+    def _add_page(self, source, page, data):
+        row = len(self.page_cols["offset"])
+        self.text.write(data)
+        for name, value in zip(PAGE_DTYPE.names, (self.offset, len(data), self._source_id(source), page)):
+            self.page_cols[name].append(value)
+        self.offset += len(data)
+        return row
+
+    def _add_chunk(self, chunk_id, page_row, start, length, n, canonical, simhash):
+        for name, value in zip(CHUNK_DTYPE.names, (chunk_id, page_row, start, length, n, canonical, simhash)):
+            self.chunk_cols[name].append(int(value))
+
+    def add_page(self, page, chunks):
+        """Store a page's text once plus the (id, chunk) pairs cut from it.
+
+        A chunk may carry "canonical" (id of the near-duplicate that represents it) and "simhash".
+        """
+        if not chunks:
+            return
+        text = page["text"]
+        row = self._add_page(page["source"], page["page"], text.encode("utf-8"))
+        for chunk_id, c in chunks:
+            start = len(text[:c["start"]].encode("utf-8"))
+            length = len(c["text"].encode("utf-8"))
+            self._add_chunk(chunk_id, row, start, length, c["n"], c.get("canonical", chunk_id), c.get("simhash", 0))
+
+    def copy_page(self, store, ids):
+        """Carry an unchanged page (identified by its chunk ids) over from a previous store."""
+        rows = [r for r in (store.row(i) for i in ids) if r >= 0]
+        if not rows:
+            return
+        old_page_row = int(store.chunks[rows[0]]["page_row"])
+        old_page = store.pages[old_page_row]
+        row = self._add_page(store.sources[int(old_page["source"])], int(old_page["page"]),
+                             store.page_bytes(old_page_row))
+        has_dedup = "simhash" in store.chunks.dtype.names
+        for r in rows:
+            c = store.chunks[r]
+            self._add_chunk(c["id"], row, c["start"], c["length"], c["n"], store.canonical[r],
+                            c["simhash"] if has_dedup else 0)
+
+    def promote_duplicates(self, removed_ids):
+        """Re-point near-duplicates whose canonical chunk was removed at one surviving copy.
+
+        Returns the ids of the promoted chunks; they need an embedding of their own.
+        """
+        removed = set(int(i) for i in removed_ids)
+        canonical = self.chunk_cols["canonical"]
+        promoted = {}
+        for row, (chunk_id, c) in enumerate(zip(self.chunk_cols["id"], canonical)):
+            if c in removed and chunk_id not in removed:
+                canonical[row] = promoted.setdefault(c, chunk_id)   # the first surviving copy takes over
+        return list(promoted.values())
+
+    def _save(self, path, arr):
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, arr)
+
+    def close(self):
+        self.text.close()
+        pages = np.empty(len(self.page_cols["offset"]), dtype=PAGE_DTYPE)
+        for name in PAGE_DTYPE.names:
+            pages[name] = self.page_cols[name]
+        chunks = np.empty(len(self.chunk_cols["id"]), dtype=CHUNK_DTYPE)
+        for name in CHUNK_DTYPE.names:
+            chunks[name] = self.chunk_cols[name]
+        chunks = chunks[np.argsort(chunks["id"], kind="stable")]
+
+        # runs of consecutive ids (in id order) that belong to the same source
+        owner = pages["source"][chunks["page_row"]]
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(owner)) + 1]) if len(owner) else np.zeros(0, dtype=int)
+        ends = np.append(starts[1:], len(owner))
+        ranges = np.empty(len(starts), dtype=RANGE_DTYPE)
+        ranges["source"] = owner[starts]
+        ranges["lo"] = chunks["id"][starts]
+        ranges["hi"] = chunks["id"][ends - 1] + 1
+
+        self._save(self.paths["pages"], pages)
+        self._save(self.paths["chunks"], chunks)
+        self._save(self.paths["ranges"], ranges)
+        with open(self.paths["sources"] + ".tmp", "w", encoding="utf8") as f:
+            json.dump(self.sources, f)
+        for path in self.paths.values():
+            os.replace(path + ".tmp", path)
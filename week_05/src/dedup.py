@@ -0,0 +1,86 @@
+# src/dedup.py
+# Near-duplicate chunk detection with 64-bit SimHash over word 3-shingles.
+# Two chunks count as near-duplicates when their hashes differ in at most MAX_DISTANCE
+# bits. The hash is split into BANDS bands of 16 bits; with MAX_DISTANCE < BANDS any such
+# pair agrees exactly on at least one band, so candidates come from BANDS dict lookups.
+# Used by build_index to merge repeated headers/footers, boilerplate pages and chapters
+# shared between editions before they are embedded.
+import re
+import hashlib
+import numpy as np
+
+MAX_DISTANCE = 3
+BANDS = 4
+BAND_BITS = 64 // BANDS
+SHINGLE = 3
+MIN_WORDS = 8       # shorter chunks (page numbers, captions) are never merged
+WORD_RE = re.compile(r"\w+")
+
+def simhash(text, shingle=SHINGLE):
+    """64-bit SimHash of the text's word shingles; 0 if the text is too short to compare."""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < MIN_WORDS:
+        return 0
+    grams = (" ".join(words[i:i + shingle]) for i in range(len(words) - shingle + 1))
+    digests = b"".join(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest() for g in grams)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(-1, 64)
+    votes = bits.sum(axis=0) * 2 > len(bits)
+    return int.from_bytes(np.packbits(votes).tobytes(), "big") or 1
+
+class NearDupIndex:
+    def __init__(self, max_distance=MAX_DISTANCE):
+        if max_distance >= BANDS:
+            raise ValueError(f"max_distance must be below {BANDS} for banded lookup")
+        self.max_distance = max_distance
+        self.bands = [{} for _ in range(BANDS)]   # band value -> chunk ids
+        self.hashes = {}
+
+    def _band_keys(self, h):
+        mask = (1 << BAND_BITS) - 1
+        return [(h >> (BAND_BITS * b)) & mask for b in range(BANDS)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, chunk_id, h):
+        if not h:
+            return
+        self.hashes[chunk_id] = h
+        for band, key in zip(self.bands, self._band_keys(h)):
+            band.setdefault(key, []).append(chunk_id)
+
+    def remove(self, chunk_id):
+        h = self.hashes.pop(chunk_id, None)
+        if h is None:
+            return
+        for band, key in zip(self.bands, self._band_keys(h)):
+            band[key].remove(chunk_id)
+
+    def find(self, h):
+        """Id of an indexed chunk within max_distance bits of `h`, or None."""
+        if not h:
+            return None
+        for band, key in zip(self.bands, self._band_keys(h)):
+            for chunk_id in band.get(key, ()):
+                if bin(h ^ self.hashes[chunk_id]).count("1") <= self.max_distance:
+                    return chunk_id
+        return None
+
+def dedup_chunks(chunks, max_distance=MAX_DISTANCE):
+    """Yield only the first copy of near-duplicate chunks.
+
+    Each yielded chunk gets an "also_in" list with the source/page of the copies merged
+    into it; the lists are complete once the generator is exhausted.
+    """
+    index = NearDupIndex(max_distance)
+    kept = {}
+    for n, c in enumerate(chunks):
+        h = simhash(c["text"])
+        match = index.find(h)
+        if match is not None:
+            kept[match]["also_in"].append({"source": c["source"], "page": c["page"], "chunk_id": c["chunk_id"]})
+            continue
+        index.add(n, h)
+        kept[n] = c
+        c["also_in"] = []
+        yield c
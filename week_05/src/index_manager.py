@@ -0,0 +1,70 @@
+# src/index_manager.py
+# Keeps the app answering from the live index while build_index runs in a background
+# thread. The build writes a new index version next to the live one; once it is
+# published, the manager's resources are replaced by a new dict (same models, new
+# index + chunk store + version) in a single assignment, so every query sees one
+# consistent set and queries already running finish on the old version.
+import time
+import threading
+import traceback
+from build_index import build_index
+from query_engine import init, reload_index, EMB_BACKEND
+
+class RebuildJob:
+    def __init__(self):
+        self.stage = "starting"
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def report(self, stage, done=0, total=0):
+        self.stage, self.done, self.total = stage, done, total
+
+    @property
+    def running(self):
+        return self.finished_at is None
+
+    def status(self):
+        end = self.finished_at or time.time()
+        return {
+            "stage": self.stage,
+            "done": self.done,
+            "total": self.total,
+            "fraction": self.done / self.total if self.total else 0.0,
+            "running": self.running,
+            "error": self.error,
+            "seconds": round(end - self.started_at, 1),
+        }
+
+class IndexManager:
+    def __init__(self, **init_kwargs):
+        self.resources = init(**init_kwargs)
+        self.lock = threading.Lock()
+        self.job = None
+
+    def start_rebuild(self, **build_kwargs):
+        """Start build_index in the background; returns False if a rebuild is already running."""
+        with self.lock:
+            if self.job is not None and self.job.running:
+                return False
+            self.job = RebuildJob()
+            threading.Thread(target=self._run, args=(self.job, build_kwargs), daemon=True).start()
+        return True
+
+    def _run(self, job, build_kwargs):
+        try:
+            # reuse the query embedder instead of loading a second copy of the model
+            build_kwargs.setdefault("backend", EMB_BACKEND)
+            if build_kwargs["backend"] == EMB_BACKEND:
+                build_kwargs.setdefault("model", self.resources["embedder"])
+            build_index(progress=job.report, **build_kwargs)
+            job.report("loading")
+            self.resources = reload_index(self.resources)
+            job.report("done")
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        finally:
+            job.finished_at = time.time()
@@ -0,0 +1,75 @@
+# src/index_versions.py
+# Every build writes a complete index (FAISS + chunk store + manifest) into its own
+# directory indexes/v<timestamp>-<id>/ and then publishes it by atomically replacing
+# indexes/CURRENT, a one-line file naming the live version. Readers never see a
+# half-written index, and the previous version stays on disk for queries still using it.
+import os
+import time
+import uuid
+import shutil
+
+INDEX_DIR = "indexes"
+CURRENT_FILE = "CURRENT"
+KEEP_VERSIONS = 2   # the live version plus the one it replaced
+
+INDEX_FILE = "faiss.index"        # ID-mapped flat index (source of truth for the vectors)
+MANIFEST_FILE = "manifest.json"
+ANN_FILE = "ann.index"            # optional IVF/HNSW/IVF-PQ index built with --index-type
+ANN_PARAMS_FILE = "ann.json"
+BM25_DIR = "bm25"                 # lexical inverted index over the same chunk ids
+
+def version_paths(version_dir):
+    return {
+        "index": os.path.join(version_dir, INDEX_FILE),
+        "manifest": os.path.join(version_dir, MANIFEST_FILE),
+        "ann": os.path.join(version_dir, ANN_FILE),
+        "ann_params": os.path.join(version_dir, ANN_PARAMS_FILE),
+        "bm25": os.path.join(version_dir, BM25_DIR),
+    }
+
+def version_name(version_dir):
+    return os.path.basename(os.path.normpath(version_dir))
+
+def current_version(index_dir=INDEX_DIR):
+    """Directory of the live index version, or None before the first build."""
+    path = os.path.join(index_dir, CURRENT_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf8") as f:
+            return os.path.join(index_dir, f.read().strip())
+    if os.path.exists(os.path.join(index_dir, INDEX_FILE)):
+        return index_dir   # layout from before versioned builds
+    return None
+
+def new_version(index_dir=INDEX_DIR):
+    version_dir = os.path.join(index_dir, time.strftime("v%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6])
+    os.makedirs(version_dir)
+    return version_dir
+
+def link_files(src_dir, dst_dir, names):
+    """Carry unchanged files into a new version (hard links where possible, they are never rewritten in place)."""
+    os.makedirs(dst_dir, exist_ok=True)
+    for name in names:
+        src, dst = os.path.join(src_dir, name), os.path.join(dst_dir, name)
+        if not os.path.exists(src):
+            continue
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+def publish_version(version_dir, index_dir=INDEX_DIR, keep=KEEP_VERSIONS):
+    """Make `version_dir` the live version in one atomic rename, then drop old versions."""
+    path = os.path.join(index_dir, CURRENT_FILE)
+    with open(path + ".tmp", "w", encoding="utf8") as f:
+        f.write(version_name(version_dir))
+    os.replace(path + ".tmp", path)
+    prune_versions(index_dir, keep=keep)
+
+def prune_versions(index_dir=INDEX_DIR, keep=KEEP_VERSIONS):
+    live = version_name(current_version(index_dir) or "")
+    versions = sorted(d for d in os.listdir(index_dir)
+                      if d.startswith("v") and os.path.isdir(os.path.join(index_dir, d)))
+    for name in versions[:-keep]:
+        if name != live:
+            # files still mapped by a running reader can't be removed on Windows; retried next build
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
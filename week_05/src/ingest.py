@@ -1,47 +1,78 @@
 # src/ingest.py
 import os
-from PyPDF2 import PdfReader
+import sys
+from pathlib import Path
+from dedup import dedup_chunks
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # repo root, for rag_common
+from rag_common import chunking, pdf_extract
+
+# chunks are sized in the embedder's tokens so none gets truncated when it is encoded
+EMB_TOKENIZER = "all-MiniLM-L6-v2"
+CHUNK_TOKENS = 250
+OVERLAP_TOKENS = 50
+PDF_BACKEND = "pypdf2"
 
 def extract_pages_from_pdf(path):
-    reader = PdfReader(path)
-    pages = []
-    for i, page in enumerate(reader.pages, start=1):
-        text = page.extract_text() or ""
-        pages.append({"text": text.strip(), "source": os.path.basename(path), "page": i})
-    return pages
-
-def chunk_text(text, chunk_size=1000, overlap=200):
+    source = os.path.basename(path)
+    return [{"text": text.strip(), "source": source, "page": i}
+            for i, text in enumerate(pdf_extract.extract_pages(path, backend=PDF_BACKEND), start=1)]
+
+# -------- parallel page extraction ----------
+def count_pages(path):
+    return pdf_extract.count_pages(path, backend=PDF_BACKEND)
+
+def iter_pages(paths, workers=None, pages_per_task=16, max_pending=None):
+    """Yield pages of `paths` in order while a process pool extracts the ones ahead.
+
+    Extraction and the on-disk page cache are rag_common.pdf_extract's; at most
+    `max_pending` page ranges are in flight, so memory stays bounded no matter
+    how large the corpus is.
+    """
+    for path, page, text in pdf_extract.iter_pages(paths, backend=PDF_BACKEND, workers=workers,
+                                                    pages_per_task=pages_per_task, max_pending=max_pending):
+        yield {"text": text.strip(), "source": os.path.basename(path), "page": page}
+
+def chunk_spans(text, chunk_size=CHUNK_TOKENS, overlap=OVERLAP_TOKENS, tokenizer=None):
+    # (start, end) character ranges of sentence-aligned chunks of at most chunk_size tokens
+    tokenizer = tokenizer or chunking.load_tokenizer(EMB_TOKENIZER)
+    return list(chunking.chunk_spans(text, tokenizer, max_tokens=chunk_size, overlap_tokens=overlap))
+
+def chunk_text(text, chunk_size=CHUNK_TOKENS, overlap=OVERLAP_TOKENS, tokenizer=None):
+    return [text[s:e] for s, e in chunk_spans(text, chunk_size=chunk_size, overlap=overlap, tokenizer=tokenizer)]
+
+def chunk_page(page, chunk_size=CHUNK_TOKENS, overlap=OVERLAP_TOKENS, tokenizer=None):
     chunks = []
-    start = 0
-    L = len(text)
-    if L == 0:
-        return []
-    while start < L:
-        end = min(start + chunk_size, L)
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-        start += chunk_size - overlap
+    text = page["text"]
+    spans = chunk_spans(text, chunk_size=chunk_size, overlap=overlap, tokenizer=tokenizer)
+    for n, (s, e) in enumerate(spans, start=1):
+        chunks.append({
+            "text": text[s:e],
+            "source": page["source"],
+            "page": page["page"],
+            "chunk_id": f"{page['source']}_p{page['page']}_c{n}",
+            "n": n,
+            "start": s,
+            "end": e,
+        })
     return chunks
 
-def ingest_folder(folder="data/books", chunk_size=1000, overlap=200):
-    all_chunks = []
-    for fname in sorted(os.listdir(folder)):
-        if not fname.lower().endswith(".pdf"):
-            continue
-        path = os.path.join(folder, fname)
-        print(f"[ingest] Reading {path}")
-        pages = extract_pages_from_pdf(path)
-        for p in pages:
-            subchunks = chunk_text(p["text"], chunk_size=chunk_size, overlap=overlap)
-            for n, sc in enumerate(subchunks, start=1):
-                all_chunks.append({
-                    "text": sc,
-                    "source": p["source"],
-                    "page": p["page"],
-                    "chunk_id": f"{p['source']}_p{p['page']}_c{n}"
-                })
-    print(f"[ingest] Ingested {len(all_chunks)} chunks from PDFs in {folder}")
+def list_pdfs(folder="data/books"):
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith(".pdf")]
+
+def iter_chunks(paths, chunk_size=CHUNK_TOKENS, overlap=OVERLAP_TOKENS, workers=None, dedup=False, tokenizer=None):
+    chunks = (c for p in iter_pages(paths, workers=workers)
+              for c in chunk_page(p, chunk_size=chunk_size, overlap=overlap, tokenizer=tokenizer))
+    if dedup:
+        # near-duplicates are dropped; their source/page is kept in the first copy's "also_in"
+        chunks = dedup_chunks(chunks)
+    yield from chunks
+
+def ingest_folder(folder="data/books", chunk_size=CHUNK_TOKENS, overlap=OVERLAP_TOKENS, workers=None, dedup=True):
+    all_chunks = list(iter_chunks(list_pdfs(folder), chunk_size=chunk_size, overlap=overlap, workers=workers,
+                                  dedup=dedup))
+    merged = sum(len(c.get("also_in", [])) for c in all_chunks)
+    print(f"[ingest] Ingested {len(all_chunks)} chunks from PDFs in {folder} ({merged} near-duplicates merged)")
     return all_chunks
 
 if __name__ == "__main__":
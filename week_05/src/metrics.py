@@ -0,0 +1,226 @@
+# src/metrics.py
+# Per-stage timing spans, token counts and cache hits for query_engine.
+# A trace covers one top-level call (answer_queries, retrieve_batch, ...); the stages
+# inside it open spans and add counts. Finished traces are
+#   - written as one JSON line each (RAG_METRICS_LOG: a file path, "-" for stderr, "off"), and
+#   - aggregated into counters/histograms served in Prometheus text format (server.py /metrics).
+# Tracing is off unless RAG_METRICS=1 or enable() is called; a single trace can also be
+# forced (the app's debug expander). When nothing is being traced, span() and count()
+# cost one context-variable lookup.
+import os
+import sys
+import json
+import time
+import threading
+from contextvars import ContextVar
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)   # seconds
+PREFIX = "rag_"
+
+_enabled = os.getenv("RAG_METRICS", "0").lower() in ("1", "true", "yes", "on")
+_log_path = os.getenv("RAG_METRICS_LOG", "-")
+_current = ContextVar("rag_trace", default=None)
+
+class _Noop:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+NOOP = _Noop()
+
+def enable(log_path=None):
+    global _enabled, _log_path
+    _enabled = True
+    if log_path is not None:
+        _log_path = log_path
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled():
+    return _enabled
+
+def active():
+    """True while a trace is being recorded in this context."""
+    return _current.get() is not None
+
+# -------- traces and spans ----------
+class Span:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.depth = self.trace.depth
+        self.trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.trace.depth -= 1
+        self.trace.spans.append((self.name, self.depth, self.start - self.trace.start, end - self.start))
+        return False
+
+class Trace:
+    def __init__(self, op, fields):
+        self.op = op
+        self.fields = fields
+        self.spans = []     # (name, depth, start offset, seconds), in completion order
+        self.counts = {}    # (name, labels) -> value
+        self.depth = 0
+        self.error = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.start
+        _current.reset(self.token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        REGISTRY.observe_trace(self)
+        if _enabled:
+            write_log(self.as_dict())
+        return False
+
+    def span(self, name):
+        return Span(self, name)
+
+    def stages(self):
+        """Seconds per stage name, summed over repeated spans (e.g. one per generation batch)."""
+        totals = {}
+        for name, _, _, seconds in self.spans:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def as_dict(self):
+        return {
+            "ts": round(time.time(), 3),
+            "op": self.op,
+            **self.fields,
+            "seconds": round(self.seconds, 6),
+            "error": self.error,
+            "stages": {name: round(s, 6) for name, s in self.stages().items()},
+            "spans": [{"name": name, "depth": depth, "start_ms": round(start * 1000, 3), "ms": round(s * 1000, 3)}
+                      for name, depth, start, s in sorted(self.spans, key=lambda sp: sp[2])],
+            "counts": {format_key(name, labels): value for (name, labels), value in self.counts.items()},
+        }
+
+def trace(op, force=False, **fields):
+    """Context manager recording one traced operation; yields the Trace (None when not traced).
+
+    Inside an active trace it is just a span of that trace, so nested public calls
+    (answer_queries -> retrieve_batch) end up in one trace.
+    """
+    parent = _current.get()
+    if parent is not None:
+        return parent.span(op)
+    if not (_enabled or force):
+        return NOOP
+    return Trace(op, fields)
+
+def span(name):
+    t = _current.get()
+    return NOOP if t is None else t.span(name)
+
+def count(name, value=1, **labels):
+    t = _current.get()
+    if t is not None:
+        key = (name, tuple(sorted(labels.items())))
+        t.counts[key] = t.counts.get(key, 0) + value
+
+def format_key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+# -------- export ----------
+_log_lock = threading.Lock()
+
+def write_log(record):
+    if _log_path.lower() in ("", "off", "none"):
+        return
+    line = json.dumps(record, ensure_ascii=False)
+    with _log_lock:
+        if _log_path == "-":
+            print(line, file=sys.stderr, flush=True)
+        else:
+            with open(_log_path, "a", encoding="utf8") as f:
+                f.write(line + "\n")
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}     # (name, labels) -> value
+        self.histograms = {}   # (name, labels) -> Histogram
+        self.gauges = {}
+
+    def inc(self, name, value=1, labels=()):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, value, labels=()):
+        self.histograms.setdefault((name, labels), Histogram()).observe(value)
+
+    def observe_trace(self, t):
+        with self.lock:
+            op = (("op", t.op),)
+            self.inc("requests", labels=op)
+            if t.error:
+                self.inc("errors", labels=op)
+            self.observe("request_seconds", t.seconds, op)
+            for stage, seconds in t.stages().items():
+                self.observe("stage_seconds", seconds, (("stage", stage),))
+            for (name, labels), value in t.counts.items():
+                self.inc(name, value, labels)
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({n for n, _ in series}):
+                    full = PREFIX + name + ("_total" if kind == "counter" else "")
+                    lines.append(f"# TYPE {full} {kind}")
+                    for (n, labels), value in sorted(series.items()):
+                        if n == name:
+                            lines.append(f"{format_key(full, labels)} {value}")
+            for name in sorted({n for n, _ in self.histograms}):
+                full = PREFIX + name
+                lines.append(f"# TYPE {full} histogram")
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, c in zip(BUCKETS, h.buckets):
+                        lines.append(f"{format_key(full + '_bucket', labels + (('le', bound),))} {c}")
+                    lines.append(f"{format_key(full + '_bucket', labels + (('le', '+Inf'),))} {h.count}")
+                    lines.append(f"{format_key(full + '_sum', labels)} {h.sum:.6f}")
+                    lines.append(f"{format_key(full + '_count', labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def render_prometheus():
+    return REGISTRY.render()
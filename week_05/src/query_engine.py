@@ -1,17 +1,41 @@
 # src/query_engine.py
 import os
-import pickle
 import re
+import sys
+from pathlib import Path
+from threading import Thread
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from transformers import TextIteratorStreamer
+from backends import load_embedder, load_generator
+from chunk_store import ChunkStore
+from index_versions import INDEX_DIR, version_paths, version_name, current_version
+from cache import QueryCache, make_key
+from shards import ShardedIndex, ExactView, load_meta as load_shards_meta, parse_shard_list
+import metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # repo root, for rag_common
+from rag_common.ann_index import load_params, apply_search_params
+from rag_common.bm25 import BM25Index, rrf_fuse
+from rag_common import bm25
 
 # Paths and models (change GEN_MODEL if you have stronger hardware)
-INDEX_PATH = "indexes/faiss.index"
-META_PATH = "indexes/meta.pkl"
+# the live index version is indexes/<CURRENT>/ (see index_versions.py)
+# memory-map the flat index's vectors where this faiss build supports it; it only serves
+# filtered queries when an ANN index is in use
+FLAT_IO_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+CACHE_DB = "indexes/query_cache.sqlite"   # disk tier of the query cache (opt-in)
 EMB_MODEL = "all-MiniLM-L6-v2"
 GEN_MODEL = "google/flan-t5-small"   # safe small model for CPU
+# inference backends: "torch" (fp32), "int8" (dynamic quantization) or "onnx" (ONNX Runtime)
+EMB_BACKEND = os.getenv("EMB_BACKEND", "torch")
+GEN_BACKEND = os.getenv("GEN_BACKEND", "torch")
+# "dense" (FAISS), "lexical" (BM25) or "hybrid" (both, fused by reciprocal rank)
+RETRIEVAL_MODES = ("dense", "lexical", "hybrid")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+HYBRID_DEPTH = 4   # in hybrid mode each ranking contributes k * HYBRID_DEPTH candidates
+# with a sharded index: the shard numbers this process serves, e.g. "0,2" (default: all)
+SERVE_SHARDS = parse_shard_list(os.getenv("SERVE_SHARDS"))
 
 CALC_PATTERN = re.compile(r"\[\[CALC:(.+?)\]\]")
 
@@ -36,70 +60,303 @@ def safe_eval(expr: str):
     return _eval(node)
 
 # -------- init resources (call once and cache in UI) ----------
-def init(index_path=INDEX_PATH, meta_path=META_PATH, emb_model=EMB_MODEL, gen_model=GEN_MODEL):
-    if not os.path.exists(index_path) or not os.path.exists(meta_path):
-        raise FileNotFoundError("Index or meta not found. Run src/build_index.py first.")
+def load_index(version_dir, serve_shards=SERVE_SHARDS):
+    """FAISS index(es) and chunk store of one published index version."""
+    paths = version_paths(version_dir)
+    if not os.path.exists(paths["index"]) or not ChunkStore.exists(version_dir):
+        raise FileNotFoundError("Index or chunk store not found. Run src/build_index.py first.")
+    print(f"[init] Loading FAISS index and chunk store from {version_dir} ...")
+    ann_params = load_params(paths["ann_params"])
+    if load_shards_meta(version_dir) is not None:
+        # shards are read on first use; only the served ones are ever loaded
+        index = ShardedIndex(version_dir, serve=serve_shards)
+        flat = index.exact
+        print(f"[init] Sharded index: serving shards {index.serve} of {index.n_shards} ({index.ntotal} vectors)")
+    elif ann_params["type"] != "flat" and os.path.exists(paths["ann"]):
+        print(f"[init] Using {ann_params['type']} index {ann_params}")
+        index = apply_search_params(faiss.read_index(paths["ann"]), ann_params)
+        flat = faiss.read_index(paths["index"], FLAT_IO_FLAGS)
+    else:
+        index = flat = faiss.read_index(paths["index"])
+    # versions built before BM25 support only serve dense retrieval
+    lexical = BM25Index(paths["bm25"]) if bm25.exists(paths["bm25"]) else None
+    # the version name is part of every index-dependent cache key
+    return {"index": index, "flat": flat, "store": ChunkStore(version_dir), "bm25": lexical,
+            "version": version_name(version_dir)}
 
-    print("[init] Loading embedder...")
-    embedder = SentenceTransformer(emb_model)
+def reload_index(resources, index_dir=INDEX_DIR):
+    """New resources sharing the loaded models but pointing at the live index version.
 
-    print("[init] Loading FAISS index and meta...")
-    index = faiss.read_index(index_path)
-    with open(meta_path, "rb") as f:
-        meta = pickle.load(f)
+    The old dict is left untouched, so queries already running on it finish on the old version.
+    """
+    version_dir = current_version(index_dir)
+    if version_dir is None or version_name(version_dir) == resources["version"]:
+        return resources
+    return dict(resources, **load_index(version_dir))
+
+def load_models(emb_model=EMB_MODEL, gen_model=GEN_MODEL, emb_backend=EMB_BACKEND, gen_backend=GEN_BACKEND):
+    print("[init] Loading embedder...")
+    embedder = load_embedder(emb_model, emb_backend)
 
     print("[init] Loading generator model (this may be slow on first load)...")
-    tokenizer = AutoTokenizer.from_pretrained(gen_model)
-    gen_model = AutoModelForSeq2SeqLM.from_pretrained(gen_model)
+    tokenizer, generator = load_generator(gen_model, gen_backend)
 
-    resources = {
+    # backends change outputs slightly, so they are part of the cache keys
+    return {
         "embedder": embedder,
-        "index": index,
-        "meta": meta,
         "tokenizer": tokenizer,
-        "gen_model": gen_model
+        "gen_model": generator,
+        "emb_model_name": f"{emb_model}:{emb_backend}",
+        "gen_model_name": f"{gen_model}:{gen_backend}",
+    }
+
+def init(index_dir=INDEX_DIR, emb_model=EMB_MODEL, gen_model=GEN_MODEL, cache_size=1024, cache_ttl=24 * 3600,
+         disk_cache=False, emb_backend=EMB_BACKEND, gen_backend=GEN_BACKEND):
+    version_dir = current_version(index_dir)
+    if version_dir is None:
+        raise FileNotFoundError("Index or chunk store not found. Run src/build_index.py first.")
+    index_resources = load_index(version_dir)
+    resources = {
+        **load_models(emb_model, gen_model, emb_backend, gen_backend),
+        "cache": QueryCache(maxsize=cache_size, ttl=cache_ttl, disk_path=CACHE_DB if disk_cache else None),
+        **index_resources,
     }
     print("[init] Resources ready.")
     return resources
 
 # -------- retrieval with optional book filter ----------
-def retrieve(query: str, resources, k: int = 4, book_filter: str = None, candidate_k: int = 50):
-    embedder = resources["embedder"]
-    index = resources["index"]
-    meta = resources["meta"]
+MAX_RANGE_SELECTORS = 16
 
-    q_emb = embedder.encode([query], convert_to_numpy=True)
-    faiss.normalize_L2(q_emb)
-    candidate_k = max(candidate_k, k*10)
-    D, I = index.search(q_emb.astype("float32"), candidate_k)
+def book_selector(store, book_filter):
+    """FAISS IDSelector over the chunk ids of the matching book(s); None if no book matches.
 
-    # form ordered unique candidate list, then filter by book_filter
-    candidates = []
-    for idx in I[0]:
-        if idx < 0 or idx >= len(meta):
-            continue
-        candidates.append((idx, D[0][len(candidates)] if len(D[0])>len(candidates) else 0.0))
+    Returns (selector, keepalive): the SWIG selectors don't own their children, so the
+    list has to outlive the search call.
+    """
+    ranges = store.id_ranges(book_filter)
+    if not ranges:
+        return None, []
+    if len(ranges) > MAX_RANGE_SELECTORS:
+        # a book re-ingested many times is spread over many id runs: hash the ids instead
+        ids = np.concatenate([store.ids[np.searchsorted(store.ids, lo):np.searchsorted(store.ids, hi)]
+                              for lo, hi in ranges])
+        sel = faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype="int64"))
+        return sel, [sel]
+    keepalive = [faiss.IDSelectorRange(lo, hi) for lo, hi in ranges]
+    sel = keepalive[0]
+    for other in keepalive[1:]:
+        sel = faiss.IDSelectorOr(sel, other)
+        keepalive.append(sel)
+    return sel, keepalive
+
+def embed_queries(queries, resources, batch_size=64):
+    """Normalized query embeddings as one (n, d) matrix; only cache misses are encoded, in one batch."""
+    cache = resources.get("cache")
+    keys = [make_key(resources["emb_model_name"], q) for q in queries]
+    rows = [None] * len(queries)
+    if cache is not None:
+        for i, key in enumerate(keys):
+            found, q_emb = cache.get("embedding", key)
+            if found:
+                rows[i] = q_emb
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        with metrics.span("embed"):
+            q_emb = resources["embedder"].encode([queries[i] for i in missing], batch_size=batch_size,
+                                                 convert_to_numpy=True).astype("float32")
+            faiss.normalize_L2(q_emb)
+        for i, row in zip(missing, q_emb):
+            rows[i] = row[None, :]
+            if cache is not None:
+                cache.put("embedding", keys[i], rows[i])
+    return np.vstack(rows)
+
+def embed_query(query: str, resources):
+    return embed_queries([query], resources)
+
+def dense_search(q_emb, resources, k, book_filter=None):
+    """FAISS (scores, ids); with a book filter, exact search restricted to that book's ids."""
+    if book_filter and book_filter.lower() != "all":
+        # distances are only computed for the book's vectors
+        sel, keepalive = book_selector(resources["store"], book_filter)
+        if sel is None:
+            return np.zeros((len(q_emb), 0), dtype="float32"), np.zeros((len(q_emb), 0), dtype="int64")
+        params = faiss.SearchParameters(sel=sel)
+        flat = resources["flat"]
+        if isinstance(flat, ExactView):
+            # only the shards holding the book's chunks (and their merged canonicals) are searched
+            shards = flat.shards_for(resources["store"], resources["store"].id_ranges(book_filter))
+            return flat.search(q_emb, k, params=params, shards=shards)
+        return flat.search(q_emb, k, params=params)
+    return resources["index"].search(q_emb, k)
+
+def retrieval_mode(resources, mode):
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+    if resources.get("bm25") is None:
+        return "dense"
+    if mode == "hybrid" and resources.get("embedder") is None:
+        return "lexical"   # embedder not loaded (yet): BM25 alone is the cheap first stage
+    return mode
+
+def retrieve_batch(queries, resources, k: int = 4, book_filter: str = None, mode: str = RETRIEVAL_MODE):
+    """Top-k contexts for every query, searching FAISS once with the whole query matrix.
+
+    `mode` picks dense, lexical (BM25) or hybrid retrieval; hybrid fuses both
+    rankings with reciprocal-rank fusion and `score` is then the fused score.
+    """
+    with metrics.trace("retrieve", queries=len(queries), k=k, mode=mode):
+        return _retrieve_batch(queries, resources, k, book_filter, mode)
+
+def _retrieve_batch(queries, resources, k, book_filter, mode):
+    store = resources["store"]
+    cache = resources.get("cache")
+    mode = retrieval_mode(resources, mode)
+    keys = [make_key(resources["version"], mode, q, k, (book_filter or "all").lower()) for q in queries]
+    results = [None] * len(queries)
+    if cache is not None:
+        for i, key in enumerate(keys):
+            found, hits = cache.get("retrieval", key)
+            if found:
+                results[i] = hits
+    missing = [i for i, r in enumerate(results) if r is None]
+    if not missing:
+        return results
 
-    # filter by book if requested
-    selected = []
+    id_ranges = None
     if book_filter and book_filter.lower() != "all":
-        for idx, _ in candidates:
-            if meta[idx]["source"].lower().startswith(book_filter.lower()):
-                selected.append(idx)
-                if len(selected) >= k:
-                    break
-    # fallback: if not enough filtered, take top k overall
-    if len(selected) < k:
-        selected = [idx for idx, _ in candidates][:k]
-
-    results = [meta[idx] for idx in selected]
+        id_ranges = store.id_ranges(book_filter)
+        if not id_ranges:
+            return [r if r is not None else [] for r in results]
+
+    lexical_ranges = id_ranges
+    index = resources["index"]
+    if isinstance(index, ShardedIndex) and index.partial and mode != "dense":
+        # BM25 is global: keep its hits to the books of the shards this node serves, as dense search does
+        lexical_ranges = index.served_ranges(store, id_ranges)
+        if not lexical_ranges:
+            return [r if r is not None else [] for r in results]
+
+    depth = k * HYBRID_DEPTH if mode == "hybrid" else k
+    if mode != "lexical":
+        q_emb = embed_queries([queries[i] for i in missing], resources)
+        with metrics.span("dense_search"):
+            D, I = dense_search(q_emb, resources, depth, book_filter)
+    if mode != "dense":
+        with metrics.span("lexical_search"):
+            lexical = [resources["bm25"].search(queries[i], depth, id_ranges=lexical_ranges) for i in missing]
+
+    # the ID-mapped index returns chunk ids; only these k chunks are decoded from the store
+    with metrics.span("fetch_chunks"):
+        for row, i in enumerate(missing):
+            if mode == "dense":
+                ranked = [(int(idx), float(score)) for idx, score in zip(I[row], D[row]) if idx >= 0]
+            elif mode == "lexical":
+                ranked = list(zip(lexical[row][0].tolist(), lexical[row][1].tolist()))
+            else:
+                ranked = rrf_fuse([[idx for idx in I[row] if idx >= 0], lexical[row][0]], k)
+            hits = []
+            for idx, score in ranked[:k]:
+                if idx not in store:
+                    continue
+                chunk = store.get(idx)
+                if id_ranges is not None and not chunk["source"].lower().startswith(book_filter.lower()):
+                    # a near-duplicate merged into another book's copy: cite the copy in the filtered book
+                    chunk = store.get(next((i for i in store.group(idx)
+                                            if store.source_of(i).lower().startswith(book_filter.lower())), idx))
+                chunk["score"] = float(score)
+                hits.append(chunk)
+            results[i] = hits
+            if cache is not None:
+                cache.put("retrieval", keys[i], hits)
     return results
 
+def retrieve(query: str, resources, k: int = 4, book_filter: str = None, mode: str = RETRIEVAL_MODE):
+    return retrieve_batch([query], resources, k=k, book_filter=book_filter, mode=mode)[0]
+
+# -------- context packing ----------
+PROMPT_TOKEN_BUDGET = 512     # encoder tokens per prompt, question and instructions included
+MIN_CONTEXT_TOKENS = 32       # don't bother adding a context cut shorter than this
+
+def merge_adjacent(contexts):
+    """Merge overlapping/adjacent chunks of the same page so their shared overlap is sent once.
+
+    The merged context takes the rank of its best-ranked member; inputs are not modified.
+    """
+    merged = []
+    by_page = {}
+    for c in contexts:
+        if "start" not in c:
+            merged.append(dict(c))
+            continue
+        group = by_page.setdefault((c["source"], c["page"]), [])
+        for m in group:
+            if c["start"] <= m["end"] and m["start"] <= c["start"] + c["length"]:
+                # extend m with the part of c it doesn't cover yet (byte offsets within the page)
+                if c["start"] + c["length"] > m["end"]:
+                    tail = c["text"].encode("utf-8")[m["end"] - c["start"]:]
+                    m["text"] += tail.decode("utf-8", errors="ignore")
+                    m["end"] = c["start"] + c["length"]
+                if c["start"] < m["start"]:
+                    head = c["text"].encode("utf-8")[:m["start"] - c["start"]]
+                    m["text"] = head.decode("utf-8", errors="ignore") + m["text"]
+                    m["start"] = c["start"]
+                break
+        else:
+            m = dict(c, end=c["start"] + c["length"])
+            group.append(m)
+            merged.append(m)
+    return merged
+
+def count_tokens(tokenizer, text):
+    return len(tokenizer(text, add_special_tokens=False, verbose=False)["input_ids"])
+
+def truncate_to_tokens(tokenizer, text, max_tokens):
+    enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=tokenizer.is_fast, verbose=False)
+    ids = enc["input_ids"]
+    if len(ids) <= max_tokens:
+        return text
+    if tokenizer.is_fast:
+        return text[:enc["offset_mapping"][max_tokens - 1][1]]
+    return tokenizer.decode(ids[:max_tokens], skip_special_tokens=True)
+
+def pack_contexts(question, contexts, tokenizer, budget=PROMPT_TOKEN_BUDGET):
+    """Fit contexts (in rank order) into `budget` generator tokens; the question always stays.
+
+    These are the contexts the model sees, so they are also the ones returned with the
+    answer; each carries its number in the prompt as "context_no".
+    """
+    remaining = budget - count_tokens(tokenizer, build_prompt(question, []))
+    packed = []
+    for c in merge_adjacent(contexts):
+        if remaining < MIN_CONTEXT_TOKENS:
+            break
+        header = count_tokens(tokenizer, context_header(len(packed) + 1, c))
+        text_tokens = count_tokens(tokenizer, c["text"])
+        if header + text_tokens > remaining:
+            if remaining - header < MIN_CONTEXT_TOKENS:
+                break
+            c = dict(c, text=truncate_to_tokens(tokenizer, c["text"], remaining - header))
+            text_tokens = remaining - header
+        c["context_no"] = len(packed) + 1
+        packed.append(c)
+        remaining -= header + text_tokens
+    return packed
+
 # -------- prompt builder & generator ----------
-def build_prompt(question, contexts):
+def context_header(i, c):
+    return f"Context {i} (source: {c['source']}, page:{c['page']}):\n"
+
+def build_prompt(question, contexts, tokenizer=None, budget=PROMPT_TOKEN_BUDGET):
+    # with a tokenizer, contexts are deduplicated and packed into the token budget first
+    if tokenizer is not None:
+        contexts = pack_contexts(question, contexts, tokenizer, budget=budget)
     ctx_texts = ""
     for i, c in enumerate(contexts, start=1):
-        ctx_texts += f"Context {i} (source: {c['source']}, page:{c['page']}):\n{c['text']}\n\n"
+        if c.get("context_no", i) != i:
+            # the caller shows these contexts numbered as packed: the prompt must agree
+            raise ValueError(f"Context {c['context_no']} would be cited as [Context {i}]")
+        ctx_texts += f"{context_header(i, c)}{c['text']}\n\n"
     prompt = (
         "You are a helpful student assistant. Use ONLY the context sections below to answer the question. "
         "If the answer is not present in the context, reply: 'I don't know based on the provided books.'\n\n"
@@ -108,15 +365,12 @@ def build_prompt(question, contexts):
     )
     return prompt
 
-def generate_answer(question, contexts, resources, max_new_tokens=200):
-    tokenizer = resources["tokenizer"]
-    gen_model = resources["gen_model"]
-
-    prompt = build_prompt(question, contexts)
-    inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=1024)
-    out = gen_model.generate(**inputs, max_new_tokens=max_new_tokens, num_beams=4, early_stopping=True)
-    answer = tokenizer.decode(out[0], skip_special_tokens=True)
+def apply_calculator(answer):
     # handle calculator marker
+    with metrics.span("calc"):
+        return _apply_calculator(answer)
+
+def _apply_calculator(answer):
     m = CALC_PATTERN.search(answer)
     if m:
         expr = m.group(1).strip()
@@ -127,19 +381,167 @@ def generate_answer(question, contexts, resources, max_new_tokens=200):
             answer = answer + f"\n\nCalculator error: {e}"
     return answer
 
-# -------- top-level wrapper ----------
-def answer_query(user_input: str, resources, k: int = 4, book_filter: str = "All"):
+def generate_answers(questions, contexts_list, resources, max_new_tokens=200, batch_size=8):
+    """Padded, batched beam-search generation; answers come back in input order.
+
+    `contexts_list` holds packed contexts (pack_contexts), which are put in the prompts as they are.
+    """
+    tokenizer = resources["tokenizer"]
+    gen_model = resources["gen_model"]
+
+    with metrics.span("build_prompt"):
+        prompts = [build_prompt(q, ctx) for q, ctx in zip(questions, contexts_list)]
+    answers = []
+    for start in range(0, len(prompts), batch_size):
+        inputs = tokenizer(prompts[start:start + batch_size], return_tensors="pt", padding=True,
+                           truncation=True, max_length=1024)
+        with metrics.span("generate"):
+            out = gen_model.generate(**inputs, max_new_tokens=max_new_tokens, num_beams=4, early_stopping=True)
+        if metrics.active():
+            metrics.count("tokens", int(inputs["attention_mask"].sum()), kind="prompt")
+            # generated tokens without padding and the decoder start token
+            metrics.count("tokens", int((out[:, 1:] != tokenizer.pad_token_id).sum()), kind="generated")
+        answers.extend(tokenizer.batch_decode(out, skip_special_tokens=True))
+    return [apply_calculator(a) for a in answers]
+
+def generate_answer(question, contexts, resources, max_new_tokens=200):
+    return generate_answers([question], [contexts], resources, max_new_tokens=max_new_tokens)[0]
+
+def stream_answer(question, contexts, resources, max_new_tokens=200):
+    """Yield the answer text piece by piece as it is decoded.
+
+    Beam search can't be streamed, so this path decodes greedily. The calculator
+    result (if any) is yielded last, once the full text is known. `contexts` are
+    packed (pack_contexts) and put in the prompt as they are.
+    """
+    tokenizer = resources["tokenizer"]
+    gen_model = resources["gen_model"]
+
+    with metrics.span("build_prompt"):
+        prompt = build_prompt(question, contexts)
+    inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=1024)
+    if metrics.active():
+        metrics.count("tokens", int(inputs["attention_mask"].sum()), kind="prompt")
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def generate():
+        try:
+            gen_model.generate(**inputs, max_new_tokens=max_new_tokens, num_beams=1, do_sample=False, streamer=streamer)
+        except BaseException as e:
+            # a failed generate never ends the streamer: end it so the consumer isn't left waiting
+            errors.append(e)
+            streamer.end()
+
+    thread = Thread(target=generate, daemon=True)
+    thread.start()
+    text = ""
+    with metrics.span("generate"):
+        for piece in streamer:
+            text += piece
+            yield piece
+        thread.join()
+    if errors:
+        raise errors[0]
+    if metrics.active():
+        metrics.count("tokens", count_tokens(tokenizer, text), kind="generated")
+    final = apply_calculator(text)
+    if len(final) > len(text):
+        yield final[len(text):]
+
+# -------- top-level wrappers ----------
+def calc_command(user_input: str):
     # direct calc command by user
+    expr = user_input.split(":",1)[1].strip()
+    try:
+        return str(safe_eval(expr)), []
+    except Exception as e:
+        return f"Calc error: {e}", []
+
+def answer_queries(user_inputs, resources, k: int = 4, book_filter: str = "All", batch_size: int = 8,
+                   mode: str = RETRIEVAL_MODE):
+    """Answer many questions at once: one embedding batch, one FAISS search, batched generation.
+
+    Returns a list of (answer, contexts) in the same order as `user_inputs`.
+    """
+    with metrics.trace("answer", questions=len(user_inputs), k=k, mode=mode):
+        return _answer_queries(user_inputs, resources, k, book_filter, batch_size, mode)
+
+def _answer_queries(user_inputs, resources, k, book_filter, batch_size, mode):
+    cache = resources.get("cache")
+    results = [None] * len(user_inputs)
+    keys = {}
+    for i, q in enumerate(user_inputs):
+        if q.strip().lower().startswith("calc:"):
+            with metrics.span("calc"):
+                results[i] = calc_command(q)
+            continue
+        keys[i] = make_key(resources["version"], resources["gen_model_name"], retrieval_mode(resources, mode), q, k,
+                           (book_filter or "all").lower())
+        if cache is not None:
+            found, result = cache.get("answer", keys[i])
+            if found:
+                results[i] = result
+
+    # repeated questions in one batch are only answered once
+    pending = {}
+    for i, r in enumerate(results):
+        if r is None:
+            pending.setdefault(keys[i], []).append(i)
+    if pending:
+        first = [idxs[0] for idxs in pending.values()]
+        questions = [user_inputs[i] for i in first]
+        contexts_list = retrieve_batch(questions, resources, k=k, book_filter=book_filter, mode=mode)
+        # the contexts returned (and cached) with an answer are exactly the ones its prompt cites
+        with metrics.span("build_prompt"):
+            contexts_list = [pack_contexts(q, ctx, resources["tokenizer"]) for q, ctx in zip(questions, contexts_list)]
+        answers = generate_answers(questions, contexts_list, resources, batch_size=batch_size)
+        for (key, idxs), answer, contexts in zip(pending.items(), answers, contexts_list):
+            for i in idxs:
+                results[i] = (answer, contexts)
+            if cache is not None:
+                cache.put("answer", key, (answer, contexts))
+    return results
+
+def answer_query(user_input: str, resources, k: int = 4, book_filter: str = "All", mode: str = RETRIEVAL_MODE):
+    return answer_queries([user_input], resources, k=k, book_filter=book_filter, mode=mode)[0]
+
+def answer_query_stream(user_input: str, resources, k: int = 4, book_filter: str = "All",
+                        mode: str = RETRIEVAL_MODE):
+    """Streaming variant of answer_query: returns (contexts, pieces) where `pieces` yields answer text.
+
+    `contexts` are the packed contexts of the prompt, numbered as the answer cites them.
+
+    Generation happens while `pieces` is consumed, so its spans land in the caller's
+    metrics trace if one is open around the whole exchange (as in app.py).
+    """
     if user_input.strip().lower().startswith("calc:"):
-        expr = user_input.split(":",1)[1].strip()
-        try:
-            return str(safe_eval(expr)), []
-        except Exception as e:
-            return f"Calc error: {e}", []
+        answer, contexts = calc_command(user_input)
+        return contexts, iter([answer])
+
+    # greedy answers differ from the beam-search ones, so they are cached separately
+    cache = resources.get("cache")
+    key = make_key(resources["version"], resources["gen_model_name"], "greedy", retrieval_mode(resources, mode),
+                   user_input, k, (book_filter or "all").lower())
+    if cache is not None:
+        found, result = cache.get("answer", key)
+        if found:
+            answer, contexts = result
+            return contexts, iter([answer])
+
+    contexts = retrieve(user_input, resources=resources, k=k, book_filter=book_filter, mode=mode)
+    with metrics.span("build_prompt"):
+        contexts = pack_contexts(user_input, contexts, resources["tokenizer"])
+
+    def pieces():
+        parts = []
+        for piece in stream_answer(user_input, contexts, resources):
+            parts.append(piece)
+            yield piece
+        if cache is not None:
+            cache.put("answer", key, ("".join(parts), contexts))
 
-    contexts = retrieve(user_input, resources=resources, k=k, book_filter=book_filter)
-    answer = generate_answer(user_input, contexts, resources)
-    return answer, contexts
+    return contexts, pieces()
 
 # quick example if run as script (for debugging)
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+# src/server.py
+# Async HTTP API over query_engine for many concurrent users on one CPU box.
+# One init() resource set is shared by all requests. Questions go into a bounded
+# queue; a single batcher task takes whatever arrived within a short window (up to
+# MAX_BATCH) and answers it with one answer_queries call per (k, book, mode) group, so
+# concurrent users share embedding, search and generation batches.
+#   POST /ask     {"question": "...", "k": 4, "book": "All", "mode": "hybrid"}
+#   GET  /health
+#   GET  /metrics  per-stage latency, token and cache counters (Prometheus text format)
+# Run: python src/server.py --port 8080
+import time
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import metrics
+from query_engine import init, answer_queries, RETRIEVAL_MODES, RETRIEVAL_MODE
+
+MAX_BATCH = 16          # questions per micro-batch
+BATCH_WINDOW = 0.02     # seconds to wait for more questions once one has arrived
+MAX_QUEUE = 256         # waiting questions before new ones are rejected with 503
+REQUEST_TIMEOUT = 60.0  # seconds a caller waits for its answer before getting 504
+MAX_K = 8
+
+class Pending:
+    def __init__(self, question, k, book_filter, mode, future):
+        self.question = question
+        self.k = k
+        self.book_filter = book_filter
+        self.mode = mode
+        self.future = future
+
+class MicroBatcher:
+    def __init__(self, resources, max_batch=MAX_BATCH, window=BATCH_WINDOW, max_queue=MAX_QUEUE):
+        self.resources = resources
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        # one worker thread: the models are used by one batch at a time, torch parallelizes inside it
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {"batches": 0, "questions": 0, "rejected": 0, "timed_out": 0}
+
+    def submit(self, question, k, book_filter, mode=RETRIEVAL_MODE):
+        """Queue a question and return the future for its (answer, contexts); raises asyncio.QueueFull."""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait(Pending(question, k, book_filter, mode, future))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise
+        return future
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # callers that already timed out are not worth a generation slot
+        return [p for p in batch if not p.future.done()]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            groups = {}
+            for p in batch:
+                groups.setdefault((p.k, (p.book_filter or "All").lower(), p.mode), []).append(p)
+            for (k, _, mode), items in groups.items():
+                questions = [p.question for p in items]
+                try:
+                    results = await loop.run_in_executor(self.executor, partial(
+                        answer_queries, questions, self.resources, k=k, book_filter=items[0].book_filter, mode=mode))
+                except Exception as e:
+                    for p in items:
+                        if not p.future.done():
+                            p.future.set_exception(e)
+                    continue
+                for p, result in zip(items, results):
+                    if not p.future.done():
+                        p.future.set_result(result)
+                self.stats["batches"] += 1
+                self.stats["questions"] += len(items)
+
+# -------- HTTP handlers ----------
+async def ask(request):
+    batcher = request.app["batcher"]
+    try:
+        body = await request.json()
+        question = str(body["question"]).strip()
+        k = min(max(int(body.get("k", 4)), 1), MAX_K)
+        book_filter = str(body.get("book", "All"))
+        mode = str(body.get("mode", RETRIEVAL_MODE))
+    except (ValueError, KeyError, TypeError):
+        return web.json_response({"error": "expected JSON {\"question\": str, \"k\": int, \"book\": str}"}, status=400)
+    if mode not in RETRIEVAL_MODES:
+        return web.json_response({"error": f"mode must be one of {list(RETRIEVAL_MODES)}"}, status=400)
+    if not question:
+        return web.json_response({"error": "empty question"}, status=400)
+
+    t0 = time.perf_counter()
+    try:
+        future = batcher.submit(question, k, book_filter, mode)
+    except asyncio.QueueFull:
+        return web.json_response({"error": "server busy, try again"}, status=503, headers={"Retry-After": "1"})
+    try:
+        answer, contexts = await asyncio.wait_for(future, request.app["timeout"])
+    except asyncio.TimeoutError:
+        batcher.stats["timed_out"] += 1
+        return web.json_response({"error": "timed out"}, status=504)
+    except Exception as e:
+        return web.json_response({"error": f"{type(e).__name__}: {e}"}, status=500)
+
+    return web.json_response({
+        "answer": answer,
+        "contexts": [{key: c[key] for key in ("context_no", "source", "page", "chunk_id", "score", "text", "also_in")
+                      if key in c}
+                     for c in contexts],
+        "version": batcher.resources["version"],
+        "seconds": round(time.perf_counter() - t0, 3),
+    })
+
+async def health(request):
+    batcher = request.app["batcher"]
+    stats = dict(batcher.stats, queued=batcher.queue.qsize())
+    if stats["batches"]:
+        stats["mean_batch_size"] = round(stats["questions"] / stats["batches"], 2)
+    return web.json_response({"status": "ok", "version": batcher.resources["version"], **stats})
+
+async def prometheus(request):
+    batcher = request.app["batcher"]
+    metrics.REGISTRY.set_gauge("server_queued", batcher.queue.qsize())
+    for key, value in batcher.stats.items():
+        metrics.REGISTRY.set_gauge(f"server_{key}", value)
+    return web.Response(text=metrics.render_prometheus(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def make_app(resources, max_batch=MAX_BATCH, window=BATCH_WINDOW, max_queue=MAX_QUEUE, timeout=REQUEST_TIMEOUT):
+    app = web.Application()
+    app["timeout"] = timeout
+
+    async def start_batcher(app):
+        app["batcher"] = MicroBatcher(resources, max_batch=max_batch, window=window, max_queue=max_queue)
+        app["batcher_task"] = asyncio.create_task(app["batcher"].run())
+
+    async def stop_batcher(app):
+        app["batcher_task"].cancel()
+        app["batcher"].executor.shutdown(wait=False)
+
+    app.on_startup.append(start_batcher)
+    app.on_cleanup.append(stop_batcher)
+    app.router.add_post("/ask", ask)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", prometheus)
+    return app
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve query_engine over HTTP with micro-batching")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="questions per micro-batch")
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW * 1000,
+                        help="how long to wait for more questions before running a batch")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE, help="queued questions before returning 503")
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="per-request timeout in seconds")
+    parser.add_argument("--no-metrics", action="store_true", help="don't trace requests (/metrics stays empty)")
+    parser.add_argument("--metrics-log", default=None,
+                        help="JSON-lines file for per-request traces ('-' for stderr, 'off'; default $RAG_METRICS_LOG)")
+    args = parser.parse_args()
+    if not args.no_metrics:
+        metrics.enable(log_path=args.metrics_log)
+    resources = init()
+    web.run_app(make_app(resources, max_batch=args.max_batch, window=args.batch_window_ms / 1000,
+                         max_queue=args.max_queue, timeout=args.timeout),
+                host=args.host, port=args.port)
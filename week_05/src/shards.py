@@ -0,0 +1,209 @@
+# src/shards.py
+# Optional sharded layout of the dense index inside a version directory:
+#   shards/shards.json       partitioning (stable hash of the book name) and per-shard info
+#   shards/<nnn>/faiss.index  ID-mapped flat index of the shard's vectors (exact/filtered search)
+#   shards/<nnn>/ann.index    the shard's IVF/HNSW/IVF-PQ index when --index-type asks for one
+# Shards are derived from the flat index like ann.index is, so incremental builds and the
+# chunk store / BM25 (both memory-mapped, and global) are unchanged. Unchanged shards are
+# hard-linked from the live version. At query time shards are loaded on first use, searched
+# in parallel threads (FAISS releases the GIL) and the per-shard top-k lists are merged by
+# score; SERVE_SHARDS limits a node to the shards it serves.
+import os
+import sys
+import json
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import faiss
+from index_versions import version_paths, link_files, INDEX_FILE, ANN_FILE, ANN_PARAMS_FILE
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # repo root, for rag_common
+from rag_common.ann_index import build_ann_index, apply_search_params, save_params, load_params
+
+SHARDS_DIR = "shards"
+SHARDS_FILE = "shards.json"
+MIN_ANN_VECTORS = 1000   # smaller shards are searched exactly: too few points to train an ANN index
+FLAT_IO_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+def shard_of(source, n_shards):
+    """Stable shard number of a book (the same across builds, machines and Python runs)."""
+    digest = hashlib.blake2b(source.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n_shards
+
+def shard_name(i):
+    return f"{i:03d}"
+
+def load_meta(version_dir):
+    """shards.json of a version, or None if it is not sharded."""
+    path = os.path.join(version_dir or "", SHARDS_DIR, SHARDS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf8") as f:
+        return json.load(f)
+
+def shards_up_to_date(n_shards, index_type, version_dir):
+    meta = load_meta(version_dir)
+    if not n_shards:
+        return meta is None
+    return meta is not None and meta["n_shards"] == n_shards and meta["index_type"] == index_type
+
+# -------- build ----------
+def build_shards(index, store, n_shards, index_type, version_dir, live_dir=None, target_recall=0.95):
+    """Split the flat ID-mapped `index` into `n_shards` by book and write them into `version_dir`.
+
+    A merged near-duplicate has no vector of its own; it is found through its canonical
+    chunk, which lives in the shard of the canonical chunk's book.
+    """
+    ids = faiss.vector_to_array(index.id_map)
+    flat = faiss.downcast_index(index.index)
+    vectors = faiss.rev_swig_ptr(flat.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+    # chunk id -> book -> shard, vectorized over the memory-mapped store columns
+    rows = np.searchsorted(store.ids, ids)
+    sources = np.asarray(store.pages["source"])[np.asarray(store.chunks["page_row"])[rows]]
+    book_shard = np.array([shard_of(s, n_shards) for s in store.sources], dtype="int64")
+    assignment = book_shard[sources] if len(ids) else np.zeros(0, dtype="int64")
+
+    live = load_meta(live_dir)
+    live_shards = {s["name"]: s for s in live["shards"]} if live and live["n_shards"] == n_shards else {}
+    shards_dir = os.path.join(version_dir, SHARDS_DIR)
+    meta = {"n_shards": n_shards, "index_type": index_type, "partition": "book", "d": int(index.d), "shards": []}
+    reused = 0
+    for i in range(n_shards):
+        name = shard_name(i)
+        sel = np.flatnonzero(assignment == i)
+        shard_ids = np.ascontiguousarray(ids[sel], dtype="int64")
+        shard_vectors = np.ascontiguousarray(vectors[sel], dtype="float32")
+        # same ids and vectors as the live shard: the files are carried over unchanged
+        h = hashlib.blake2b(digest_size=16)
+        h.update(shard_ids.tobytes())
+        h.update(shard_vectors.tobytes())
+        entry = {"name": name, "ntotal": int(len(sel)), "digest": h.hexdigest(),
+                 "type": index_type if len(sel) >= MIN_ANN_VECTORS else "flat",
+                 "books": sorted(s for s, b in zip(store.sources, book_shard) if b == i)}
+        meta["shards"].append(entry)
+        if not len(sel):
+            continue
+        shard_dir = os.path.join(shards_dir, name)
+        old = live_shards.get(name)
+        if old and old["digest"] == entry["digest"] and old["type"] == entry["type"]:
+            link_files(os.path.join(live_dir, SHARDS_DIR, name), shard_dir, [INDEX_FILE, ANN_FILE, ANN_PARAMS_FILE])
+            reused += 1
+            continue
+        os.makedirs(shard_dir, exist_ok=True)
+        paths = version_paths(shard_dir)
+        shard_flat = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+        shard_flat.add_with_ids(shard_vectors, shard_ids)
+        faiss.write_index(shard_flat, paths["index"])
+        if entry["type"] != "flat":
+            print(f"[build] Shard {name}: building {entry['type']} index over {len(sel)} vectors...")
+            ann, params = build_ann_index(entry["type"], shard_vectors, shard_ids, shard_flat,
+                                          target_recall=target_recall)
+            faiss.write_index(ann, paths["ann"])
+            save_params(params, paths["ann_params"])
+
+    with open(os.path.join(shards_dir, SHARDS_FILE), "w", encoding="utf8") as f:
+        json.dump(meta, f, indent=2)
+    print(f"[build] {n_shards} shards written ({reused} carried over):",
+          {s["name"]: s["ntotal"] for s in meta["shards"]})
+    return meta
+
+# -------- search ----------
+def merge_topk(results, k):
+    """Merge per-shard (scores, ids) of the same queries into one top-k by score."""
+    D = np.concatenate([d for d, _ in results], axis=1)
+    I = np.concatenate([i for _, i in results], axis=1)
+    order = np.argsort(-D, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+def parse_shard_list(value):
+    """"0,2,5" -> [0, 2, 5]; empty or None -> None (all shards)."""
+    if not value:
+        return None
+    return [int(s) for s in str(value).split(",") if s.strip()]
+
+class ShardedIndex:
+    """Dense search over the shards of one version, with the .search() interface of a FAISS index.
+
+    `serve` lists the shard numbers this process holds (None: all of them). `exact`
+    is a view over the same shards that searches their flat indexes (used for
+    filtered search and recall checks).
+    """
+    def __init__(self, version_dir, serve=None, workers=None):
+        self.meta = load_meta(version_dir)
+        if self.meta is None:
+            raise FileNotFoundError(f"{version_dir} has no {SHARDS_DIR}/{SHARDS_FILE}")
+        self.dir = os.path.join(version_dir, SHARDS_DIR)
+        self.n_shards = self.meta["n_shards"]
+        held = range(self.n_shards) if serve is None else [i for i in serve if 0 <= i < self.n_shards]
+        self.serve = [i for i in held if self.meta["shards"][i]["ntotal"]]
+        # holding only some of the non-empty shards: the rest of the corpus is another node's
+        self.partial = len(self.serve) < sum(1 for s in self.meta["shards"] if s["ntotal"])
+        self.ranges = None   # chunk-id runs of the served books, see served_ranges
+        self.d = self.meta["d"]
+        self.ntotal = sum(self.meta["shards"][i]["ntotal"] for i in self.serve)
+        self.loaded = {}   # shard number -> (search index, flat index)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(len(self.serve), workers or os.cpu_count() or 1)))
+        self.exact = ExactView(self)
+
+    def shard(self, i):
+        """(search index, flat index) of shard `i`, read from disk on first use."""
+        if i not in self.loaded:
+            with self.lock:
+                if i not in self.loaded:
+                    paths = version_paths(os.path.join(self.dir, shard_name(i)))
+                    params = load_params(paths["ann_params"])
+                    if params["type"] != "flat" and os.path.exists(paths["ann"]):
+                        # the flat index then only serves filtered queries: memory-map it
+                        self.loaded[i] = (apply_search_params(faiss.read_index(paths["ann"]), params),
+                                          faiss.read_index(paths["index"], FLAT_IO_FLAGS))
+                    else:
+                        flat = faiss.read_index(paths["index"])
+                        self.loaded[i] = (flat, flat)
+        return self.loaded[i]
+
+    def shards_for(self, store, id_ranges):
+        """Served shards holding any of the chunk-id ranges (a book's chunks and its merged canonicals)."""
+        wanted = {shard_of(store.source_of(lo), self.n_shards) for lo, _ in id_ranges}
+        return [i for i in self.serve if i in wanted]
+
+    def served_ranges(self, store, id_ranges=None):
+        """The [lo, hi) chunk-id runs among `id_ranges` (default: all) whose vectors are in a served shard."""
+        if id_ranges is None:
+            if self.ranges is None:
+                runs = store.ranges
+                self.ranges = [(int(lo), int(hi)) for lo, hi, source in zip(runs["lo"], runs["hi"], runs["source"])
+                               if shard_of(store.sources[int(source)], self.n_shards) in self.serve]
+            return self.ranges
+        return [(lo, hi) for lo, hi in id_ranges if shard_of(store.source_of(lo), self.n_shards) in self.serve]
+
+    def _search_one(self, i, x, k, params, exact):
+        index = self.shard(i)[1 if exact else 0]
+        if params is not None:
+            return index.search(x, k, params=params)
+        return index.search(x, k)
+
+    def search(self, x, k, params=None, shards=None, exact=False):
+        """(scores, ids) of the top-k over `shards` (default: every served shard)."""
+        shards = self.serve if shards is None else shards
+        if not shards:
+            return np.zeros((len(x), 0), dtype="float32"), np.zeros((len(x), 0), dtype="int64")
+        if len(shards) == 1:
+            return self._search_one(shards[0], x, k, params, exact)
+        futures = [self.executor.submit(self._search_one, i, x, k, params, exact) for i in shards]
+        return merge_topk([f.result() for f in futures], k)
+
+class ExactView:
+    """The flat indexes of a ShardedIndex's shards, searched exactly."""
+    def __init__(self, sharded):
+        self.sharded = sharded
+        self.d = sharded.d
+        self.ntotal = sharded.ntotal
+
+    def shards_for(self, store, id_ranges):
+        return self.sharded.shards_for(store, id_ranges)
+
+    def search(self, x, k, params=None, shards=None):
+        return self.sharded.search(x, k, params=params, shards=shards, exact=True)
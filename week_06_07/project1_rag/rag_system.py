@@ -1,256 +1,870 @@
 import os
+import sys
 import json
 import time
+_T0 = time.perf_counter()   # start of the import, for the startup report
+import argparse
+import hashlib
+import shutil
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 import numpy as np
-import pdfplumber
 
 # faiss
 import faiss
 
-# sentence-transformers for embeddings
-from sentence_transformers import SentenceTransformer
+# pdfplumber (via rag_common.pdf_extract), sentence-transformers and transformers are imported on first use
 
-# transformers for local generation
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+# shared helpers (repo root)
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from rag_common.ann_index import build_ann_index, apply_search_params, save_params, load_params, recall_at_k
+from rag_common import bm25, pdf_extract
+from rag_common.pdf_extract import file_sha256
+from rag_common.chunking import chunk_spans, load_tokenizer
+from rag_common.embed_cache import EmbeddingCache, encode_cached
 
 # ---------------- Config ----------------
 PROJECT_DIR = Path(".") / "project1-rag"
 PROJECT_DIR.mkdir(parents=True, exist_ok=True)
 
 PDF_PATH = PROJECT_DIR / "sample.pdf"
-CHUNKS_JSON = PROJECT_DIR / "chunks.json"
-CHUNKS_SPLIT_JSON = PROJECT_DIR / "chunks_split.json"
-EMBEDDINGS_NPY = PROJECT_DIR / "embeddings.npy"
-FAISS_INDEX_PATH = PROJECT_DIR / "faiss.index"
+STAGES_DIR = PROJECT_DIR / "stages"                     # stage outputs, one directory per fingerprint
+CURRENT_JSON = PROJECT_DIR / "current.json"             # stage outputs of the last build, per chunk config
+STORAGE_REPORT_JSON = PROJECT_DIR / "storage_report.json"
 RESPONSES_JSON = PROJECT_DIR / "responses.json"
+RESPONSES_JSONL = PROJECT_DIR / "responses.jsonl"       # evaluation rows, appended as they are answered
 COMPARISON_MD = PROJECT_DIR / "comparison_analysis.md"
 
+# Files inside the stage directories
+STAGE_FILE = "stage.json"             # written last: the stage output is complete
+EXTRACTED_FILE = "extracted.json"     # extract: full_text & page_index
+CHUNKS_FILE = "chunks.json"           # chunk
+EMBEDDINGS_FILE = "embeddings.npy"    # embed
+PCA_FILE = "pca.vt"                   # embed: PCA fitted at build time (when PCA_DIM is set)
+FAISS_INDEX_FILE = "faiss.index"      # index
+FAISS_PARAMS_FILE = "faiss_params.json"   # index: index type + tuned nprobe/efSearch
+BM25_SUBDIR = "bm25"                  # bm25: lexical inverted index over the same chunks
+
 # Embedding model (local)
 LOCAL_EMBED_MODEL = "all-MiniLM-L6-v2"
 
 # Local generator model (smaller / CPU-friendly)
 LOCAL_GEN_MODEL = "google/flan-t5-small"
 LOCAL_GEN_MAX_NEW_TOKENS = 200
-
-# Chunking defaults
-SMALL_CHUNK_SIZE = 3000
-SMALL_CHUNK_OVERLAP = 300
-LARGE_CHUNK_SIZE = 9000
-LARGE_CHUNK_OVERLAP = 500
+GEN_BATCH_SIZE = 8   # padded prompts per generate() call in evaluation runs
+
+# Chunking defaults (embedder tokens; MiniLM embeds at most 256, so only small chunks are embedded)
+SMALL_CHUNK_SIZE = 250
+SMALL_CHUNK_OVERLAP = 30
+LARGE_CHUNK_SIZE = 768
+LARGE_CHUNK_OVERLAP = 64
+CHUNK_CONFIGS = {"small": (SMALL_CHUNK_SIZE, SMALL_CHUNK_OVERLAP), "large": (LARGE_CHUNK_SIZE, LARGE_CHUNK_OVERLAP)}
+EMBED_MAX_TOKENS = 256   # LOCAL_EMBED_MODEL's max_seq_length: longer chunks would be cut off silently
+# configs that can be built and searched; the others (large) are only chunked, as parents
+EMBEDDED_CONFIGS = sorted(c for c, (size, _) in CHUNK_CONFIGS.items() if size <= EMBED_MAX_TOKENS)
+CHUNK_CONFIG = "small"   # the config built and queried by default (small: precision, and fully embedded)
+
+# Embedding storage: vectors are saved L2-normalized and memory-mapped when the index is built.
+# "float16" halves embeddings.npy and the flat index (FAISS keeps fp16 codes); PCA_DIM reduces
+# the dimension with a PCA fitted on the chunk embeddings and applied to queries (None = keep all).
+# STORAGE_REPORT writes the memory saved vs. recall lost by each option to storage_report.json.
+EMBED_DTYPE = "float32"
+PCA_DIM = None
+PCA_TRAIN_SAMPLE = 50000
+ADD_BATCH = 65536          # vectors converted/added to FAISS at a time
+STORAGE_REPORT = False
 
 # Retrieval default
 TOP_K = 4
 
+# FAISS index type: one of INDEX_TYPES ("flat", "ivf", "hnsw", "ivfpq");
+# ANN types are tuned to reach TARGET_RECALL recall@10 against the flat index
+INDEX_TYPE = "flat"
+TARGET_RECALL = 0.95
+
+# "dense" (FAISS), "lexical" (BM25) or "hybrid" (both, fused by reciprocal rank)
+RETRIEVAL_MODE = "hybrid"
+HYBRID_DEPTH = 4   # each ranking contributes k * HYBRID_DEPTH candidates to the fusion
+
+# Small-to-big context: the small chunks are searched, then each hit (best first) is widened
+# before prompting, with no second search: "parent" = the large chunk enclosing it, "neighbors" =
+# up to NEIGHBOR_CHUNKS adjacent small chunks on each side, "none" = each hit cut to 1500 chars.
+# Widening stops at CONTEXT_TOKEN_BUDGET generator tokens for the whole context.
+CONTEXT_EXPANSION = "parent"
+CONTEXT_TOKEN_BUDGET = 1024
+NEIGHBOR_CHUNKS = 2
+PARENT_CHUNK_CONFIG = {"small": "large"}   # chunk config whose chunks are the parents (chunked, never embedded)
+
 # ---------------- Helpers ----------------
 def extract_text_pdfplumber(pdf_path: str) -> Dict[str, Any]:
-    """Extract text from PDF using pdfplumber; returns dict with full_text & page_index."""
+    """Extract text from PDF using pdfplumber; returns dict with full_text & page_index.
+
+    Pages are extracted in parallel and cached on disk (rag_common.pdf_extract).
+    """
     if not Path(pdf_path).exists():
         raise FileNotFoundError(f"PDF not found: {pdf_path}")
-    text = ""
-    page_index = []
-    with pdfplumber.open(pdf_path) as pdf:
-        for i, page in enumerate(pdf.pages):
-            page_text = page.extract_text() or ""
-            start_char = len(text)
-            text += f"\n\n[PAGE {i+1}]\n" + page_text
-            page_index.append({"page": i + 1, "start_char": start_char, "length": len(page_text)})
-    return {"full_text": text, "page_index": page_index}
-
-def chunk_text_chars(text: str, chunk_size:int=SMALL_CHUNK_SIZE, overlap:int=SMALL_CHUNK_OVERLAP) -> List[str]:
-    chunks = []
-    start = 0
-    L = len(text)
-    while start < L:
-        end = min(start + chunk_size, L)
-        chunks.append(text[start:end])
-        start = max(end - overlap, end)
-    return chunks
+    return pdf_extract.extract_document(pdf_path, backend="pdfplumber")
+
+def chunk_spans_tokens(text: str, chunk_size:int=SMALL_CHUNK_SIZE, overlap:int=SMALL_CHUNK_OVERLAP) -> List[Tuple[int, int]]:
+    """(start, end) character spans of sentence-aligned chunks of at most chunk_size embedder tokens."""
+    # only the (fast) tokenizer is needed here, not the embedding model itself
+    return list(chunk_spans(text, load_tokenizer(LOCAL_EMBED_MODEL), max_tokens=chunk_size, overlap_tokens=overlap))
+
+def chunk_text_tokens(text: str, chunk_size:int=SMALL_CHUNK_SIZE, overlap:int=SMALL_CHUNK_OVERLAP) -> List[str]:
+    """Sentence-aligned chunks of at most chunk_size embedder tokens, overlapping by up to `overlap` tokens."""
+    return [text[s:e] for s, e in chunk_spans_tokens(text, chunk_size, overlap)]
+
+# ---------------- Lazy models ----------------
+# Models are loaded on first use, so importing this module is cheap and each path only
+# pays for what it needs: a build whose chunks are all in the embedding cache or a
+# lexical-only query never loads the embedder, retrieval alone never loads the generator.
+STARTUP: Dict[str, float] = {"import": time.perf_counter() - _T0}   # stage -> seconds
+_models: Dict[str, Any] = {}
+_models_lock = threading.Lock()
+
+@contextmanager
+def startup_stage(name: str):
+    """Add the time spent in the block to STARTUP[name]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP[name] = STARTUP.get(name, 0.0) + time.perf_counter() - start
+
+def get_embed_model():
+    with _models_lock:
+        if "embed" not in _models:
+            print("[*] Loading embedding model:", LOCAL_EMBED_MODEL)
+            with startup_stage("load_embedder"):
+                from sentence_transformers import SentenceTransformer
+                _models["embed"] = SentenceTransformer(LOCAL_EMBED_MODEL)
+    return _models["embed"]
+
+def get_generator():
+    """(tokenizer, model) of the local seq2seq generator."""
+    with _models_lock:
+        if "gen" not in _models:
+            print("[*] Preparing local generator:", LOCAL_GEN_MODEL)
+            with startup_stage("load_generator"):
+                from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+                _models["gen"] = (AutoTokenizer.from_pretrained(LOCAL_GEN_MODEL),
+                                  AutoModelForSeq2SeqLM.from_pretrained(LOCAL_GEN_MODEL))
+    return _models["gen"]
+
+def startup_report(path: str):
+    """Print where the time of the `path` subcommand went (model loads, first answer, ...)."""
+    stages = ", ".join(f"{name} {sec:.2f}s" for name, sec in STARTUP.items())
+    print(f"[startup] {path}: {stages} | elapsed {time.perf_counter() - _T0:.2f}s")
 
 # ---------------- Embedding (local) ----------------
-print("[*] Loading embedding model:", LOCAL_EMBED_MODEL)
-embed_model = SentenceTransformer(LOCAL_EMBED_MODEL)
+# vectors are shared with every other project through the on-disk embedding cache
+def get_embed_cache():
+    """The embedding cache (None when turned off), opened on first use like the models."""
+    with _models_lock:
+        if "embed_cache" not in _models:
+            _models["embed_cache"] = EmbeddingCache.for_model(f"{LOCAL_EMBED_MODEL}:torch")
+    return _models["embed_cache"]
 
 def compute_local_embeddings(text_list: List[str], batch_size: int = 32) -> np.ndarray:
-    """Return numpy array float32 of embeddings."""
-    emb = embed_model.encode(text_list, batch_size=batch_size, show_progress_bar=True, convert_to_numpy=True)
-    return np.array(emb, dtype=np.float32)
+    """Return numpy array float32 of embeddings; only texts missing from the cache are encoded."""
+    def encode(texts):
+        return get_embed_model().encode(texts, batch_size=batch_size, show_progress_bar=True, convert_to_numpy=True)
+    embed_cache = get_embed_cache()
+    emb = encode_cached(text_list, encode, embed_cache)
+    if embed_cache is not None:
+        embed_cache.flush()
+    return emb
+
+# ---------------- Embedding storage ----------------
+def fit_pca(emb: np.ndarray, dim: int, seed: int = 0) -> faiss.PCAMatrix:
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(emb), min(len(emb), PCA_TRAIN_SAMPLE), replace=False))
+    pca = faiss.PCAMatrix(emb.shape[1], dim)
+    pca.train(np.ascontiguousarray(emb[rows], dtype=np.float32))
+    return pca
+
+def reduce_embeddings(emb: np.ndarray, pca: faiss.PCAMatrix) -> np.ndarray:
+    """Project normalized vectors with `pca` and re-normalize them (cosine in the reduced space)."""
+    out = np.empty((len(emb), pca.d_out), dtype=np.float32)
+    for start in range(0, len(emb), ADD_BATCH):
+        out[start:start + ADD_BATCH] = pca.apply_py(np.ascontiguousarray(emb[start:start + ADD_BATCH], dtype=np.float32))
+    faiss.normalize_L2(out)
+    return out
+
+def store_embeddings(emb: np.ndarray, out_dir: Path, dtype: str = EMBED_DTYPE, pca_dim: int = PCA_DIM) -> np.ndarray:
+    """Normalize `emb` in place, optionally PCA-reduce it, save it as `dtype` into `out_dir` and return it memory-mapped."""
+    faiss.normalize_L2(emb)
+    if pca_dim:
+        pca = fit_pca(emb, pca_dim)
+        faiss.write_VectorTransform(pca, str(out_dir / PCA_FILE))
+        emb = reduce_embeddings(emb, pca)
+    np.save(out_dir / EMBEDDINGS_FILE, emb.astype(dtype, copy=False))
+    return np.load(out_dir / EMBEDDINGS_FILE, mmap_mode="r")
+
+def load_pca(embed_dir: Path):
+    path = embed_dir / PCA_FILE
+    return faiss.read_VectorTransform(str(path)) if path.exists() else None
+
+def embedding_storage_report(emb: np.ndarray, k: int = 10, n_queries: int = 500, seed: int = 0) -> List[Dict[str, Any]]:
+    """Memory vs. recall@k (against float32 full-dimension exact search) of each storage option.
+
+    `emb` are the normalized float32 chunk embeddings; sampled chunks serve as queries.
+    """
+    n, d = emb.shape
+    rng = np.random.default_rng(seed)
+    q_rows = np.sort(rng.choice(n, min(n_queries, n), replace=False))
+
+    def search(vectors, queries):
+        index = faiss.IndexFlatIP(vectors.shape[1])
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+        _, I = index.search(queries, k + 1)
+        # the query chunk itself is always its own best match: drop it
+        return np.array([[i for i in row if i != q][:k] for row, q in zip(I, q_rows)])
+
+    truth = search(emb, emb[q_rows])
+    base_mb = n * d * 4 / 2 ** 20
+    report = []
+    for dim in [None] + [m for m in (d // 2, d // 4) if m >= 8]:
+        full = emb if dim is None else reduce_embeddings(emb, fit_pca(emb, dim, seed))
+        for dtype in ("float32", "float16"):
+            stored = full.astype(dtype).astype(np.float32)
+            mb = n * full.shape[1] * np.dtype(dtype).itemsize / 2 ** 20
+            report.append({"dtype": dtype, "dim": int(full.shape[1]), "mb": round(mb, 3),
+                           "saved_pct": round(100 * (1 - mb / base_mb), 1),
+                           f"recall@{k}": round(recall_at_k(search(stored, full[q_rows]), truth, k), 4)})
+    with open(STORAGE_REPORT_JSON, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[+] Embedding storage report ({n} vectors, saved to {STORAGE_REPORT_JSON}):")
+    for row in report:
+        print(f"    {row['dtype']:>7} dim={row['dim']:<4} {row['mb']:>9.2f} MB  saved {row['saved_pct']:5.1f}%  "
+              f"recall@{k}={row[f'recall@{k}']:.3f}")
+    return report
 
 # ---------------- Local generator (TF/PyTorch) ----------------
-print("[*] Preparing local generator:", LOCAL_GEN_MODEL)
-tokenizer = AutoTokenizer.from_pretrained(LOCAL_GEN_MODEL)
-gen_model = AutoModelForSeq2SeqLM.from_pretrained(LOCAL_GEN_MODEL)
-
 def generate_local(prompt: str, max_new_tokens:int=LOCAL_GEN_MAX_NEW_TOKENS) -> str:
     """Generate text locally with the seq2seq model. Works on CPU (may be slower)."""
+    tokenizer, gen_model = get_generator()
     # Tokenize & generate
     inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048)
     out = gen_model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
     text = tokenizer.decode(out[0], skip_special_tokens=True)
     return text
 
-# ---------------- FAISS functions ----------------
-def build_faiss_index(emb_matrix: np.ndarray) -> faiss.Index:
-    emb = emb_matrix.copy()
-    faiss.normalize_L2(emb)
-    d = emb.shape[1]
-    idx = faiss.IndexFlatIP(d)
-    idx.add(emb)
-    return idx
-
-def save_faiss_index(index: faiss.Index, path: Path):
-    faiss.write_index(index, str(path))
-
-def load_faiss_index(path: Path) -> faiss.Index:
-    return faiss.read_index(str(path))
+def generate_local_batch(prompts: List[str], max_new_tokens: int = LOCAL_GEN_MAX_NEW_TOKENS,
+                         batch_size: int = GEN_BATCH_SIZE) -> List[str]:
+    """generate_local for many prompts, `batch_size` padded prompts per generate() call.
+
+    Prompts are grouped by length so a batch pads to similar lengths. A failing batch
+    gets "ERROR: local generation: ..." answers, as single generations do.
+    """
+    tokenizer, gen_model = get_generator()
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+    answers = [None] * len(prompts)
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        try:
+            inputs = tokenizer([prompts[i] for i in rows], return_tensors="pt", padding=True,
+                               truncation=True, max_length=2048)
+            out = gen_model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+            texts = tokenizer.batch_decode(out, skip_special_tokens=True)
+        except Exception as e:
+            texts = [f"ERROR: local generation: {type(e).__name__}: {e}"] * len(rows)
+        for i, text in zip(rows, texts):
+            answers[i] = text
+    return answers
 
-# ---------------- Main pipeline ----------------
-def main_run():
-    # 1) Extract PDF text
+# ---------------- FAISS functions ----------------
+def build_faiss_index(emb_matrix: np.ndarray, index_type: str = INDEX_TYPE) -> Tuple[faiss.Index, Dict[str, Any]]:
+    """Build the search index; returns (index, params) where params holds the tuned search settings.
+
+    `emb_matrix` holds normalized vectors (e.g. embeddings.npy memory-mapped); it is
+    added in batches, so only one batch is ever converted to float32 in memory.
+    """
+    d = emb_matrix.shape[1]
+    if emb_matrix.dtype == np.float16:
+        idx = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    else:
+        idx = faiss.IndexFlatIP(d)
+    for start in range(0, len(emb_matrix), ADD_BATCH):
+        idx.add(np.ascontiguousarray(emb_matrix[start:start + ADD_BATCH], dtype=np.float32))
+    params = {"type": "flat", "ntotal": int(idx.ntotal), "dtype": str(emb_matrix.dtype), "dim": int(d)}
+    if index_type == "flat":
+        return idx, params
+    # the flat index serves as ground truth for tuning
+    index, ann_params = build_ann_index(index_type, emb_matrix, np.arange(len(emb_matrix)), idx,
+                                        target_recall=TARGET_RECALL)
+    return index, dict(ann_params, dtype=params["dtype"], dim=params["dim"])
+
+def save_faiss_index(index: faiss.Index, index_dir: Path, params: Dict[str, Any] = None):
+    faiss.write_index(index, str(index_dir / FAISS_INDEX_FILE))
+    save_params(params or {"type": "flat", "ntotal": int(index.ntotal)}, index_dir / FAISS_PARAMS_FILE)
+
+def load_faiss_index(index_dir: Path) -> faiss.Index:
+    return apply_search_params(faiss.read_index(str(index_dir / FAISS_INDEX_FILE)),
+                               load_params(index_dir / FAISS_PARAMS_FILE))
+
+# ---------------- Staged artifact cache ----------------
+# Each stage (extract -> chunk -> embed -> index, and bm25 over the chunks) writes its output
+# into STAGES_DIR/<stage>/<fingerprint>/, the fingerprint hashing the stage's parameters and
+# the fingerprint of its input (the PDF's content for extract). A stage whose output exists
+# is reused, so a changed PDF or parameter reruns exactly the stages downstream of it, and
+# a stale index can't be served. Outputs of other configs stay on disk: switching back to
+# a chunk config (or index type) built before costs nothing.
+def fingerprint(**inputs) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def run_stage(stage: str, inputs: Dict[str, Any], compute) -> Path:
+    """Output directory of `stage` for `inputs`; `compute(out_dir)` fills it unless it is up to date.
+
+    The output is written to a temporary directory and renamed into place once complete,
+    so an interrupted build never leaves a half-written stage behind.
+    """
+    fp = fingerprint(stage=stage, **inputs)
+    out_dir = STAGES_DIR / stage / fp
+    if (out_dir / STAGE_FILE).exists():
+        print(f"[=] {stage}: up to date ({fp})")
+        return out_dir
+    print(f"[*] {stage}: computing ({fp})...")
+    tmp_dir = out_dir.with_name(fp + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    info = compute(tmp_dir) or {}
+    with open(tmp_dir / STAGE_FILE, "w", encoding="utf8") as f:
+        json.dump({"stage": stage, "fingerprint": fp, "inputs": inputs, "created": time.time(), **info}, f, indent=2)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+def read_current() -> Dict[str, Any]:
+    if not CURRENT_JSON.exists():
+        return {"pdf_sha256": None, "chunk_config": None, "configs": {}}
+    with open(CURRENT_JSON, encoding="utf8") as f:
+        return json.load(f)
+
+def write_current(current: Dict[str, Any]):
+    tmp = CURRENT_JSON.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf8") as f:
+        json.dump(current, f, indent=2)
+    os.replace(tmp, CURRENT_JSON)
+
+def prune_stages() -> int:
+    """Delete stage outputs no config in current.json uses; returns how many were removed."""
+    used = {Path(p).name for stages in read_current()["configs"].values() for p in stages.values()}
+    removed = 0
+    for stage_dir in STAGES_DIR.glob("*/*"):
+        if stage_dir.is_dir() and stage_dir.name not in used:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            removed += 1
+    return removed
+
+# ---------------- Build ----------------
+def check_embedded(chunk_config: str):
+    if chunk_config not in EMBEDDED_CONFIGS:
+        size = CHUNK_CONFIGS[chunk_config][0] if chunk_config in CHUNK_CONFIGS else None
+        raise ValueError(f"Chunk config {chunk_config!r} ({size} tokens) can't be embedded: {LOCAL_EMBED_MODEL} "
+                         f"reads at most {EMBED_MAX_TOKENS} tokens. Use one of {EMBEDDED_CONFIGS}.")
+
+def build(chunk_config: str = CHUNK_CONFIG) -> Dict[str, Any]:
+    """Bring every stage for `chunk_config` up to date and make it current; returns its index resources."""
+    check_embedded(chunk_config)
     if not PDF_PATH.exists():
         raise FileNotFoundError(f"Put your PDF at: {PDF_PATH.resolve()} and re-run.")
-    print("[*] Extracting PDF:", PDF_PATH)
-    extracted = extract_text_pdfplumber(str(PDF_PATH))
-    full_text = extracted["full_text"]
-    print(f"[+] Extracted {len(full_text)} characters across {len(extracted['page_index'])} pages")
+    pdf_sha256 = file_sha256(PDF_PATH)
 
-    # Save raw extraction
-    with open(CHUNKS_JSON, "w", encoding="utf8") as f:
-        json.dump(extracted, f, ensure_ascii=False)
-
-    # 2) Chunking (small and large)
-    print("[*] Chunking text (small & large)...")
-    chunks_small = chunk_text_chars(full_text, chunk_size=SMALL_CHUNK_SIZE, overlap=SMALL_CHUNK_OVERLAP)
-    chunks_large = chunk_text_chars(full_text, chunk_size=LARGE_CHUNK_SIZE, overlap=LARGE_CHUNK_OVERLAP)
-    print(f"[+] small: {len(chunks_small)} chunks, large: {len(chunks_large)} chunks")
-
-    with open(CHUNKS_SPLIT_JSON, "w", encoding="utf8") as f:
-        json.dump({"small": chunks_small, "large": chunks_large}, f, ensure_ascii=False)
-
-    # Choose small by default for precision
-    chunks = chunks_small
-    with open(CHUNKS_JSON, "w", encoding="utf8") as f:
-        json.dump({"used": "small", "chunks": chunks}, f, ensure_ascii=False)
+    # 1) Extract PDF text
+    def extract(out_dir):
+        print("[*] Extracting PDF:", PDF_PATH)
+        extracted = extract_text_pdfplumber(str(PDF_PATH))
+        print(f"[+] Extracted {len(extracted['full_text'])} characters across {len(extracted['page_index'])} pages")
+        with open(out_dir / EXTRACTED_FILE, "w", encoding="utf8") as f:
+            json.dump(extracted, f, ensure_ascii=False)
+    extract_dir = run_stage("extract", {"pdf_sha256": pdf_sha256, "backend": "pdfplumber"}, extract)
+
+    # 2) Chunking: the selected config, plus the parent chunks its hits are widened to
+    def chunk_stage(config):
+        chunk_size, overlap = CHUNK_CONFIGS[config]
+        def chunk(out_dir):
+            with open(extract_dir / EXTRACTED_FILE, encoding="utf8") as f:
+                full_text = json.load(f)["full_text"]
+            spans = chunk_spans_tokens(full_text, chunk_size=chunk_size, overlap=overlap)
+            print(f"[+] {config}: {len(spans)} chunks")
+            with open(out_dir / CHUNKS_FILE, "w", encoding="utf8") as f:
+                json.dump({"used": config, "chunks": [full_text[s:e] for s, e in spans], "spans": spans},
+                          f, ensure_ascii=False)
+            return {"n_chunks": len(spans)}
+        return run_stage("chunk", {"extract": extract_dir.name, "tokenizer": LOCAL_EMBED_MODEL,
+                                   "chunk_size": chunk_size, "overlap": overlap, "spans": True}, chunk)
+    chunk_dir = chunk_stage(chunk_config)
+    parent_config = PARENT_CHUNK_CONFIG.get(chunk_config)
+    parent_dir = chunk_stage(parent_config) if parent_config else None
 
     # 3) Embeddings (local)
-    if not Path(EMBEDDINGS_NPY).exists():
+    # cheap when the chunks were embedded before: vectors come from the embedding cache
+    def embed(out_dir):
+        with open(chunk_dir / CHUNKS_FILE, encoding="utf8") as f:
+            chunks = json.load(f)["chunks"]
         print("[*] Computing local embeddings for chunks...")
         emb_matrix = compute_local_embeddings(chunks, batch_size=32)
-        np.save(EMBEDDINGS_NPY, emb_matrix)
-        print(f"[+] Saved embeddings.npy shape {emb_matrix.shape}")
-    else:
-        emb_matrix = np.load(EMBEDDINGS_NPY)
-        print(f"[+] Loaded embeddings.npy shape {emb_matrix.shape}")
-
-    # 4) Build/load FAISS
-    if not FAISS_INDEX_PATH.exists():
-        print("[*] Building FAISS index...")
-        index = build_faiss_index(emb_matrix)
-        save_faiss_index(index, FAISS_INDEX_PATH)
-        print(f"[+] Saved FAISS index to {FAISS_INDEX_PATH}")
-    else:
-        index = load_faiss_index(FAISS_INDEX_PATH)
-        print(f"[+] Loaded FAISS index (ntotal={index.ntotal})")
-
-    # Retrieval helpers using local embeddings for queries
-    def embed_query_local(query: str) -> np.ndarray:
-        qv = embed_model.encode([query], convert_to_numpy=True).astype(np.float32)
-        faiss.normalize_L2(qv)
-        return qv
-
-    def retrieve_topk_local(query: str, k: int = TOP_K):
-        qv = embed_query_local(query)
-        D, I = index.search(qv, k)
-        hits = []
-        for idx_i, score in zip(I[0], D[0]):
-            if idx_i < 0 or idx_i >= len(chunks): 
-                continue
-            hits.append({"id": int(idx_i), "score": float(score), "chunk": chunks[int(idx_i)]})
-        return hits
-
-    # 5) RAG & Non-RAG with local generator
-    def build_context_prompt_local(hits, question, per_chunk_chars=1500):
-        parts = []
+        if STORAGE_REPORT:
+            faiss.normalize_L2(emb_matrix)
+            embedding_storage_report(emb_matrix)
+        # normalized in place, then only the (smaller) memory-mapped copy on disk is used
+        emb_matrix = store_embeddings(emb_matrix, out_dir, EMBED_DTYPE, PCA_DIM)
+        cache = get_embed_cache()
+        print(f"[+] Saved embeddings.npy shape {emb_matrix.shape} {emb_matrix.dtype}" +
+              (f" (cache: {cache.stats()})" if cache is not None else ""))
+        return {"shape": list(emb_matrix.shape), "dtype": str(emb_matrix.dtype)}
+    embed_dir = run_stage("embed", {"chunk": chunk_dir.name, "model": LOCAL_EMBED_MODEL, "dtype": EMBED_DTYPE,
+                                    "pca_dim": PCA_DIM, "pca_train_sample": PCA_TRAIN_SAMPLE}, embed)
+
+    # 4) FAISS
+    def index(out_dir):
+        print(f"[*] Building FAISS index ({INDEX_TYPE})...")
+        faiss_index, index_params = build_faiss_index(np.load(embed_dir / EMBEDDINGS_FILE, mmap_mode="r"), INDEX_TYPE)
+        save_faiss_index(faiss_index, out_dir, index_params)
+        return {"ntotal": int(faiss_index.ntotal)}
+    index_inputs = {"embed": embed_dir.name, "index_type": INDEX_TYPE}
+    if INDEX_TYPE != "flat":
+        index_inputs["target_recall"] = TARGET_RECALL
+    index_dir = run_stage("index", index_inputs, index)
+
+    # 4b) BM25 over the same chunks (ids = chunk positions)
+    def lexical(out_dir):
+        with open(chunk_dir / CHUNKS_FILE, encoding="utf8") as f:
+            chunks = json.load(f)["chunks"]
+        bm25.build_bm25(enumerate(chunks), out_dir / BM25_SUBDIR)
+    bm25_dir = run_stage("bm25", {"chunk": chunk_dir.name}, lexical)
+
+    current = read_current()
+    if current["pdf_sha256"] != pdf_sha256:
+        current = {"pdf_sha256": pdf_sha256, "configs": {}}   # other configs were built from an older PDF
+    current["chunk_config"] = chunk_config
+    current["configs"][chunk_config] = {name: str(d.relative_to(PROJECT_DIR)) for name, d in
+                                        [("extract", extract_dir), ("chunk", chunk_dir), ("embed", embed_dir),
+                                         ("index", index_dir), ("bm25", bm25_dir), ("parent_chunk", parent_dir)]
+                                        if d is not None}
+    write_current(current)
+    print(f"[+] Current config: {chunk_config} ({CURRENT_JSON})")
+    _index.clear()
+    return load_index(chunk_config)
+
+# ---------------- Index resources ----------------
+_index: Dict[str, Any] = {}   # chunks, FAISS index, BM25 index and PCA of one built config
+
+def load_index(chunk_config: str = None) -> Dict[str, Any]:
+    """What build() produced for `chunk_config` (default: the current one), read from disk once per process."""
+    if not _index or (chunk_config and _index["config"] != chunk_config):
+        current = read_current()
+        chunk_config = chunk_config or current["chunk_config"]
+        if chunk_config:
+            check_embedded(chunk_config)
+        stages = current["configs"].get(chunk_config) if chunk_config else None
+        if stages is None:
+            flag = f" --chunks {chunk_config}" if chunk_config else ""
+            raise FileNotFoundError(f"No{flag} index in {PROJECT_DIR}: run `python rag_system.py build{flag}` first.")
+        with startup_stage("load_index"):
+            with open(PROJECT_DIR / stages["chunk"] / CHUNKS_FILE, encoding="utf8") as f:
+                chunked = json.load(f)
+            if "spans" not in chunked:
+                raise FileNotFoundError(f"The {chunk_config} index predates chunk spans: run "
+                                        f"`python rag_system.py build --chunks {chunk_config}` again.")
+            with open(PROJECT_DIR / stages["extract"] / EXTRACTED_FILE, encoding="utf8") as f:
+                full_text = json.load(f)["full_text"]
+            spans = np.array(chunked["spans"], dtype=np.int64).reshape(-1, 2)
+            parent_spans = None
+            if "parent_chunk" in stages:
+                with open(PROJECT_DIR / stages["parent_chunk"] / CHUNKS_FILE, encoding="utf8") as f:
+                    parent_spans = np.array(json.load(f)["spans"], dtype=np.int64).reshape(-1, 2)
+            _index.clear()
+            _index.update(config=chunk_config, stages=stages, chunks=chunked["chunks"],
+                          index=load_faiss_index(PROJECT_DIR / stages["index"]),
+                          lexical=bm25.BM25Index(PROJECT_DIR / stages["bm25"] / BM25_SUBDIR),
+                          pca=load_pca(PROJECT_DIR / stages["embed"]), full_text=full_text, spans=spans,
+                          parent_spans=parent_spans,
+                          parent_of=parent_of_chunks(spans, parent_spans) if parent_spans is not None else None)
+    return _index
+
+# ---------------- Retrieval & answering ----------------
+# Retrieval helpers using local embeddings for queries
+def embed_query_local(query: str) -> np.ndarray:
+    qv = get_embed_model().encode([query], convert_to_numpy=True).astype(np.float32)
+    faiss.normalize_L2(qv)
+    pca = load_index()["pca"]
+    if pca is not None:
+        # same reduction the chunk vectors went through at build time
+        qv = reduce_embeddings(qv, pca)
+    return qv
+
+def retrieve_topk_local(query: str, k: int = TOP_K, mode: str = RETRIEVAL_MODE):
+    res = load_index()
+    chunks = res["chunks"]
+    depth = k * HYBRID_DEPTH if mode == "hybrid" else k
+    if mode != "lexical":
+        D, I = res["index"].search(embed_query_local(query), depth)
+        ranked = [(int(i), float(s)) for i, s in zip(I[0], D[0]) if i >= 0]
+    if mode != "dense":
+        lex_ids, lex_scores = res["lexical"].search(query, depth)
+        lexical = list(zip(lex_ids.tolist(), lex_scores.tolist()))
+    if mode == "lexical":
+        ranked = lexical
+    elif mode == "hybrid":
+        ranked = bm25.rrf_fuse([[i for i, _ in ranked], [i for i, _ in lexical]], k)
+    hits = []
+    for idx_i, score in ranked[:k]:
+        if idx_i < 0 or idx_i >= len(chunks):
+            continue
+        hits.append({"id": int(idx_i), "score": float(score), "chunk": chunks[int(idx_i)]})
+    return hits
+
+# Small-to-big context assembly
+def parent_of_chunks(spans: np.ndarray, parent_spans: np.ndarray) -> np.ndarray:
+    """Index of the parent chunk overlapping each chunk the most (both span lists run in text order)."""
+    starts, ends = parent_spans[:, 0], parent_spans[:, 1]
+    parents = np.empty(len(spans), dtype=np.int64)
+    for i, (s, e) in enumerate(spans):
+        lo = min(int(np.searchsorted(ends, s, side="right")), len(parent_spans) - 1)
+        hi = max(int(np.searchsorted(starts, e, side="left")), lo + 1)
+        cand = np.arange(lo, hi)
+        parents[i] = cand[np.argmax(np.minimum(ends[cand], e) - np.maximum(starts[cand], s))]
+    return parents
+
+def merge_ranges(ranges: List[List[Any]]) -> List[List[Any]]:
+    """Union overlapping [start, end, chunk ids] ranges, keeping the order of first appearance (rank order)."""
+    merged: List[List[Any]] = []
+    for s, e, ids in ranges:
+        for m in merged:
+            if s <= m[1] and m[0] <= e:
+                m[0], m[1] = min(m[0], s), max(m[1], e)
+                m[2] = m[2] + [i for i in ids if i not in m[2]]
+                break
+        else:
+            merged.append([s, e, list(ids)])
+    # a widened range can bridge two earlier ones
+    return merged if len(merged) == len(ranges) else merge_ranges(merged)
+
+def assemble_context(hits, res: Dict[str, Any], expansion: str = CONTEXT_EXPANSION,
+                     budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[List[List[Any]], List[int]]:
+    """([start, end, hit chunk ids] ranges of the full text to put in the prompt, ids of the hits placed).
+
+    The hits themselves come first (the best one always), then each hit in rank order is widened
+    to its parent chunk or its neighbours while the whole context stays within `budget` tokens.
+    Overlapping ranges are merged, so no text is repeated; hits that do not fit are left out.
+    """
+    tokenizer = get_generator()[0]
+    full_text, spans = res["full_text"], res["spans"]
+    counted: Dict[Tuple[int, int], int] = {}
+
+    def tokens(ranges):
+        for s, e, _ in ranges:
+            if (s, e) not in counted:
+                counted[(s, e)] = len(tokenizer(full_text[s:e], add_special_tokens=False, verbose=False)["input_ids"])
+        return sum(counted[(s, e)] for s, e, _ in ranges)
+
+    ranges: List[List[Any]] = []
+    placed = []
+    for h in hits:
+        trial = merge_ranges(ranges + [[int(spans[h["id"]][0]), int(spans[h["id"]][1]), [h["id"]]]])
+        if not ranges or tokens(trial) <= budget:
+            ranges = trial
+            placed.append(h["id"])
+    for i in placed:
+        s, e = int(spans[i][0]), int(spans[i][1])
+        if expansion == "parent" and res["parent_of"] is not None:
+            ps, pe = res["parent_spans"][res["parent_of"][i]]
+            steps = [(min(s, int(ps)), max(e, int(pe)))]
+        elif expansion == "neighbors":
+            steps = [(int(spans[max(i - w, 0)][0]), int(spans[min(i + w, len(spans) - 1)][1]))
+                     for w in range(1, NEIGHBOR_CHUNKS + 1)]
+        else:
+            steps = []
+        for step_s, step_e in steps:
+            trial = merge_ranges(ranges + [[step_s, step_e, []]])
+            if tokens(trial) > budget:
+                break
+            ranges = trial
+    return ranges, placed
+
+# 5) RAG & Non-RAG with local generator
+def build_context_prompt_local(hits, question, per_chunk_chars=1500, expansion: str = CONTEXT_EXPANSION):
+    """(prompt, the hits that made it into the context)."""
+    parts = []
+    if expansion == "none":
         for h in hits:
             txt = h["chunk"][:per_chunk_chars]
             parts.append(f"[chunk_id:{h['id']}]\n{txt}")
-        context = "\n\n---\n".join(parts)
-        prompt = (
-            "You are a helpful assistant. Use ONLY the context below to answer the question. "
-            "If the answer is not in the context, say 'Not enough information in the provided context.'\n\n"
-            f"Context:\n{context}\n\nQuestion: {question}\n\nAnswer concisely and cite chunk ids."
-        )
-        return prompt
-
-    def rag_answer_local(question: str, topk: int = 3):
-        hits = retrieve_topk_local(question, k=topk)
-        if not hits:
-            return {"answer": "ERROR: no retrieval hits", "hits": []}
-        prompt = build_context_prompt_local(hits, question)
-        try:
-            answer = generate_local(prompt)
-            return {"answer": answer, "hits": hits}
-        except Exception as e:
-            return {"answer": f"ERROR: local generation: {type(e).__name__}: {e}", "hits": hits}
-
-    def non_rag_local(question: str):
-        try:
-            answer = generate_local(question)
-            return answer
-        except Exception as e:
-            return f"ERROR: local generation: {type(e).__name__}: {e}"
-
-    # 6) Run sample questions and save responses
-    QUESTIONS = [
-        "Summarize the paper's main contribution in two sentences.",
-        "What dataset(s) are used and what preprocessing steps are mentioned?",
-        "Describe the model/architecture and key hyperparameters.",
-        "What are the main experimental results and metrics reported?",
-        "What limitations or future work does the paper mention?"
-    ]
-
-    results = []
+    else:
+        res = load_index()
+        ranges, placed = assemble_context(hits, res, expansion)
+        for s, e, ids in ranges:
+            parts.append(f"[chunk_id:{','.join(map(str, ids))}]\n{res['full_text'][s:e].strip()}")
+        hits = [h for h in hits if h["id"] in placed]
+    context = "\n\n---\n".join(parts)
+    prompt = (
+        "You are a helpful assistant. Use ONLY the context below to answer the question. "
+        "If the answer is not in the context, say 'Not enough information in the provided context.'\n\n"
+        f"Context:\n{context}\n\nQuestion: {question}\n\nAnswer concisely and cite chunk ids."
+    )
+    return prompt, hits
+
+def rag_answer_local(question: str, topk: int = 3, mode: str = RETRIEVAL_MODE):
+    hits = retrieve_topk_local(question, k=topk, mode=mode)
+    if not hits:
+        return {"answer": "ERROR: no retrieval hits", "hits": []}
+    prompt, hits = build_context_prompt_local(hits, question)
+    try:
+        answer = generate_local(prompt)
+        return {"answer": answer, "hits": hits}
+    except Exception as e:
+        return {"answer": f"ERROR: local generation: {type(e).__name__}: {e}", "hits": hits}
+
+def non_rag_local(question: str):
+    try:
+        answer = generate_local(question)
+        return answer
+    except Exception as e:
+        return f"ERROR: local generation: {type(e).__name__}: {e}"
+
+def answer_question(question: str, topk: int = 3, mode: str = RETRIEVAL_MODE, baseline: bool = True) -> Dict[str, Any]:
+    """RAG answer (and the non-RAG baseline unless `baseline` is False) in the responses.json format."""
+    first = "first_answer" not in STARTUP
+    start = time.perf_counter()
+    r = rag_answer_local(question, topk=topk, mode=mode)
+    result = {
+        "question": question,
+        "rag_answer": r["answer"],
+        "rag_hits": r["hits"],
+        "non_rag_answer": non_rag_local(question) if baseline else None
+    }
+    if first:
+        STARTUP["first_answer"] = time.perf_counter() - start
+    return result
+
+# 6) Run sample questions and save responses
+QUESTIONS = [
+    "Summarize the paper's main contribution in two sentences.",
+    "What dataset(s) are used and what preprocessing steps are mentioned?",
+    "Describe the model/architecture and key hyperparameters.",
+    "What are the main experimental results and metrics reported?",
+    "What limitations or future work does the paper mention?"
+]
+
+def read_jsonl(path: Path) -> List[Dict[str, Any]]:
+    """Rows of a JSONL file; a last line cut off by an interrupted run is dropped from the file."""
+    if not path.exists():
+        return []
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    return [json.loads(line) for line in data.decode("utf8").splitlines() if line.strip()]
+
+def evaluate(questions: List[str], topk: int = 3, mode: str = RETRIEVAL_MODE, batch_size: int = GEN_BATCH_SIZE,
+             out_path: Path = RESPONSES_JSONL, resume: bool = True) -> List[Dict[str, Any]]:
+    """RAG and non-RAG answers to `questions`, generated together `batch_size` prompts at a time.
+
+    Every group of `batch_size` questions is appended to the JSONL file `out_path` as soon as
+    it is answered. Rows carry a run key (index stages, k, mode, context, generator); with `resume`,
+    questions this run already answered there are skipped, so an interrupted run continues
+    where it stopped. Returns the rows in question order.
+    """
+    res = load_index()
+    run = fingerprint(stages=res["stages"], k=topk, mode=mode, model=LOCAL_GEN_MODEL,
+                      max_new_tokens=LOCAL_GEN_MAX_NEW_TOKENS, context=[CONTEXT_EXPANSION, CONTEXT_TOKEN_BUDGET])
+    done = {r["question"]: r for r in read_jsonl(out_path) if r.get("run") == run} if resume else {}
+    unique = list(dict.fromkeys(questions))
+    todo = [q for q in unique if q not in done]
+    repeated = f", {len(questions) - len(unique)} repeated" if len(unique) < len(questions) else ""
+    print(f"\n[*] Evaluating {len(todo)} questions ({len(unique) - len(todo)} already in {out_path}{repeated}), "
+          f"{batch_size} prompts per batch...")
+    with open(out_path, "a", encoding="utf8") as f:
+        for start in range(0, len(todo), batch_size):
+            group_start = time.perf_counter()
+            group = todo[start:start + batch_size]
+            hits = [retrieve_topk_local(q, k=topk, mode=mode) for q in group]
+            with_hits = [i for i, h in enumerate(hits) if h]
+            # the RAG prompts and the bare questions (non-RAG) go through the same batches
+            prompts = {i: build_context_prompt_local(hits[i], group[i]) for i in with_hits}
+            answers = generate_local_batch([prompts[i][0] for i in with_hits] + group, batch_size=batch_size)
+            rag = dict(zip(with_hits, answers))
+            for i, q in enumerate(group):
+                row = {"run": run, "question": q, "rag_answer": rag.get(i, "ERROR: no retrieval hits"),
+                       "rag_hits": prompts[i][1] if i in prompts else [], "non_rag_answer": answers[len(with_hits) + i]}
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                done[q] = row
+            f.flush()
+            if "first_batch" not in STARTUP:
+                STARTUP["first_batch"] = time.perf_counter() - group_start
+            print(f"[+] {start + len(group)}/{len(todo)} answered ({time.perf_counter() - group_start:.1f}s)")
+    return [done[q] for q in questions]
+
+def run_questions(questions: List[str] = QUESTIONS, topk: int = 3, mode: str = RETRIEVAL_MODE,
+                  batch_size: int = GEN_BATCH_SIZE, resume: bool = True) -> List[Dict[str, Any]]:
     print("\n[*] Running RAG vs Non-RAG tests (local generator)...")
-    for q in QUESTIONS:
-        print("\n---\nQuestion:", q)
-        r = rag_answer_local(q, topk=3)
-        n = non_rag_local(q)
-        results.append({
-            "question": q,
-            "rag_answer": r["answer"],
-            "rag_hits": r["hits"],
-            "non_rag_answer": n
-        })
-        print("RAG preview:", (r["answer"] or "")[:400])
-        print("Non-RAG preview:", (n or "")[:400])
+    results = [{k: v for k, v in r.items() if k != "run"}
+               for r in evaluate(questions, topk=topk, mode=mode, batch_size=batch_size, resume=resume)]
+    for r in results:
+        print("\n---\nQuestion:", r["question"])
+        print("RAG preview:", (r["rag_answer"] or "")[:400])
+        print("Non-RAG preview:", (r["non_rag_answer"] or "")[:400])
 
     with open(RESPONSES_JSON, "w", encoding="utf8") as f:
         json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+# 8) Interactive mode
+def print_answer(r: Dict[str, Any]):
+    print("\n--- RAG Answer ---\n", r["rag_answer"])
+    print("\nRAG hits (preview):")
+    for h in r["rag_hits"]:
+        preview = h["chunk"][:300].replace("\n", " ")
+        print(f" id:{h['id']} score:{h['score']:.3f} preview: {preview}")
+    if r["non_rag_answer"] is not None:
+        print("\n--- Non-RAG Answer ---\n", r["non_rag_answer"])
+
+def interactive_mode(topk: int = 3, mode: str = RETRIEVAL_MODE, baseline: bool = True, report: str = None):
+    """Question loop; `report` names the path whose startup is reported after the first answer."""
+    print("\nInteractive mode: ask questions (type 'exit' to quit).")
+    while True:
+        q = input("\nQuestion> ").strip()
+        if not q or q.lower() in ("exit", "quit"): break
+        print_answer(answer_question(q, topk=topk, mode=mode, baseline=baseline))
+        if report:
+            startup_report(report)
+            report = None
+
+# ---------------- HTTP server ----------------
+_answer_lock = threading.Lock()   # one CPU model: requests are answered one at a time
+
+class AskHandler(BaseHTTPRequestHandler):
+    """POST /ask {"question": "...", "k": 3, "mode": "hybrid", "baseline": true}; GET /health."""
+    defaults = {"k": 3, "mode": RETRIEVAL_MODE, "baseline": True}
+
+    def send_json(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": "not found"})
+        res = load_index()
+        self.send_json(200, {"status": "ok", "chunk_config": res["config"], "chunks": len(res["chunks"]),
+                             "startup": {name: round(sec, 3) for name, sec in STARTUP.items()}})
+
+    def do_POST(self):
+        if self.path != "/ask":
+            return self.send_json(404, {"error": "not found"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            question = str(body.get("question", "")).strip()
+            k = int(body.get("k", self.defaults["k"]))
+            mode = body.get("mode", self.defaults["mode"])
+        except (ValueError, AttributeError):
+            return self.send_json(400, {"error": "expected a JSON object"})
+        if not question:
+            return self.send_json(400, {"error": "question is required"})
+        if mode not in ("dense", "lexical", "hybrid") or not 1 <= k <= 20:
+            return self.send_json(400, {"error": "mode must be dense, lexical or hybrid and k in 1..20"})
+        with _answer_lock:
+            result = answer_question(question, topk=k, mode=mode,
+                                     baseline=bool(body.get("baseline", self.defaults["baseline"])))
+        self.send_json(200, result)
+
+def serve(host: str = "127.0.0.1", port: int = 8000, chunk_config: str = None):
+    # a server pays the cold start once, before it accepts requests
+    load_index(chunk_config)
+    get_embed_model()
+    get_generator()
+    startup_report("serve")
+    server = ThreadingHTTPServer((host, port), AskHandler)
+    print(f"[*] Serving on http://{host}:{port} (POST /ask, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# ---------------- Main pipeline ----------------
+def main_run():
+    """The original end-to-end run: build, answer QUESTIONS, then interactive mode."""
+    build()
+    run_questions()
 
     print("\nAll done. Files created/updated:")
-    print(" -", CHUNKS_SPLIT_JSON)
-    print(" -", EMBEDDINGS_NPY)
-    print(" -", FAISS_INDEX_PATH)
+    for stage, path in read_current()["configs"][CHUNK_CONFIG].items():
+        print(" -", PROJECT_DIR / path, f"({stage})")
+    print(" -", RESPONSES_JSONL)
     print(" -", RESPONSES_JSON)
     print(" -", COMPARISON_MD)
 
-    # 8) Offer interactive mode
-    def interactive_mode():
-        print("\nInteractive mode: ask questions (type 'exit' to quit).")
-        while True:
-            q = input("\nQuestion> ").strip()
-            if not q or q.lower() in ("exit", "quit"): break
-            r = rag_answer_local(q, topk=3)
-            print("\n--- RAG Answer ---\n", r["answer"])
-            print("\nRAG hits (preview):")
-            for h in r["hits"]:
-                print(f" id:{h['id']} score:{h['score']:.3f} preview: {h['chunk'][:300].replace('\\n',' ')}")
-            print("\n--- Non-RAG Answer ---\n", non_rag_local(q))
-
     # Launch interactive prompt for further testing
     interactive_mode()
 
+def read_questions(path: str) -> List[str]:
+    """One question per line (blank lines skipped), or a JSON list of strings."""
+    with open(path, encoding="utf8") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return [str(q) for q in json.loads(text)]
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Local RAG vs Non-RAG over one PDF "
+                                                 "(no subcommand: build, run QUESTIONS, then interactive mode)")
+    answering = argparse.ArgumentParser(add_help=False)
+    answering.add_argument("--k", type=int, default=3, help="chunks retrieved per question")
+    answering.add_argument("--mode", choices=("dense", "lexical", "hybrid"), default=RETRIEVAL_MODE,
+                           help="retrieval mode")
+    answering.add_argument("--chunks", choices=EMBEDDED_CONFIGS, default=None,
+                           help="built chunk config to search (default: the last one built)")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("build", help="bring the extract/chunk/embed/index stages of PDF_PATH up to date")
+    p.add_argument("--chunks", choices=EMBEDDED_CONFIGS, default=CHUNK_CONFIG, help="chunk config to build")
+    p.add_argument("--prune", action="store_true", help="delete stage outputs no built config uses")
+    p = sub.add_parser("query", parents=[answering], help="answer one question (interactive loop without one)")
+    p.add_argument("question", nargs="?", help="question to answer")
+    p.add_argument("--no-baseline", action="store_true", help="skip the non-RAG answer")
+    p = sub.add_parser("batch", parents=[answering], help="answer a question set into responses.jsonl / responses.json")
+    p.add_argument("--questions", default=None, help="file with one question per line or a JSON list (default: QUESTIONS)")
+    p.add_argument("--batch-size", type=int, default=GEN_BATCH_SIZE, help="prompts per generate() call")
+    p.add_argument("--no-resume", action="store_true", help="answer every question again, even if already in responses.jsonl")
+    p = sub.add_parser("serve", parents=[answering], help="answer questions over HTTP")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        main_run()
+    elif args.command == "build":
+        build(args.chunks)
+        if args.prune:
+            print(f"[+] Pruned {prune_stages()} unused stage outputs")
+        startup_report("build")
+    elif args.command == "query":
+        load_index(args.chunks)
+        if args.question:
+            print_answer(answer_question(args.question, topk=args.k, mode=args.mode, baseline=not args.no_baseline))
+            startup_report("query")
+        else:
+            interactive_mode(args.k, args.mode, baseline=not args.no_baseline, report="query")
+    elif args.command == "batch":
+        load_index(args.chunks)
+        questions = read_questions(args.questions) if args.questions else QUESTIONS
+        run_questions(questions, topk=args.k, mode=args.mode, batch_size=args.batch_size, resume=not args.no_resume)
+        print(f"\n[+] {len(questions)} answers saved to {RESPONSES_JSONL} and {RESPONSES_JSON}")
+        startup_report("batch")
+    elif args.command == "serve":
+        AskHandler.defaults = {"k": args.k, "mode": args.mode, "baseline": True}
+        serve(args.host, args.port, args.chunks)
+
 if __name__ == "__main__":
-    main_run()
+    main()
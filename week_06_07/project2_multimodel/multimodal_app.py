@@ -1,7 +1,13 @@
+import sys
 from pathlib import Path
 import textwrap
 from gemini_utils import image_caption, document_ocr, chart_analysis, embed_texts, generate_text
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # repo root, for rag_common
+from rag_common import pdf_extract
+from rag_common.chunking import chunk_text, load_tokenizer
+from rag_common.embed_cache import EmbeddingCache, encode_cached
+
 BASE = Path(__file__).resolve().parent
 IMAGES_DIR = BASE / "images"
 OUTPUT_DIR = BASE / "outputs"
@@ -73,31 +79,18 @@ def extract_text_from_pdf(pdf_path):
     """
     Try pdfplumber first (better); if not available fall back to PyPDF2.
     Returns a single string with all page text concatenated.
+    Pages are extracted in parallel and cached on disk (rag_common.pdf_extract).
     """
-    pdf_path = Path(pdf_path)
-    text = ""
-    # try pdfplumber
-    try:
-        import pdfplumber
-        with pdfplumber.open(str(pdf_path)) as pdf:
-            for p in pdf.pages:
-                page_text = p.extract_text() or ""
-                text += "\n\n" + page_text
-        print("[long-context] Extracted text using pdfplumber.")
-        return text.strip()
-    except Exception:
-        # fall back to PyPDF2
+    error = None
+    for backend, name in (("pdfplumber", "pdfplumber"), ("pypdf2", "PyPDF2 fallback")):
         try:
-            from PyPDF2 import PdfReader
-            with open(pdf_path, "rb") as f:
-                reader = PdfReader(f)
-                for page in reader.pages:
-                    text += "\n\n" + (page.extract_text() or "")
-            print("[long-context] Extracted text using PyPDF2 fallback.")
-            return text.strip()
+            doc = pdf_extract.extract_document(pdf_path, backend=backend, header="\n\n")
+            print(f"[long-context] Extracted text using {name}.")
+            return doc["full_text"].strip()
         except Exception as e:
-            print("[long-context] PDF text extraction failed:", e)
-            return ""
+            error = e
+    print("[long-context] PDF text extraction failed:", error)
+    return ""
 
 def save_text_for_reuse(txt, out_path=LONG_TEXT_TXT):
     try:
@@ -135,14 +128,13 @@ def run_long_context():
 
     # --- Optional: tiny local RAG demo (only if dependencies installed) ---
     try:
-        # chunk a little
-        chunk_chars = 3000
-        overlap = 300
-        chunks = []
-        i = 0
-        while i < len(txt):
-            chunks.append(txt[i:i+chunk_chars])
-            i = max(0, i + chunk_chars - overlap)
+        # sentence-aligned chunks sized in the embedder's tokens (MiniLM embeds at most 256)
+        try:
+            chunks = chunk_text(txt, load_tokenizer("all-MiniLM-L6-v2"), max_tokens=250, overlap_tokens=30)
+        except Exception:
+            # no tokenizer available: fixed character windows
+            chunk_chars, overlap = 3000, 300
+            chunks = [txt[i:i + chunk_chars] for i in range(0, len(txt), chunk_chars - overlap)]
         lines.append(f"Chunks created: {len(chunks)}\n")
 
         # compute embeddings locally (sentence-transformers) and build FAISS index
@@ -151,7 +143,13 @@ def run_long_context():
             import numpy as np
             import faiss
             embed_model = SentenceTransformer("all-MiniLM-L6-v2")
-            emb = embed_model.encode(chunks, convert_to_numpy=True, show_progress_bar=False).astype("float32")
+
+            # unchanged text is not re-embedded on every run
+            emb_cache = EmbeddingCache.for_model("all-MiniLM-L6-v2:torch")
+            emb = encode_cached(chunks, lambda texts: embed_model.encode(texts, convert_to_numpy=True,
+                                                                         show_progress_bar=False), emb_cache)
+            if emb_cache is not None:
+                emb_cache.flush()
             # normalize + build index
             faiss.normalize_L2(emb)
             d = emb.shape[1]